@@ -3,13 +3,47 @@ import tomli as toml
 
 DEFAULTS = {
     "n_simulations": 20,
+    "adaptive_replication": False,
+    "adaptive_min_simulations": 3,
+    "adaptive_target_se": {"papers_found": 0.5, "atd": 3.0},
     "stop_at_n": 100,
     "n_abstracts": [1, 4, 7],
     "length_abstracts": [100, 500, 900],
     "llm_temperature": [0.0, 0.4, 0.8],
     "wss_threshold": 0.95,
+    "recall_cutoffs": [25, 50, 100],
+    "random_reference": "analytical",
+    "random_reference_seeds": 10000,
     "stimulus_for_llm": ["inclusion_criteria"],
-    "subset_datasets": None
+    "subset_datasets": None,
+    "n_workers": 1,
+    "queue_lease_minutes": 10,
+    "queue_max_attempts": 3,
+    "share_baselines": False,
+    "feature_store_dir": None,
+    "dataset_cache_dir": None,
+    "al_engine": "asreview",
+    "feature_extractor": "tfidf",
+    "query_batch_size": 1,
+    "output_format": "csv",
+    "output_batch_size": 1,
+    "aggregate_by_ivs": False,
+    "save_rankings": False,
+    "trace_runs": False,
+    "plot_policy": "all",
+    "plot_sample_size": 10,
+    "abstract_cache_mode": "read_write",
+    "abstract_cache_dir": None,
+    "abstract_cache_max_mb": None,
+    "abstract_cache_max_age_days": None,
+    "llm_max_concurrency": 4,
+    "llm_requests_per_second": 5.0,
+    "llm_max_retries": 5,
+    "llm_backend": "openai",
+    "llm_replay_dir": None,
+    "llm_replay_fallback": False,
+    "llm_synthetic_seed": 0,
+    "llm_synthetic_latency": 0.0
 }
 
 def load_pyproject_config(pyproject_path: Path = Path("pyproject.toml")) -> dict:
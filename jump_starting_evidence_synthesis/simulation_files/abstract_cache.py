@@ -0,0 +1,114 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+
+from storage import atomic_write
+
+
+### On-disk cache for LLM-generated abstracts ###
+
+# Every generated abstract is stored as a small json file whose name is a hash of the prompt inputs
+# plus the replicate and the position of the abstract within it, so that re-running a sweep reuses abstracts
+# that were already paid for. The replicate is counted per IV combination (not the global run, which shifts
+# whenever IV combinations are added or removed), and the IVs that shape the prompt are part of the key.
+
+CACHE_MODES = ("off", "read_write", "cache_only")
+
+
+class CacheMissError(LookupError):
+    """Raised in cache_only mode when an abstract is not in the cache."""
+
+
+def abstract_key(name: str, criteria: str, length_abstracts: int, llm_temperature: float, label_relevant: int, model: str, replicate: int, index: int) -> str:
+
+    prompt_inputs = {
+        'dataset': name,
+        'criteria': str(criteria),
+        'length_abstracts': int(length_abstracts),
+        'llm_temperature': float(llm_temperature),
+        'label_relevant': int(label_relevant),
+        'model': model,
+        'replicate': int(replicate),
+        'index': int(index),
+    }
+
+    return hashlib.sha256(json.dumps(prompt_inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _entry_path(cache_dir: Path, key: str) -> Path:
+    # shard on the first two characters to keep directories small
+    return Path(cache_dir) / key[:2] / f"{key}.json"
+
+
+def load_abstract(cache_dir: Path, key: str, max_age_days: float = None) -> dict:
+
+    path = _entry_path(cache_dir, key)
+
+    try:
+        # entries not used within max_age_days count as a miss
+        if max_age_days is not None and time.time() - path.stat().st_mtime > max_age_days * 86400:
+            return None
+        with path.open("r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # refresh modification time so size eviction removes least recently used entries first
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+    return entry['abstract']
+
+
+def store_abstract(cache_dir: Path, key: str, abstract: dict) -> None:
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({'created': time.time(), 'abstract': abstract}, f)
+
+    atomic_write(_entry_path(cache_dir, key), write)
+
+
+def evict_cache(cache_dir: Path, max_size_mb: float = None, max_age_days: float = None) -> int:
+
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return 0
+
+    entries = []
+    for path in cache_dir.glob("*/*.json"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    removed = 0
+    now = time.time()
+
+    # drop entries that were not used within max_age_days
+    if max_age_days is not None:
+        kept = []
+        for mtime, size, path in entries:
+            if now - mtime > max_age_days * 86400:
+                path.unlink(missing_ok=True)
+                removed += 1
+            else:
+                kept.append((mtime, size, path))
+        entries = kept
+
+    # drop least recently used entries until the cache fits within max_size_mb
+    if max_size_mb is not None:
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= max_size_mb * 1024 * 1024:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            removed += 1
+
+    return removed
@@ -2,6 +2,7 @@ from pathlib import Path
 import pandas as pd
 
 from metrics import aggregate_recall_plots
+from storage import simulated_datasets
 
 # parameters for evaluation
 
@@ -9,7 +10,7 @@ stop_at_n = 100
 
 out_dir = Path(r'C:\\Users\\timov\\Desktop\\Utrecht\\Utrecht\\MSBBSS\\thesis_timo\\simulation_results\\correct_trials')
 
-datasets = [p.name for p in out_dir.iterdir() if p.is_dir()]
+datasets = simulated_datasets(out_dir)
 
 print(datasets) 
 
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+
+### Dataset with prior rows appended, without copying the dataset ###
+
+# The llm and criteria conditions screen the dataset with a few prior rows (generated abstracts or the inclusion
+# criteria) appended after the last record. Instead of concatenating a copy of the dataset for every run and IV
+# combination, the shared dataset is kept as it is and the prior rows live in a small overlay, indexed after it.
+
+class AugmentedDataset:
+    """Read-only view of a base dataset followed by an overlay of prior rows."""
+
+    def __init__(self, base: pd.DataFrame, overlay: pd.DataFrame):
+        self.base = base
+        self.overlay = overlay.set_axis(pd.RangeIndex(len(base), len(base) + len(overlay)))
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.overlay)
+
+    @property
+    def prior_idx(self) -> np.ndarray:
+        return np.arange(len(self.base), len(self))
+
+    @property
+    def labels(self) -> np.ndarray:
+        # only the label columns are joined, the text stays where it is
+        return np.concatenate([self.base["label_included"].to_numpy(dtype=int), self.overlay["label_included"].to_numpy(dtype=int)])
+
+    def texts(self, columns: list = ("title", "abstract"), sep: str = " "):
+        yield from row_texts(self.base, columns, sep)
+        yield from row_texts(self.overlay, columns, sep)
+
+
+def row_texts(frame: pd.DataFrame, columns: list = ("title", "abstract"), sep: str = " "):
+
+    # the text columns of every row joined like asreview's TextMerger does, streamed row by row
+    for values in zip(*(frame[column] for column in columns)):
+        yield sep.join("" if pd.isna(value) else str(value) for value in values)
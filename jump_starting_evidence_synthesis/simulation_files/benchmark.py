@@ -0,0 +1,306 @@
+import typer
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+import json
+import multiprocessing
+import platform
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+from config import load_pyproject_config
+
+# Benchmarks run_simulation (all four conditions, synthetic LLM abstracts) on seeded synthetic review datasets of
+# different sizes and prevalences of relevant records. Every case runs in a fresh process, so its peak memory is
+# its own, and the wall time, the time per stage (from the run trace, see instrument.py) and the peak memory are
+# written to a json file. The compare command flags the cases and stages that got slower or use more memory than
+# in a stored baseline file.
+
+app = typer.Typer()
+
+# syllables of the pseudo-words of the synthetic datasets (alphabetic, so the synthetic LLM backend can use them)
+SYLLABLES = "ba be bi bo bu da de di do du fa fe fi fo fu ka ke ki ko ku la le li lo lu ma me mi mo mu na ne ni no nu pa pe pi po pu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo vu za ze zi zo zu".split()
+
+N_WORDS = 20000   # general vocabulary, drawn with Zipf frequencies
+N_TOPIC_WORDS = 300   # vocabulary of the review topic, used far more often in relevant records
+
+# allowed relative increase of the wall and stage times and of the peak memory, and the shortest stage compared
+TIME_TOLERANCE = 0.2
+MEMORY_TOLERANCE = 0.1
+MIN_SECONDS = 0.1
+
+
+### SYNTHETIC DATASETS ###
+
+def vocabulary(seed: int) -> tuple:
+
+    # (general words, topic words) as distinct pseudo-words of two to four syllables
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < N_WORDS + N_TOPIC_WORDS:
+        words.add("".join(rng.choice(SYLLABLES, size=rng.integers(2, 5))))
+
+    words = np.array(sorted(words))
+    rng.shuffle(words)
+
+    return words[:N_WORDS], words[N_WORDS:]
+
+
+def synthetic_dataset(n_records: int, prevalence: float, seed: int = 0, chunk_size: int = 10000) -> pd.DataFrame:
+
+    general, topic = vocabulary(seed)
+    rng = np.random.default_rng([seed, n_records, int(prevalence * 1e6)])
+
+    # at least one relevant record, so the random condition can sample its prior
+    labels = np.zeros(n_records, dtype=int)
+    labels[rng.choice(n_records, size=max(1, round(n_records * prevalence)), replace=False)] = 1
+
+    zipf = 1 / np.arange(1, N_WORDS + 1)
+    zipf /= zipf.sum()
+
+    def texts(chunk_labels: np.ndarray, mean_length: int) -> list:
+
+        # share of topic words: 30% in relevant records, 2% in the others
+        lengths = np.maximum(rng.poisson(mean_length, size=len(chunk_labels)), 1)
+        n_words = lengths.sum()
+        row_topic_share = np.repeat(np.where(chunk_labels == 1, 0.3, 0.02), lengths)
+
+        words = np.where(rng.random(n_words) < row_topic_share, rng.choice(topic, size=n_words), rng.choice(general, size=n_words, p=zipf))
+
+        return [" ".join(row) for row in np.split(words, np.cumsum(lengths)[:-1])]
+
+    # generated in chunks, so the word arrays stay small for the largest datasets
+    titles, abstracts = [], []
+    for start in range(0, n_records, chunk_size):
+        chunk_labels = labels[start:start + chunk_size]
+        titles.extend(texts(chunk_labels, 10))
+        abstracts.extend(texts(chunk_labels, 120))
+
+    return pd.DataFrame({
+        "title": titles,
+        "abstract": abstracts,
+        "label_included": labels,
+        "doi": [f"10.0000/synthetic.{seed}.{i}" for i in range(n_records)],
+    })
+
+
+def synthetic_criteria(seed: int = 0) -> str:
+    _, topic = vocabulary(seed)
+    return "Studies about " + " ".join(topic[:40])
+
+
+def case_name(n_records: int, prevalence: float, seed: int) -> str:
+    return f"synthetic_n{n_records}_p{prevalence:g}_s{seed}"
+
+
+def load_case_dataset(data_dir: Path, n_records: int, prevalence: float, seed: int) -> pd.DataFrame:
+
+    # generated once per (size, prevalence, seed) and kept in data_dir, in the same format as the dataset cache
+    path = data_dir / f"{case_name(n_records, prevalence, seed)}.feather"
+
+    if not path.exists():
+        print(f"Generating {path.stem}")
+        from storage import atomic_write
+        dataset = synthetic_dataset(n_records, prevalence, seed)
+        atomic_write(path, lambda tmp_path: dataset.to_feather(tmp_path, compression="uncompressed"))
+
+    import pyarrow.feather as feather
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+
+### RUN ONE CASE (in its own process) ###
+
+def run_case(case: dict, settings: dict, data_dir: Path) -> dict:
+
+    from simulation import run_simulation
+    from instrument import tracing, trace_file, read_traces, memory_mb
+
+    name = case_name(case['n_records'], case['prevalence'], case['seed'])
+    dataset = load_case_dataset(data_dir, case['n_records'], case['prevalence'], case['seed'])
+    metadata = pd.DataFrame([{"dataset_ID": name, "inclusion_criteria": synthetic_criteria(case['seed'])}])
+
+    rss_before, _ = memory_mb()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_dir = Path(out_dir)
+        path = trace_file(out_dir, name, 1, settings['n_abstracts'], settings['length_abstracts'], settings['llm_temperature'])
+
+        start = time.perf_counter()
+        with tracing(path, dataset=name, run=1):
+            results_rows = run_simulation(
+                datasets={name: dataset},
+                criterium=["inclusion_criteria"],
+                out_dir=out_dir,
+                metadata=metadata,
+                n_abstracts=settings['n_abstracts'],
+                length_abstracts=settings['length_abstracts'],
+                llm_temperature=settings['llm_temperature'],
+                papers_screened=settings['stop_at_n'],
+                run=1,
+                replicate=0,
+                stop_at_n=settings['stop_at_n'],
+                write_results=False,
+                llm_options={"backend": "synthetic"},
+                engine=settings['engine'],
+                feature_extractor=settings['feature_extractor'],
+                query_batch_size=settings['query_batch_size'])
+        wall_seconds = time.perf_counter() - start
+
+        traces = read_traces(out_dir)
+
+    # seconds per stage (and condition) of run_simulation, e.g. "simulate/llm"
+    traces = traces[(traces['stage'] != 'llm_request') & (traces['stage'] != 'run')]
+    stage_names = traces['stage'] + np.where(traces['condition'].notna(), '/' + traces['condition'].fillna(''), '')
+    stages = traces.groupby(stage_names)['seconds'].sum().round(4).to_dict()
+
+    # the outcomes are kept as well, so that a comparison can tell when a change altered the results
+    df_results = results_rows[name]
+    papers_found = df_results[df_results['metric'] == 'papers_found'].set_index('condition')['value'].astype(int).to_dict()
+
+    return {
+        **case,
+        'name': name,
+        'wall_seconds': round(wall_seconds, 4),
+        'stages': stages,
+        'rss_before_mb': round(rss_before, 1),
+        'peak_rss_mb': round(memory_mb()[1], 1),
+        'papers_found': papers_found,
+    }
+
+
+
+### COMMANDS ###
+
+@app.command()
+def run(
+    output: Path = typer.Option(Path("benchmark.json"), "--output", help="File to write the benchmark results to."),
+    sizes: List[int] = typer.Option([1000, 10000, 100000, 500000], "--size", min=10, help="Numbers of records of the synthetic datasets, can be repeated."),
+    prevalences: List[float] = typer.Option([0.01, 0.05], "--prevalence", help="Shares of relevant records, can be repeated."),
+    seed: int = typer.Option(0, "--seed", help="Seed of the synthetic datasets."),
+    repeats: int = typer.Option(1, "--repeats", min=1, help="Times each case is run; the fastest run counts."),
+    data_dir: Path = typer.Option(Path(tempfile.gettempdir()) / "jumpstart_benchmark", "--data-dir", help="Folder where the generated datasets are kept between benchmarks."),
+    stop_at_n: int = typer.Option(None, "--stop-at-n", help="Records to screen per simulation (defaults to stop_at_n in pyproject.toml)."),
+    baseline: Path = typer.Option(None, "--baseline", exists=True, dir_okay=False, help="Baseline file to compare the results with."),
+):
+
+    # the pipeline as configured in pyproject.toml, with the first value of every IV grid
+    config = load_pyproject_config()
+
+    settings = {
+        'stop_at_n': stop_at_n if stop_at_n is not None else config.get("stop_at_n"),
+        'n_abstracts': config.get("n_abstracts")[0],
+        'length_abstracts': config.get("length_abstracts")[0],
+        'llm_temperature': config.get("llm_temperature")[0],
+        'engine': config.get("al_engine"),
+        'feature_extractor': config.get("feature_extractor"),
+        'query_batch_size': config.get("query_batch_size"),
+    }
+
+    cases = [{'n_records': n_records, 'prevalence': prevalence, 'seed': seed} for n_records in sizes for prevalence in prevalences]
+    results = []
+
+    for case in cases:
+
+        # datasets are generated up front, so that generating them is not part of the measured time and memory
+        load_case_dataset(data_dir, case['n_records'], case['prevalence'], case['seed'])
+
+        runs = []
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                runs.append(pool.submit(run_case, case, settings, data_dir).result())
+
+        result = min(runs, key=lambda r: r['wall_seconds'])
+        result['peak_rss_mb'] = max(r['peak_rss_mb'] for r in runs)
+        results.append(result)
+
+        print(f"{result['name']}: {result['wall_seconds']:.2f}s, peak memory {result['peak_rss_mb']:.0f} MB, "
+              f"slowest stage {max(result['stages'], key=result['stages'].get)}")
+
+    benchmark = {
+        'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'processor': platform.processor(), 'cpus': multiprocessing.cpu_count()},
+        'settings': settings,
+        'cases': results,
+    }
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('w') as f:
+        json.dump(benchmark, f, indent=1)
+
+    print(f"Benchmark results written to {output}")
+
+    if baseline is not None:
+        compare(output, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE, min_seconds=MIN_SECONDS)
+
+
+def regressions(current: dict, baseline: dict, time_tolerance: float, memory_tolerance: float, min_seconds: float) -> list:
+
+    # (case, measure, baseline value, current value, regression) of every measure of the cases in both files;
+    # stages that take less than min_seconds in both files are too noisy to compare
+    rows = []
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+
+    for case in current['cases']:
+        if case['name'] not in baseline_cases:
+            continue
+        base = baseline_cases[case['name']]
+
+        times = {'wall': (base['wall_seconds'], case['wall_seconds'])}
+        times.update({f'stage {stage}': (base['stages'].get(stage, 0.0), seconds) for stage, seconds in case['stages'].items()})
+
+        for measure, (old, new) in times.items():
+            if max(old, new) >= min_seconds:
+                rows.append((case['name'], f'{measure} (s)', old, new, new > old * (1 + time_tolerance)))
+
+        rows.append((case['name'], 'peak memory (MB)', base['peak_rss_mb'], case['peak_rss_mb'], case['peak_rss_mb'] > base['peak_rss_mb'] * (1 + memory_tolerance)))
+
+        if case['papers_found'] != base['papers_found']:
+            print(f"Note: {case['name']} finds other papers than the baseline ({case['papers_found']} vs {base['papers_found']}), so the results changed too.")
+
+    return rows
+
+
+@app.command()
+def compare(
+    current: Path = typer.Argument(..., exists=True, dir_okay=False, help="Benchmark results to check."),
+    baseline: Path = typer.Argument(..., exists=True, dir_okay=False, help="Stored benchmark results to compare with."),
+    time_tolerance: float = typer.Option(TIME_TOLERANCE, "--time-tolerance", help="Allowed relative increase of the wall time and stage times."),
+    memory_tolerance: float = typer.Option(MEMORY_TOLERANCE, "--memory-tolerance", help="Allowed relative increase of the peak memory."),
+    min_seconds: float = typer.Option(MIN_SECONDS, "--min-seconds", help="Stages faster than this in both files are not compared."),
+):
+
+    with current.open() as f:
+        current_results = json.load(f)
+    with baseline.open() as f:
+        baseline_results = json.load(f)
+
+    if current_results['settings'] != baseline_results['settings']:
+        print(f"Note: the benchmarks ran with different settings ({current_results['settings']} vs {baseline_results['settings']}).")
+    if current_results['machine'] != baseline_results['machine']:
+        print("Note: the benchmarks ran on different machines, so their times may not be comparable.")
+
+    rows = regressions(current_results, baseline_results, time_tolerance, memory_tolerance, min_seconds)
+
+    if not rows:
+        print("The benchmark files have no cases in common.")
+        raise typer.Exit(code=1)
+
+    df_comparison = pd.DataFrame(rows, columns=['case', 'measure', 'baseline', 'current', 'regression'])
+    df_comparison['change'] = (df_comparison['current'] / df_comparison['baseline'] - 1).map('{:+.0%}'.format)
+    df_comparison['regression'] = np.where(df_comparison['regression'], '<-- regression', '')
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.float_format', '{:.2f}'.format):
+        print(df_comparison.to_string(index=False))
+
+    n_regressions = (df_comparison['regression'] != '').sum()
+    if n_regressions:
+        print(f"{n_regressions} measures regressed against {baseline}.")
+        raise typer.Exit(code=1)
+
+    print(f"No regressions against {baseline}.")
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,98 @@
+import typer
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+from asreview.models.feature_extractors import Tfidf
+
+from config import load_pyproject_config
+from features import fit_features
+from llm import prepare_datasets
+from simulation import simulate, TFIDF_KWARGS
+from priors import sample_priors
+
+# Checks that the native active learning engine screens the records in the same order as asreview, for all four
+# conditions of the first few runs of each dataset. The llm and criteria views are built like in a sweep, with the
+# first IV combination in pyproject.toml and abstracts from the synthetic backend, so no API calls are made.
+
+app = typer.Typer()
+
+@app.command()
+def check(
+    in_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Folder containing datasets (e.g. the SYNERGY csv files)."),
+    criteria_path: Path = typer.Argument(..., exists=True, file_okay=True, dir_okay=False, readable=True,
+                                  help="Path to criteria file for LLM."),
+    n_runs: int = typer.Option(3, "--n-runs", min=1, help="Number of seeds to compare per dataset."),
+    stop_at_n: int = typer.Option(100, "--stop-at-n", help="Records to screen per simulation (-1 to run to completion)."),
+    query_batch_size: int = typer.Option(1, "--query-batch-size", min=1, help="Records screened between two retrainings of the classifier."),
+):
+
+    config = load_pyproject_config()
+    metadata = pd.read_excel(criteria_path)
+    llm_options = {"backend": "synthetic", "synthetic_seed": config.get("llm_synthetic_seed")}
+
+    mismatches = 0
+
+    for path in sorted(Path(in_dir).glob("*.csv")):
+
+        dataset = pd.read_csv(path)
+        labels = dataset["label_included"]
+        X = Tfidf(**TFIDF_KWARGS).fit_transform(dataset)
+
+        for run in range(1, n_runs + 1):
+
+            # features, labels and priors per condition
+            views = {"no_initialisation": (X, labels, []), "random": (X, labels, [sample_priors(dataset, seed=run)])}
+
+            with tempfile.TemporaryDirectory() as out_dir:
+                prepared = prepare_datasets(dataset, name=path.stem, criterium=config.get("stimulus_for_llm"), out_dir=Path(out_dir), metadata=metadata, n_abstracts=config.get("n_abstracts")[0], length_abstracts=config.get("length_abstracts")[0], llm_temperature=config.get("llm_temperature")[0], run=run, replicate=run - 1, llm_options=llm_options)
+
+            # datasets missing from the criteria file only have the baseline conditions
+            if prepared is not None:
+                for condition, view in zip(("llm", "criteria"), prepared):
+                    views[condition] = (fit_features(view['dataset'], TFIDF_KWARGS), view['dataset'].labels, view['prior_idx'])
+
+            for condition, (X_condition, labels_condition, prior_idx) in views.items():
+
+                # stop_at_n records are screened after the priors (-1 runs to completion)
+                n_stop = stop_at_n + len(prior_idx) if stop_at_n != -1 else -1
+
+                start = time.perf_counter()
+                reference = simulate(X_condition, labels_condition, prior_idx, seed=run, n_stop=n_stop, skip_transform=True, engine="asreview", query_batch_size=query_batch_size)
+                time_asreview = time.perf_counter() - start
+
+                start = time.perf_counter()
+                native = simulate(X_condition, labels_condition, prior_idx, seed=run, n_stop=n_stop, skip_transform=True, engine="native", query_batch_size=query_batch_size)
+                time_native = time.perf_counter() - start
+
+                # position of the first record screened in a different order, if any
+                same = len(reference) == len(native) and np.array_equal(reference["record_id"].to_numpy(), native["record_id"].to_numpy())
+                n_common = min(len(reference), len(native))
+                diverged = np.flatnonzero(reference["record_id"].to_numpy()[:n_common] != native["record_id"].to_numpy()[:n_common])
+                first_diff = int(diverged[0]) if len(diverged) else n_common
+
+                # with batches, asreview breaks ties between equally scored records arbitrarily, so the
+                # records screened in each batch are compared as sets
+                same_batches = same or (len(reference) == len(native) and np.array_equal(
+                    reference["record_id"].groupby(reference["training_set"].fillna(-1).astype(int).to_numpy()).apply(frozenset).to_numpy(),
+                    native["record_id"].groupby(native["training_set"].fillna(-1).astype(int).to_numpy()).apply(frozenset).to_numpy()))
+
+                if not same_batches:
+                    mismatches += 1
+
+                status = 'identical' if same else 'same batches, order within a batch differs' if same_batches else f'differs from record {first_diff}'
+                print(f"{path.stem} run {run} {condition}: {status}, "
+                      f"papers found {int(reference['label'].sum())} vs {int(native['label'].sum())}, "
+                      f"time {time_asreview:.2f}s vs {time_native:.2f}s")
+
+    if mismatches:
+        print(f"{mismatches} simulations differ between the engines.")
+        raise typer.Exit(code=1)
+
+    print("The native engine matches asreview on all simulations.")
+
+if __name__ == "__main__":
+    app()
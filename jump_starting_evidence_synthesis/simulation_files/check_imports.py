@@ -0,0 +1,90 @@
+import typer
+from pathlib import Path
+import os
+import subprocess
+import sys
+import tempfile
+
+# Checks the import-time budget of the commands of run.py: every command is started in a fresh interpreter with
+# python -X importtime (on an empty output folder, so only startup is measured), and the check fails when its imports
+# take longer than the budget or pull in a heavy package that only the simulation itself needs.
+
+RUN_PY = Path(__file__).parent / 'run.py'
+
+# command line -> import-time budget in seconds
+IMPORT_BUDGETS = {
+    ('--help',): 0.5,
+    ('aggregate', '{out_dir}'): 1.5,
+    ('evaluate', '{out_dir}'): 1.5,
+    ('plot', '{out_dir}'): 1.5,
+    ('profile', '{out_dir}'): 1.5,
+    ('merge', '{out_dir}'): 1.5,
+}
+
+# packages that are only imported once simulations run, abstracts are requested or plots are drawn
+HEAVY_PACKAGES = ['asreview', 'sklearn', 'dspy', 'litellm', 'matplotlib']
+
+app = typer.Typer()
+
+
+def import_profile(args: list) -> tuple:
+
+    # (cumulative time in microseconds, indented module name) of every import; config.py is imported from the project folder
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(RUN_PY.parent.parent), os.environ.get('PYTHONPATH', '')])}
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line.removeprefix('import time:').split('|')
+            imports.append((int(cumulative), name))
+
+    return imports
+
+
+def startup_time(args: list, startup_modules: set) -> tuple:
+
+    # total import time (sum of the cumulative time of the top-level imports, leaving out the ones every interpreter
+    # makes at startup) and the top-level packages imported; nested imports are indented below their importer
+    imports = import_profile([str(RUN_PY), *args])
+
+    seconds = sum(cumulative for cumulative, name in imports if not name[1:].startswith(' ') and name.strip() not in startup_modules) / 1e6
+    packages = {name.strip().split('.')[0] for _, name in imports}
+
+    return seconds, packages
+
+
+@app.command()
+def check(
+    repeats: int = typer.Option(3, "--repeats", min=1, help="Times each command is started; the fastest start counts."),
+):
+
+    failures = 0
+
+    # modules imported by the interpreter itself before run.py starts
+    startup_modules = {name.strip() for _, name in import_profile(['-c', 'pass'])}
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for command, budget in IMPORT_BUDGETS.items():
+
+            args = [arg.format(out_dir=out_dir) for arg in command]
+            profiles = [startup_time(args, startup_modules) for _ in range(repeats)]
+            seconds = min(profile[0] for profile in profiles)
+            heavy = sorted(set(HEAVY_PACKAGES) & profiles[0][1])
+
+            ok = seconds <= budget and not heavy
+            failures += not ok
+
+            print(f"run.py {command[0]}: imports {seconds:.2f}s (budget {budget:.1f}s)"
+                  + (f", imports {', '.join(heavy)}" if heavy else '') + ('' if ok else '  <-- over budget'))
+
+    if failures:
+        print(f"{failures} commands exceed their import-time budget.")
+        raise typer.Exit(code=1)
+
+    print("All commands start within their import-time budget.")
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,171 @@
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.optimize import minimize
+
+from features import StackedFeatures
+
+
+### Native active learning engine ###
+
+# Covers exactly the cycles built in simulation.make_cycles: a Random querier until both classes are labeled
+# (IsFittable), followed by Max + SVM(C=0.11, squared hinge) + Balanced(ratio=9.8) until NLabeled(n_stop),
+# with asreview's default LastRelevant stop on top. Instead of refitting LinearSVC from scratch and ranking
+# the whole pool after every label, the primal SVM problem is warm-started from the previous solution and
+# the pool is scored in place with one sparse mat-vec over the features seen in training per query. The features of
+# a feature store (and the prior rows stacked on them) are only read, never copied.
+# The cost of a fit grows with the vocabulary of the labeled records, so on small datasets that are screened far
+# (e.g. 500 records of a hard, low-prevalence dataset of 3k records) asreview is faster; see check_engine.py.
+
+ENGINES = ("asreview", "native")
+
+RESULTS_COLUMNS = ["record_id", "label", "classifier", "querier", "balancer", "feature_extractor", "training_set", "time", "note", "tags", "user_id"]
+
+
+def balanced_weights(y: np.ndarray, ratio: float) -> np.ndarray:
+
+    # same weights as asreview's Balanced balancer
+    n_relevant = np.sum(y == 1)
+    n_irrelevant = np.sum(y == 0)
+
+    weights = np.where(y == 1, 1.0, n_relevant / (ratio * n_irrelevant))
+    return weights * (len(y) / weights.sum())
+
+
+def with_intercept(X: sp.csr_matrix) -> sp.csr_matrix:
+
+    # X with an extra last column of ones, built from its arrays (one value appended to every row)
+    n_rows, n_columns = X.shape
+    ends = X.indptr[1:]
+
+    indices = np.insert(X.indices, ends, n_columns)
+    data = np.insert(X.data, ends, 1.0)
+    indptr = X.indptr + np.arange(n_rows + 1)
+
+    return sp.csr_matrix((data, indices, indptr), shape=(n_rows, n_columns + 1))
+
+
+def fit_svm(X: sp.csr_matrix, y: np.ndarray, sample_weight: np.ndarray, C: float, coef_init: np.ndarray = None) -> np.ndarray:
+
+    # primal of LinearSVC(penalty="l2", loss="squared_hinge") as solved by liblinear: the intercept is an extra
+    # feature with value 1 and is regularised too, so the objective is strictly convex with a unique minimum
+    X_bias = with_intercept(X)
+    X_bias_t = X_bias.T.tocsr()
+    sign = np.where(y == 1, 1.0, -1.0)
+    cost = C * sample_weight
+
+    def objective(w):
+        # records outside the margin contribute neither loss nor gradient
+        margin = np.maximum(1 - sign * (X_bias @ w), 0)
+        loss = 0.5 * w @ w + cost @ margin ** 2
+        grad = w - 2 * (X_bias_t @ (cost * sign * margin))
+        return loss, grad
+
+    # liblinear itself stops at a dual tolerance of 1e-4, so its solution is not exact either: these tolerances
+    # reproduce its screening orders in check_engine.py (tighter ones only cost iterations and can break near-ties)
+    w0 = coef_init if coef_init is not None else np.zeros(X_bias.shape[1])
+    solution = minimize(objective, w0, jac=True, method="L-BFGS-B", options={"maxiter": 1000, "gtol": 1e-6, "ftol": 1e-10})
+
+    return solution.x
+
+
+def simulate_native(X, labels, prior_idx, seed: int, n_stop: int, C: float = 0.11, ratio: float = 9.8, feature_extractor: str = "tfidf", n_query: int = 1) -> pd.DataFrame:
+
+    X = X if isinstance(X, StackedFeatures) else StackedFeatures(sp.csr_matrix(X))
+    labels = np.asarray(labels, dtype=int)
+    n_records = len(labels)
+    n_relevant = labels.sum()
+
+    labeled = np.zeros(n_records, dtype=bool)
+    record_ids, training_sets, names, times = [], [], [], []
+
+    def label(ids, training_set, cycle_names):
+        labeled[ids] = True
+        record_ids.extend(int(i) for i in ids)
+        training_sets.extend([training_set] * len(ids))
+        names.extend([cycle_names] * len(ids))
+        times.extend([time.time()] * len(ids))
+
+    def all_found():
+        # asreview's default LastRelevant stopper, which also stops once every record is labeled
+        return labeled.all() or labels[labeled].sum() == n_relevant
+
+    # priors are labeled without a cycle
+    if len(prior_idx) > 0:
+        label(np.asarray(prior_idx, dtype=int), None, (None, None, None, None))
+
+    ### CYCLE 1: RANDOM UNTIL BOTH CLASSES ARE LABELED ###
+
+    while not all_found() and not (labels[labeled].sum() >= 1 and (labels[labeled] == 0).sum() >= 1):
+
+        # same permutation as asreview's Random(random_state=seed) over the sorted pool
+        pool = np.flatnonzero(~labeled)
+        ranking = np.arange(len(pool))
+        np.random.RandomState(seed).shuffle(ranking)
+
+        label(pool[ranking[:1]], len(record_ids), (None, "random", None, None))
+
+    ### CYCLE 2: MAX + SVM + BALANCED UNTIL N LABELED ###
+
+    # weights of features absent from the training records are zero at the optimum, so the classifier
+    # is fitted on the (sorted) features seen so far, which only grow as records are labeled; column maps every
+    # feature to its position among them
+    features = np.array([], dtype=np.int64)
+    column = np.zeros(X.shape[1], dtype=np.int64)
+    seen = np.zeros(X.shape[1], dtype=bool)
+    n_seen = 0
+    coef = np.zeros(1)
+    scores = np.empty(n_records)
+
+    while not all_found() and not (n_stop != -1 and len(record_ids) >= n_stop):
+
+        train_idx = np.asarray(record_ids)
+        X_train = X[train_idx]
+        y_train = labels[train_idx]
+
+        # warm-start the classifier from the previous iteration, with zero weights for new features (only the
+        # records labeled since then can bring new ones, inserted in order)
+        new_features = np.unique(X[train_idx[n_seen:]].indices)
+        new_features = new_features[~seen[new_features]]
+        positions = np.searchsorted(features, new_features)
+        coef_init = np.append(np.insert(coef[:-1], positions, 0.0), coef[-1])
+        features = np.insert(features, positions, new_features)
+        seen[new_features] = True
+        column[features] = np.arange(len(features), dtype=column.dtype)
+        n_seen = len(train_idx)
+
+        X_train = sp.csr_matrix((X_train.data, column[X_train.indices], X_train.indptr), shape=(len(train_idx), len(features)))
+        coef = fit_svm(X_train, y_train, balanced_weights(y_train, ratio), C, coef_init=coef_init)
+
+        # score the whole pool in place and take the top records
+        np.add(X.dot_features(features, coef[:-1]), coef[-1], out=scores)
+        scores[labeled] = -np.inf
+
+        # a batch never screens past n_stop
+        k = min(n_query, n_records - labeled.sum())
+        if n_stop != -1:
+            k = max(1, min(k, n_stop - len(record_ids)))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        label(top, len(record_ids), ("svm", "max", "balanced", feature_extractor))
+
+    ### RESULTS IN ASREVIEW'S FORMAT ###
+
+    names = np.array(names, dtype=object).reshape(-1, 4)
+
+    return pd.DataFrame({
+        "record_id": np.array(record_ids, dtype=int),
+        "label": labels[record_ids],
+        "classifier": names[:, 0],
+        "querier": names[:, 1],
+        "balancer": names[:, 2],
+        "feature_extractor": names[:, 3],
+        "training_set": pd.Series(training_sets, dtype=object),
+        "time": times,
+        "note": None,
+        "tags": None,
+        "user_id": None,
+    }, columns=RESULTS_COLUMNS)
@@ -0,0 +1,305 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from pathlib import Path
+import threading
+import time
+
+from instrument import tracing, trace_file
+from storage import ResultsWriter, read_results, remove_temporary_files
+from manifest import load_manifest, record_cells, is_complete, damaged_outputs, prune_results, cell_key
+from replication import replicate_precision, converged_groups, replication_group, PRECISION_NAME
+from scheduling import CostModel, dataset_sizes, group_cells, pop_longest, format_projection, cell_conditions, N_CONDITIONS
+from work_queue import queue_path, shard_dir, claim_cell, keep_lease, complete_cell, release_cell, queue_status, projected_seconds, baseline_worker, copy_shared_baselines, POLL_SECONDS
+
+
+### BUILD THE SWEEP GRID ###
+
+def build_tasks(dataset_names: list, iv_combinations: list, n_simulations: int, share_baselines: bool = False) -> list:
+
+    # one task per (run, IV combination, dataset) cell, in the same order as the serial loop
+    tasks = []
+
+    for run in range(n_simulations):
+        for combo_idx, (n_abs, len_abs, temp) in enumerate(iv_combinations):
+            for name in dataset_names:
+                tasks.append({
+                    'dataset': name,
+                    'replicate': run,
+                    'combo_idx': combo_idx,
+                    'n_abstracts': n_abs,
+                    'length_abstracts': len_abs,
+                    'llm_temperature': temp,
+                    'run': run * len(iv_combinations) + combo_idx + 1,  # global run counter starting from 1
+                    'baseline_run': run * len(iv_combinations) + 1 if share_baselines else None,  # IV-independent conditions run once per replicate
+                })
+
+    return tasks
+
+
+
+### RUN A SINGLE CELL ###
+
+# datasets, shared simulation settings and whether runs are traced, set once per worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(datasets: dict, sim_kwargs: dict, trace_runs: bool = False) -> None:
+    _worker_state['datasets'] = datasets
+    _worker_state['sim_kwargs'] = sim_kwargs
+    _worker_state['trace_runs'] = trace_runs
+
+
+def run_cell(task: dict) -> dict:
+
+    # imported here, so that building the grid (e.g. for the generate command) does not import asreview
+    from simulation import run_simulation
+
+    name = task['dataset']
+
+    # time and memory of every stage of the run go to its own trace file (see instrument.py)
+    trace = nullcontext()
+    if _worker_state['trace_runs']:
+        path = trace_file(_worker_state['sim_kwargs']['out_dir'], name, task['run'], task['n_abstracts'], task['length_abstracts'], task['llm_temperature'])
+        trace = tracing(path, dataset=name, run=task['run'], n_abstracts=task['n_abstracts'], length_abstracts=task['length_abstracts'], llm_temperature=task['llm_temperature'])
+
+    # results are returned to the parent process instead of being appended to the master file here
+    with trace:
+        return run_simulation(
+            datasets={name: _worker_state['datasets'][name]},
+            n_abstracts=task['n_abstracts'],
+            length_abstracts=task['length_abstracts'],
+            llm_temperature=task['llm_temperature'],
+            run=task['run'],
+            replicate=task['replicate'],
+            baseline_run=task['baseline_run'],
+            write_results=False,
+            **_worker_state['sim_kwargs']
+        )
+
+
+
+### RUN THE FULL SWEEP ###
+
+def resume_tasks(tasks: list, out_dir: Path, manifest: dict, output_format: str = "csv") -> list:
+
+    # temporary files of writes that the interrupted sweep did not finish
+    removed = remove_temporary_files(out_dir)
+    if removed:
+        print(f"Removed {removed} temporary files of interrupted writes")
+
+    # resume: skip the cells whose outputs are all in place (including their LLM generation) and redo the others
+    done_tasks = [task for task in tasks if is_complete(out_dir, manifest, task)]
+    prune_results(out_dir, done_tasks, output_format=output_format)
+    tasks = [task for task in tasks if not is_complete(out_dir, manifest, task)]
+    print(f"Resuming sweep: skipping {len(done_tasks)} finished cells, {len(tasks)} cells left")
+
+    # damaged files are removed, so the cells that are redone do not reuse them (e.g. shared baselines)
+    for path in {path for task in tasks for path in damaged_outputs(out_dir, manifest, task)}:
+        print(f"Removing damaged output {path.relative_to(out_dir)}")
+        path.unlink()
+
+    return tasks
+
+
+def run_sweep(tasks: list, datasets: dict, out_dir: Path, n_workers: int, resume: bool = False, output_batch_size: int = 1, trace_runs: bool = False, **sim_kwargs) -> None:
+
+    sim_kwargs['out_dir'] = out_dir
+
+    # every finished cell is recorded in the manifest, saved right after each batch of metrics rows is written
+    manifest = load_manifest(out_dir)
+
+    # metrics rows are written to the master results every output_batch_size cells
+    writer = ResultsWriter(out_dir, output_format=sim_kwargs.get('output_format', 'csv'), batch_size=output_batch_size)
+
+    def finish_cell(task: dict, results_rows: dict) -> None:
+        record_cells(out_dir, manifest, writer.add(list(results_rows.values()), task), output_format=writer.output_format)
+
+    def flush() -> None:
+        record_cells(out_dir, manifest, writer.flush(), output_format=writer.output_format)
+
+    if resume:
+        tasks = resume_tasks(tasks, out_dir, manifest, output_format=writer.output_format)
+
+    # the longest cells start first: costs are estimated from the dataset sizes, and refined with the time of every
+    # finished cell (and of the traced cells of an earlier, interrupted sweep in out_dir)
+    model = CostModel(dataset_sizes(datasets), sim_kwargs.get('stop_at_n'), sim_kwargs.get('query_batch_size') or 1)
+    model.observe_traces(out_dir)
+    groups = group_cells(tasks)
+
+    # with shared baselines, a cell that reuses them starts once the cell simulating them finished
+    baseline_cells = {(task['dataset'], task['run']) for task in tasks if cell_conditions(task) == N_CONDITIONS}
+    finished_cells = set()
+
+    def can_start(task: dict) -> bool:
+        return cell_conditions(task) == N_CONDITIONS or (task['dataset'], task['baseline_run']) not in baseline_cells or (task['dataset'], task['baseline_run']) in finished_cells
+
+    def observe(task: dict, seconds: float) -> None:
+        model.observe(task['dataset'], cell_conditions(task), seconds)
+        finished_cells.add((task['dataset'], task['run']))
+
+    # serial mode: run every cell in this process
+    if n_workers <= 1:
+        _init_worker(datasets, sim_kwargs, trace_runs)
+
+        try:
+            for i in range(len(tasks)):
+                task = pop_longest(groups, model, can_start)
+
+                print(f"\nCell {i + 1}/{len(tasks)}: dataset={task['dataset']}, "
+                      f"n_abstracts={task['n_abstracts']}, length={task['length_abstracts']}, temperature={task['llm_temperature']}. "
+                      f"From simulation {task['replicate'] + 1}, global run {task['run']}.")
+
+                start = time.perf_counter()
+                finish_cell(task, run_cell(task))
+                observe(task, time.perf_counter() - start)
+
+                print(f"Finished cell {i + 1}/{len(tasks)}, {format_projection(model.projection({group: len(cells) for group, cells in groups.items()}, [], 1))}")
+        finally:
+            # also keep the finished cells of a sweep that fails halfway
+            flush()
+
+        return
+
+    # parallel mode: every cell is an independent task, only the parent process writes to the master file
+    print(f"Running {len(tasks)} cells on {n_workers} worker processes, longest first")
+
+    # cells are submitted one at a time as workers become free, so every choice uses the estimates of that moment
+    running = {}
+    n_finished = 0
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(datasets, sim_kwargs, trace_runs)) as pool:
+
+        try:
+            while running or any(groups.values()):
+
+                while len(running) < n_workers:
+                    task = pop_longest(groups, model, can_start)
+                    if task is None:
+                        break
+                    running[pool.submit(run_cell, task)] = (task, time.perf_counter())
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    task, start = running.pop(future)
+                    finish_cell(task, future.result())
+                    observe(task, time.perf_counter() - start)
+
+                    n_finished += 1
+                    now = time.perf_counter()
+                    projection = model.projection({group: len(cells) for group, cells in groups.items()}, [(task, now - start) for task, start in running.values()], n_workers)
+                    print(f"Finished cell {n_finished}/{len(tasks)}: dataset={task['dataset']}, global run {task['run']}, {format_projection(projection)}.")
+        finally:
+            flush()
+
+
+
+### ADD REPLICATES UNTIL THE METRICS ARE PRECISE ENOUGH ###
+
+def run_adaptive_sweep(tasks: list, datasets: dict, out_dir: Path, n_workers: int, target_se: dict, min_simulations: int = 3, resume: bool = False, **sweep_kwargs) -> None:
+
+    # tasks is the grid up to the maximum number of replicates; every round runs the next replicates of the
+    # (dataset, IV combination) cells that did not reach the target standard errors yet (see replication.py)
+    output_format = sweep_kwargs.get('output_format', 'csv')
+    n_replicates = max(task['replicate'] for task in tasks) + 1
+
+    # a resumed sweep keeps every finished cell of the grid, also of the replicates of later rounds
+    left = resume_tasks(tasks, out_dir, load_manifest(out_dir), output_format=output_format) if resume else tasks
+    left_keys = {cell_key(task) for task in left}
+
+    active = {replication_group(task) for task in tasks}
+    n_groups = len(active)
+    replicate = 0
+
+    while active and replicate < n_replicates:
+
+        # at least min_simulations replicates first, so every standard error rests on a few values
+        n_round = max(min_simulations, 1) if replicate == 0 else 1
+        round_tasks = [task for task in tasks if replicate <= task['replicate'] < replicate + n_round and replication_group(task) in active]
+
+        print(f"\nAdaptive replication: replicates {replicate + 1} to {min(replicate + n_round, n_replicates)} (of at most {n_replicates}) for {len(active)} of {n_groups} dataset and IV combinations")
+        replicate += n_round
+        run_sweep([task for task in round_tasks if cell_key(task) in left_keys], datasets, out_dir, n_workers, **sweep_kwargs)
+
+        df_results = read_results(out_dir, output_format)
+        if df_results is None:
+            continue
+
+        df_precision = replicate_precision(df_results, tasks, target_se)
+        df_precision.to_csv(out_dir / PRECISION_NAME, index=False)
+        active -= converged_groups(df_precision)
+
+    print(f"Adaptive replication: {n_groups - len(active)} of {n_groups} dataset and IV combinations reached the target standard errors, "
+          f"{len(active)} stopped at {n_replicates} replicates")
+
+
+
+### WORK ON THE QUEUE OF A DISTRIBUTED SWEEP ###
+
+def run_worker(datasets: dict, out_dir: Path, worker: str, lease_seconds: float = 600, max_attempts: int = 3, poll_seconds: float = POLL_SECONDS, trace_runs: bool = False, **sim_kwargs) -> int:
+
+    # claims cells from the queue in out_dir until none are left, and writes their outputs to the shard of this worker
+    path = queue_path(out_dir)
+    shard = shard_dir(out_dir, worker)
+    sim_kwargs['out_dir'] = shard
+
+    _init_worker(datasets, sim_kwargs, trace_runs)
+
+    # every cell is written and recorded in the shard manifest before it is marked done in the queue
+    manifest = load_manifest(shard)
+    writer = ResultsWriter(shard, output_format=sim_kwargs.get('output_format', 'csv'), batch_size=1)
+
+    n_finished = 0
+
+    while True:
+
+        task = claim_cell(path, worker, lease_seconds, max_attempts)
+
+        if task is None:
+            counts = queue_status(path, max_attempts)
+            if counts['pending'] + counts['leased'] == 0:
+                break
+
+            # cells are running elsewhere: wait for their shared baselines, or for leases to expire
+            time.sleep(poll_seconds)
+            continue
+
+        print(f"\nWorker {worker}, cell {cell_key(task)}: dataset={task['dataset']}, "
+              f"n_abstracts={task['n_abstracts']}, length={task['length_abstracts']}, temperature={task['llm_temperature']}. "
+              f"From simulation {task['replicate'] + 1}, global run {task['run']}.")
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease, args=(path, task, worker, lease_seconds, stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            if task['dataset'] not in datasets:
+                raise KeyError(f"dataset {task['dataset']} is not among the datasets of this worker")
+
+            copy_shared_baselines(out_dir, shard, task, baseline_worker(path, task), output_format=writer.output_format)
+
+            start = time.perf_counter()
+            record_cells(shard, manifest, writer.add(list(run_cell(task).values()), task), output_format=writer.output_format)
+
+            complete_cell(path, task, worker, seconds=time.perf_counter() - start)
+            n_finished += 1
+
+            print(f"Worker {worker} finished cell {cell_key(task)}, {format_projection(projected_seconds(path))} of the queue")
+
+        except Exception as error:
+            # the cell is tried again, by this or another worker, until it failed max_attempts times
+            print(f"Cell {cell_key(task)} failed: {error!r}")
+            release_cell(path, task, worker, error=repr(error), max_attempts=max_attempts)
+
+        except BaseException:
+            # interrupted: the cell goes back to the queue right away instead of waiting for its lease to expire
+            release_cell(path, task, worker)
+            raise
+
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    print(f"Worker {worker} finished {n_finished} cells, no cells left to claim")
+
+    return n_finished
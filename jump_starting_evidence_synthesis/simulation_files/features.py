@@ -0,0 +1,228 @@
+from pathlib import Path
+import hashlib
+import json
+from itertools import islice
+import pickle
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+from asreview.models.feature_extractors import Tfidf
+
+from augmented import AugmentedDataset, row_texts
+from storage import atomic_write
+
+
+### Feature extractors ###
+
+# tfidf: asreview's Tfidf, which fits a vocabulary and IDF weights over the whole dataset (priors included).
+# hashing: stateless hashed term frequencies, built chunk by chunk from the streamed text without a fit step, so
+# memory stays bounded by the feature matrix itself and every row (e.g. a prior) is vectorized on its own.
+
+FEATURE_EXTRACTORS = ("tfidf", "hashing")
+
+
+class Hashing(TransformerMixin, BaseEstimator):
+    """Hashed (sublinear) term frequencies of word n-grams, l2-normalised, without a vocabulary or IDF to fit."""
+
+    name = "hashing"
+    label = "Hashing"
+
+    def __init__(self, columns=["title", "abstract"], sep=" ", n_features=2 ** 20, ngram_range=(1, 1), sublinear_tf=False, chunk_size=10000):
+        self.columns = columns
+        self.sep = sep
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.sublinear_tf = sublinear_tf
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+
+        texts = X.texts(self.columns, self.sep) if isinstance(X, AugmentedDataset) else row_texts(X, self.columns, self.sep)
+        vectorizer = HashingVectorizer(n_features=self.n_features, ngram_range=self.ngram_range, alternate_sign=False, norm=None)
+
+        chunks = []
+        for chunk in iter(lambda: list(islice(texts, self.chunk_size)), []):
+            X_chunk = vectorizer.transform(chunk)
+            if self.sublinear_tf:
+                np.log(X_chunk.data, out=X_chunk.data)
+                X_chunk.data += 1
+            chunks.append(normalize(X_chunk, copy=False))
+
+        return sp.vstack(chunks, format="csr") if chunks else sp.csr_matrix((0, self.n_features))
+
+
+def make_vectorizer(feature_extractor: str, params: dict):
+
+    if feature_extractor not in FEATURE_EXTRACTORS:
+        raise ValueError(f"Unknown feature extractor '{feature_extractor}', expected one of {FEATURE_EXTRACTORS}.")
+
+    return Hashing(**params) if feature_extractor == "hashing" else Tfidf(**params)
+
+
+### Precomputed feature store ###
+
+# The features (TF-IDF or hashed) of each dataset's base corpus are computed once and stored as the three CSR arrays
+# (data, indices, indptr) in .npy files, keyed by a hash of the dataset, the feature extractor and its parameters,
+# together with the same arrays of the transposed matrix (one row per feature), with which the native engine scores
+# the records through the features seen in training only. Worker processes memory-map the arrays read-only, so they
+# share one copy through the OS page cache. Prior rows (LLM abstracts, criteria) are transformed with the stored
+# vectorizer and kept next to the stored matrix (StackedFeatures): the native engine screens both without copying the
+# store, asreview needs them in one matrix.
+
+# (store path) -> (feature matrix, fitted vectorizer), loaded once per process
+_loaded = {}
+
+
+def feature_key(dataset: pd.DataFrame, params: dict) -> str:
+
+    text = dataset[["title", "abstract"]].fillna("").astype(str)
+    hasher = hashlib.sha256(pd.util.hash_pandas_object(text, index=False).values.tobytes())
+    hasher.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+
+    return hasher.hexdigest()[:16]
+
+
+def save_csr(path: Path, X: sp.csr_matrix, suffix: str = "") -> None:
+    np.save(path / f"data{suffix}.npy", X.data)
+    np.save(path / f"indices{suffix}.npy", X.indices)
+    np.save(path / f"indptr{suffix}.npy", X.indptr)
+
+
+def load_csr(path: Path, shape: tuple, suffix: str = "") -> sp.csr_matrix:
+    arrays = [np.load(path / f"{array}{suffix}.npy", mmap_mode="r") for array in ("data", "indices", "indptr")]
+    return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def build_features(store_dir: Path, name: str, dataset: pd.DataFrame, params: dict, feature_extractor: str = "tfidf") -> Path:
+
+    # TF-IDF stores keep the key they had before other feature extractors existed
+    key_params = params if feature_extractor == "tfidf" else {**params, "feature_extractor": feature_extractor}
+    path = Path(store_dir) / name / feature_key(dataset, key_params)
+    if (path / "vectorizer.pkl").exists():
+        return path
+
+    print(f"Building feature store for dataset: {name}")
+
+    vectorizer = make_vectorizer(feature_extractor, params)
+    X = sp.csr_matrix(vectorizer.fit_transform(dataset))
+
+    # the store is a directory, moved in place as a whole
+    def write(tmp_path: Path) -> None:
+        tmp_path.mkdir()
+        save_csr(tmp_path, X)
+        save_csr(tmp_path, X.T.tocsr(), suffix="_t")
+        with (tmp_path / "shape.json").open("w") as f:
+            json.dump(list(X.shape), f)
+        with (tmp_path / "vectorizer.pkl").open("wb") as f:
+            pickle.dump(vectorizer, f)
+
+    try:
+        atomic_write(path, write)
+    except OSError:
+        # another process finished the same store first
+        if not (path / "vectorizer.pkl").exists():
+            raise
+
+    return path
+
+
+def add_transposed(path: Path, X: sp.csr_matrix) -> None:
+
+    # stores built before the transposed arrays were kept get them on first use, written array by array (indptr last,
+    # which marks them as complete)
+    X_t = X.T.tocsr()
+
+    for array in ("data", "indices", "indptr"):
+        def write(tmp_path: Path) -> None:
+            with tmp_path.open("wb") as f:
+                np.save(f, getattr(X_t, array))
+        atomic_write(path / f"{array}_t.npy", write)
+
+
+def load_features(store_dir: Path, name: str, dataset: pd.DataFrame, params: dict, feature_extractor: str = "tfidf") -> tuple:
+
+    path = build_features(store_dir, name, dataset, params, feature_extractor)
+
+    if path not in _loaded:
+        with (path / "shape.json").open() as f:
+            shape = tuple(json.load(f))
+        with (path / "vectorizer.pkl").open("rb") as f:
+            vectorizer = pickle.load(f)
+
+        X = load_csr(path, shape)
+        if not (path / "indptr_t.npy").exists():
+            add_transposed(path, X)
+
+        _loaded[path] = (StackedFeatures(X, base_t=load_csr(path, shape[::-1], suffix="_t")), vectorizer)
+
+    return _loaded[path]
+
+
+class StackedFeatures:
+    """Rows of a base feature matrix followed by the rows of the priors, kept as two blocks so the base is not copied."""
+
+    def __init__(self, base: sp.csr_matrix, extra: sp.csr_matrix = None, base_t: sp.csr_matrix = None):
+        self.base = base
+        self.extra = sp.csr_matrix(extra) if extra is not None else sp.csr_matrix((0, base.shape[1]), dtype=base.dtype)
+        self.base_t = base_t  # the base transposed, stored or built on first use
+        self.extra_t = None
+
+    @property
+    def shape(self) -> tuple:
+        return self.base.shape[0] + self.extra.shape[0], self.base.shape[1]
+
+    def __getitem__(self, rows) -> sp.csr_matrix:
+
+        # the given rows, in their order, copied from the block they are in
+        rows = np.asarray(rows)
+        in_base = rows < self.base.shape[0]
+        if in_base.all():
+            return self.base[rows]
+
+        # the stacked rows hold the base rows first: put every row back at its place in rows
+        stacked = sp.vstack([self.base[rows[in_base]], self.extra[rows[~in_base] - self.base.shape[0]]], format="csr")
+        return stacked[np.argsort(np.argsort(~in_base, kind="stable"), kind="stable")]
+
+    def dot_features(self, features: np.ndarray, coef: np.ndarray) -> np.ndarray:
+
+        # X[:, features] @ coef over all rows, reading only the given features of the base (and of the few prior rows)
+        if self.base_t is None:
+            self.base_t = self.base.T.tocsr()
+
+        scores = self.base_t[features].T @ coef
+        if self.extra.shape[0] == 0:
+            return scores
+
+        if self.extra_t is None:
+            self.extra_t = self.extra.T.tocsr()
+
+        return np.concatenate([scores, self.extra_t[features].T @ coef])
+
+    def tocsr(self) -> sp.csr_matrix:
+        return self.base if self.extra.shape[0] == 0 else sp.vstack([self.base, self.extra], format="csr")
+
+
+def augment_features(X_base, vectorizer, extra_rows: pd.DataFrame):
+
+    # only the prior rows are vectorized; the base corpus (and its stored transpose) is reused as it is
+    base, base_t = (X_base.base, X_base.base_t) if isinstance(X_base, StackedFeatures) else (X_base, None)
+
+    return StackedFeatures(base, vectorizer.transform(extra_rows) if len(extra_rows) > 0 else None, base_t)
+
+
+def fit_features(dataset: AugmentedDataset, params: dict) -> sp.csr_matrix:
+
+    # TF-IDF of the dataset and its prior rows together, as asreview's Tfidf would compute it on the concatenated
+    # dataset, but fitted on the text streamed from the view instead of a concatenated copy
+    vectorizer = Tfidf(**params)
+
+    return sp.csr_matrix(vectorizer.named_steps["tfidf"].fit_transform(dataset.texts(vectorizer.columns, vectorizer.sep)))
+
@@ -0,0 +1,89 @@
+from pathlib import Path
+import hashlib
+import json
+import pandas as pd
+
+from storage import atomic_write
+
+
+### Typed binary cache of the input datasets ###
+
+# Every dataset csv is parsed once, keeping only the columns the simulation uses, and stored as an uncompressed
+# Feather (Arrow IPC) file in the dataset cache, which later runs read instead of parsing the csv again. This only
+# saves the csv parsing: the file is converted to a DataFrame (the text columns to Python strings) on reading, so
+# every process still holds its own copy of the dataset. Cache entries are named after the csv and a hash of its
+# full path, so csv files with the same name in different folders do not share an entry.
+# A cached file is used while the size and mtime of its csv are unchanged; when they changed, the csv is hashed
+# and the cache is only rebuilt if its content changed too.
+
+DATASET_COLUMNS = ["title", "abstract", "label_included", "doi"]
+
+# text columns stay text, also when a column is empty in a dataset
+DATASET_DTYPES = {"title": "object", "abstract": "object", "doi": "object"}
+
+
+def read_dataset_csv(path: Path) -> pd.DataFrame:
+    return pd.read_csv(path, usecols=lambda column: column in DATASET_COLUMNS, dtype=DATASET_DTYPES)
+
+
+def source_stamp(path: Path) -> list:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def source_hash(path: Path) -> str:
+
+    hasher = hashlib.sha256()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def _write_meta(meta_path: Path, meta: dict) -> None:
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open('w') as f:
+            json.dump(meta, f, indent=1)
+
+    atomic_write(meta_path, write)
+
+
+def cache_name(path: Path) -> str:
+    return f"{path.stem}-{hashlib.sha256(str(path.resolve()).encode('utf-8')).hexdigest()[:16]}"
+
+
+def load_dataset(path: Path, cache_dir: Path = None) -> pd.DataFrame:
+
+    if cache_dir is None:
+        return read_dataset_csv(path)
+
+    cache_path = cache_dir / f'{cache_name(path)}.feather'
+    meta_path = cache_dir / f'{cache_name(path)}.json'
+    stamp = source_stamp(path)
+
+    if cache_path.exists() and meta_path.exists():
+        with meta_path.open() as f:
+            meta = json.load(f)
+
+        if meta['source'] == str(path.resolve()) and meta['columns'] == DATASET_COLUMNS:
+
+            # the csv was touched (e.g. copied again) but its content is the same: keep the cache
+            if meta['stamp'] != stamp and meta['sha256'] == source_hash(path):
+                meta['stamp'] = stamp
+                _write_meta(meta_path, meta)
+
+            if meta['stamp'] == stamp:
+                import pyarrow.feather as feather
+                return feather.read_feather(cache_path)
+
+    # (re)build the cache
+    print(f"Caching dataset {path.stem} in {cache_dir}")
+    dataset = read_dataset_csv(path)
+
+    atomic_write(cache_path, lambda tmp_path: dataset.to_feather(tmp_path, compression='uncompressed'))
+
+    _write_meta(meta_path, {'source': str(path.resolve()), 'stamp': stamp, 'sha256': source_hash(path), 'columns': DATASET_COLUMNS})
+
+    return dataset
@@ -0,0 +1,145 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import psutil
+
+try:
+    import resource
+except ImportError:  # not available on Windows, where psutil reports the peak working set instead
+    resource = None
+
+
+### Per-stage timing and memory trace ###
+
+# While a trace is open (one per simulation run of a dataset, opened by executor.run_cell), every stage wrapped in
+# stage() appends one JSON line to <out_dir>/<dataset>/traces/run_<run>_IVs_<ivs>.jsonl with its wall-clock and CPU
+# time, the resident memory of the process after the stage and its peak so far, and record() appends single events
+# such as LLM requests. Outside a trace both do nothing, so the instrumented functions also run on their own.
+
+# open trace file, fields written on every line (dataset, run, IVs) and the stages entered, per process
+_trace = {'file': None, 'fields': {}, 'stages': []}
+
+# LLM requests are recorded from several generation threads
+_lock = threading.Lock()
+
+_process = psutil.Process()
+
+
+def memory_mb() -> tuple:
+
+    # (resident memory, peak resident memory) of this process in MB
+    info = _process.memory_info()
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2 ** 20 if psutil.MACOS else peak / 2 ** 10  # bytes on macOS, kilobytes on Linux
+    else:
+        peak = getattr(info, 'peak_wset', info.rss) / 2 ** 20
+
+    # the kernel only updates the recorded peak now and then, so it can lag behind the current memory
+    return info.rss / 2 ** 20, max(peak, info.rss / 2 ** 20)
+
+
+def trace_file(out_dir: Path, name: str, run: int, n_abstracts: int, length_abstracts: int, llm_temperature: float) -> Path:
+    return out_dir / name / 'traces' / f'run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.jsonl'
+
+
+@contextmanager
+def tracing(path: Path, **fields):
+
+    # a redone run replaces its trace; the whole run is recorded as the 'run' stage
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with path.open('w') as f:
+        _trace.update(file=f, fields={**fields, 'pid': os.getpid()}, stages=[])
+        try:
+            with stage('run'):
+                yield
+        finally:
+            _trace.update(file=None, fields={}, stages=[])
+
+
+def record(name: str, **values) -> None:
+
+    if _trace['file'] is None:
+        return
+
+    line = json.dumps({**_trace['fields'], 'stage': name, 'parent': _trace['stages'][-1] if _trace['stages'] else None, **values}, default=str)
+
+    with _lock:
+        _trace['file'].write(line + '\n')
+
+
+@contextmanager
+def stage(name: str, **fields):
+
+    if _trace['file'] is None:
+        yield
+        return
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    _, peak_start = memory_mb()
+    _trace['stages'].append(name)
+
+    try:
+        yield
+    finally:
+        _trace['stages'].pop()
+        rss, peak = memory_mb()
+        record(name, seconds=time.perf_counter() - start, cpu_seconds=time.process_time() - cpu_start,
+               rss_mb=rss, peak_rss_mb=peak, peak_growth_mb=peak - peak_start, **fields)
+
+
+
+### Summary of the traces of an output folder ###
+
+def read_traces(out_dir: Path) -> pd.DataFrame:
+
+    lines = []
+    for path in sorted(out_dir.glob('*/traces/*.jsonl')):
+        with path.open() as f:
+            lines.extend(json.loads(line) for line in f if line.strip())
+
+    return pd.DataFrame(lines)
+
+
+def summarise_traces(out_dir: Path) -> tuple:
+
+    # (time and memory per dataset, stage and condition; LLM requests per dataset; runs that replayed the abstracts of
+    # another run) over all traced runs
+    traces = read_traces(out_dir)
+    if traces.empty:
+        return None, None, None
+
+    traces['condition'] = traces.get('condition', pd.Series(index=traces.index, dtype=object)).fillna('')
+    stages = traces[~traces['stage'].isin(['llm_request', 'llm_replay_fallback'])]
+
+    df_stages = (stages.groupby(['dataset', 'stage', 'condition'], sort=False)
+                 .agg(n=('seconds', 'size'), seconds=('seconds', 'sum'), mean_seconds=('seconds', 'mean'), cpu_seconds=('cpu_seconds', 'sum'),
+                      max_peak_rss_mb=('peak_rss_mb', 'max'), max_peak_growth_mb=('peak_growth_mb', 'max'))
+                 .reset_index())
+
+    # share of the time of all traced runs of the dataset (nested stages are also part of their parent's share)
+    run_seconds = df_stages[df_stages['stage'] == 'run'].set_index('dataset')['seconds']
+    df_stages['share'] = df_stages['seconds'] / df_stages['dataset'].map(run_seconds)
+
+    requests = traces[traces['stage'] == 'llm_request']
+    df_requests = None
+
+    if not requests.empty:
+        df_requests = (requests.groupby('dataset')
+                       .agg(requests=('seconds', 'size'), cached=('cached', 'sum'), seconds=('seconds', 'sum'), mean_latency=('seconds', 'mean'),
+                            p95_latency=('seconds', lambda seconds: seconds.quantile(0.95)),
+                            prompt_tokens=('prompt_tokens', 'sum'), completion_tokens=('completion_tokens', 'sum'))
+                       .astype({'cached': int, 'prompt_tokens': int, 'completion_tokens': int})
+                       .reset_index())
+
+    fallbacks = traces[traces['stage'] == 'llm_replay_fallback']
+    df_fallbacks = fallbacks[['dataset', 'run', 'n_abstracts', 'length_abstracts', 'llm_temperature', 'source_run']].astype({'source_run': int}).reset_index(drop=True) if not fallbacks.empty else None
+
+    return df_stages, df_requests, df_fallbacks
@@ -1,14 +1,15 @@
 import pandas as pd
-import numpy as np
 from pathlib import Path
 
 from stimulus import select_criteria
+from augmented import AugmentedDataset
+from instrument import stage
 from prompting import generate_abstracts
 
 
 ### Prepare the llm datasets ###
 
-def prepare_datasets(dataset: pd.DataFrame, name: str, criterium: list, out_dir: Path, metadata: pd.ExcelFile, n_abstracts: int, length_abstracts: int, llm_temperature: float, run: int) -> dict:
+def prepare_datasets(dataset: pd.DataFrame, name: str, criterium: list, out_dir: Path, metadata: pd.ExcelFile, n_abstracts: int, length_abstracts: int, llm_temperature: float, run: int, replicate: int, llm_options: dict = None) -> dict:
 
     ### RETRIEVE CRITERIA FROM METADATA ##########################################################
 
@@ -21,7 +22,8 @@ def prepare_datasets(dataset: pd.DataFrame, name: str, criterium: list, out_dir:
 
     ### GENERATE ABSTRACTS #################################################################
 
-    generated_abstracts = generate_abstracts(name=name, stimulus=stimuli, out_dir=out_dir, n_abstracts=n_abstracts, length_abstracts=length_abstracts, llm_temperature=llm_temperature, run=run)
+    with stage('generate_abstracts', condition='llm'):
+        generated_abstracts = generate_abstracts(name=name, stimulus=stimuli, out_dir=out_dir, n_abstracts=n_abstracts, length_abstracts=length_abstracts, llm_temperature=llm_temperature, run=run, replicate=replicate, **(llm_options or {}))
      
     # # Ensure exactly n_abstracts included and n_abstracts excluded (1:1 ratio)
     # # If not, regenerate up to max_retries times
@@ -45,9 +47,9 @@ def prepare_datasets(dataset: pd.DataFrame, name: str, criterium: list, out_dir:
  
     ### APPEND GENERATED ABSTRACTS TO DATASET ##########################################################
              
-    # concatenate original dataset with generated abstracts for simulation
-    dataset_llm = pd.concat([dataset, generated_abstracts.drop(columns=['reasoning'])], ignore_index=True) # concatenate original dataset with generated abstracts
-    llm_prior_idx = np.array(range(len(dataset), len(dataset_llm))) # get indices of generated abstracts to use as priors
+    # append generated abstracts to the original dataset for simulation, as an overlay (the dataset itself is not copied)
+    dataset_llm = AugmentedDataset(dataset, generated_abstracts.drop(columns=['reasoning']))
+    llm_prior_idx = dataset_llm.prior_idx # get indices of generated abstracts to use as priors
     
     #store dataset with llm priors and prior indices in dictionary
     datasets_llms = {
@@ -67,9 +69,9 @@ def prepare_datasets(dataset: pd.DataFrame, name: str, criterium: list, out_dir:
     criteria_data = pd.DataFrame([included_row])
 
         
-    # concatenate original dataset with criteria for simulation
-    dataset_criteria = pd.concat([dataset, criteria_data], ignore_index=True) # concatenate original dataset with criteria
-    criteria_idx = np.array(range(len(dataset), len(dataset_criteria))) # get indices of criteria to use as priors
+    # append criteria to the original dataset for simulation, as an overlay
+    dataset_criteria = AugmentedDataset(dataset, criteria_data)
+    criteria_idx = dataset_criteria.prior_idx # get indices of criteria to use as priors
     
     #store dataset with criteria and prior indices in dictionary
     datasets_criteria = {
@@ -0,0 +1,114 @@
+from pathlib import Path
+import json
+import pandas as pd
+
+from storage import raw_simulation_paths, read_results, replace_results, atomic_write
+
+
+### Completion manifest of a sweep ###
+
+# One entry per finished (dataset, run, IV combination) cell, with the raw simulation file of each condition.
+# The manifest is rewritten atomically once per batch of metrics rows written to the master results (every cell with
+# the default output_batch_size of 1), so a resumed sweep can skip finished cells and redo the ones whose outputs are
+# missing or were cut short.
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def cell_key(task: dict) -> str:
+    return f"{task['dataset']}/run_{task['run']}/IVs_{task['n_abstracts']}_{task['length_abstracts']}_{task['llm_temperature']}"
+
+
+def cell_outputs(out_dir: Path, task: dict, output_format: str = "csv") -> dict:
+
+    # recall plots are rendered after the sweep (see metrics.render_recall_plots), so they are not part of a cell
+    return raw_simulation_paths(out_dir, task['dataset'], task['run'], task['baseline_run'], task['n_abstracts'], task['length_abstracts'], task['llm_temperature'], output_format)
+
+
+def load_manifest(out_dir: Path) -> dict:
+
+    path = out_dir / MANIFEST_NAME
+    if not path.exists():
+        return {}
+
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir: Path, manifest: dict) -> None:
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open('w') as f:
+            json.dump(manifest, f, indent=1)
+
+    atomic_write(out_dir / MANIFEST_NAME, write)
+
+
+def record_cell(out_dir: Path, manifest: dict, task: dict, output_format: str = "csv") -> None:
+
+    # the size of every output is stored, so that a file cut short later on is noticed on resume
+    manifest[cell_key(task)] = {
+        'dataset': task['dataset'],
+        'run': task['run'],
+        'replicate': task['replicate'],
+        'baseline_run': task['baseline_run'],
+        'n_abstracts': task['n_abstracts'],
+        'length_abstracts': task['length_abstracts'],
+        'llm_temperature': task['llm_temperature'],
+        'outputs': {output: {'path': path.relative_to(out_dir).as_posix(), 'bytes': path.stat().st_size} for output, path in cell_outputs(out_dir, task, output_format).items()},
+        'finished': pd.Timestamp.now().isoformat(),
+    }
+
+
+def record_cells(out_dir: Path, manifest: dict, tasks: list, output_format: str = "csv") -> None:
+
+    # the cells whose metrics rows were just written, saved with one rewrite of the manifest
+    if not tasks:
+        return
+
+    for task in tasks:
+        record_cell(out_dir, manifest, task, output_format=output_format)
+
+    save_manifest(out_dir, manifest)
+
+
+def is_complete(out_dir: Path, manifest: dict, task: dict) -> bool:
+
+    entry = manifest.get(cell_key(task))
+    if entry is None:
+        return False
+
+    for output in entry['outputs'].values():
+        path = out_dir / output['path']
+        if not path.exists() or path.stat().st_size != output['bytes']:
+            return False
+
+    return True
+
+
+def damaged_outputs(out_dir: Path, manifest: dict, task: dict) -> list:
+
+    # outputs that still exist but no longer match the recorded size, e.g. a shared baseline cut short
+    entry = manifest.get(cell_key(task))
+    if entry is None:
+        return []
+
+    paths = [out_dir / output['path'] for output in entry['outputs'].values()]
+    return [path for path, output in zip(paths, entry['outputs'].values()) if path.exists() and path.stat().st_size != output['bytes']]
+
+
+def prune_results(out_dir: Path, done_tasks: list, output_format: str = "csv") -> None:
+
+    # keep one set of metrics rows per finished cell: drop the rows of cells that are redone and any duplicates
+    df_results = read_results(out_dir, output_format)
+    if df_results is None:
+        return
+
+    done = {(task['dataset'], task['run']) for task in done_tasks}
+
+    keep = pd.Series([(name, run) in done for name, run in zip(df_results['dataset'], df_results['run'])], index=df_results.index)
+    df_pruned = df_results[keep].sort_values('timestamp', kind='stable').drop_duplicates(subset=['dataset', 'run', 'condition', 'metric'], keep='last')
+
+    if len(df_pruned) < len(df_results):
+        print(f"Removed {len(df_results) - len(df_pruned)} rows of unfinished or repeated cells from the master results")
+        replace_results(df_pruned, out_dir, output_format)
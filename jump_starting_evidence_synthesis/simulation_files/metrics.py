@@ -1,19 +1,18 @@
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
-import matplotlib
-matplotlib.use("Agg")   # headless, no Tk
-import matplotlib.pyplot as plt
+from instrument import stage
+from storage import atomic_write, append_results, raw_simulation_files, read_table, read_results, simulated_datasets, ranking_files, read_ranking, BASELINE_CONDITIONS
 
 
-from asreview.metrics import loss
-from asreview.metrics import ndcg
-from asreviewcontrib.insights import algorithms
-from asreviewcontrib.insights import metrics
+# conditions in the order of the rows of the evaluation kernel
+EVALUATION_CONDITIONS = ['random', 'llm', 'criteria', 'no_initialisation']
 
 
-def evaluate_simulation(simulation_results: dict, dataset: pd.DataFrame, dataset_llms: pd.DataFrame, dataset_criteria: pd.DataFrame, prior_idx: list, n_abstracts: int, length_abstracts: int, llm_temperature: float, papers_screened: int, out_dir: Path, run: int, stop_at_n: int) -> None:
+def evaluate_simulation(simulation_results: dict, dataset: pd.DataFrame, dataset_llms: pd.DataFrame, dataset_criteria: pd.DataFrame, prior_idx: list, n_abstracts: int, length_abstracts: int, llm_temperature: float, papers_screened: int, out_dir: Path, run: int, stop_at_n: int, write_results: bool = True, baseline_run: int = None, query_batch_size: int = 1, output_format: str = "csv", wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100)) -> pd.DataFrame:
 
     ### PREPARE DATA FOR EVALUATION ############################################################################################################
 
@@ -25,55 +24,18 @@ def evaluate_simulation(simulation_results: dict, dataset: pd.DataFrame, dataset
     # padded_labels_criteria = pad_labels(simulation_results['criteria']["label"].reset_index(drop=True), 0, len(dataset_criteria['dataset']), stop_at_n) # idem for criteria condition
     # padded_labels_no_initialisation = pad_labels(simulation_results['no_initialisation']["label"].reset_index(drop=True), 0, len(dataset), stop_at_n)
 
-    # concatenate the three cumulative sum results in one dataframe for adding metadata and plottingq
-    df_cumsum = pd.DataFrame({
-        'Random Initialization': simulation_results['random']["label"].reset_index(drop=True).iloc[:100].cumsum(),
-        'LLM Initialization': simulation_results['llm']["label"].reset_index(drop=True).iloc[:100].cumsum(),
-        'Criteria Initialization': simulation_results['criteria']["label"].reset_index(drop=True).iloc[:100].cumsum(),
-        'No Initialization': simulation_results['no_initialisation']["label"].reset_index(drop=True).iloc[:100].cumsum()
-    })
-    
-    # Calculate the actual number of runs (retrievals) performed
-    n_trials = len(simulation_results['random']["label"].reset_index(drop=True).iloc[:100])
-    
-    ############################################################################################################################################
-    
-    
-    
-    
+    # labels of the screened records of the four conditions, one row per condition, zero-padded to the longest simulation
+    labels, lengths = label_matrix([simulation_results[condition]["label"].to_numpy() for condition in EVALUATION_CONDITIONS])
 
-    ### GENERATE PLOTS #########################################################################################################################
-    
-    recall_plot(
-        df_cumsum=df_cumsum,
-        dataset_names=dataset_names,
-        n_abstracts=n_abstracts,
-        length_abstracts=length_abstracts,
-        llm_temperature=llm_temperature,
-        out_dir=out_dir,
-        run=run,
-        stop_at_n=stop_at_n
-    )
-    
-    ############################################################################################################################################
- 
- 
- 
- 
- 
-    #### CALCULATE OUTCOME METRICS ############################################################################################################
-
-    # Calculate the number of relevant records found at TDD threshold (capped at 100 rows)
-    td_random = tdd_at({'record_id': simulation_results['random']['record_id'].iloc[:100], 'label': simulation_results['random']['label'].iloc[:100]}, papers_screened)[1]
-    td_llm = tdd_at({'record_id': simulation_results['llm']['record_id'].iloc[:100], 'label': simulation_results['llm']['label'].iloc[:100]}, papers_screened)[1]
-    td_criteria = tdd_at({'record_id': simulation_results['criteria']['record_id'].iloc[:100], 'label': simulation_results['criteria']['label'].iloc[:100]}, papers_screened)[1]
-    td_no_initialisation = tdd_at({'record_id': simulation_results['no_initialisation']['record_id'].iloc[:100], 'label': simulation_results['no_initialisation']['label'].iloc[:100]}, papers_screened)[1]
-
-    # Calculate the number of records that need to be screened to find the first relevant record (ATD)
-    atd_random = metrics._average_time_to_discovery(tdd_at({'record_id': simulation_results['random']['record_id'].iloc[:100], 'label': simulation_results['random']['label'].iloc[:100]}, papers_screened)[0])
-    atd_llm = metrics._average_time_to_discovery(tdd_at({'record_id': simulation_results['llm']['record_id'].iloc[:100], 'label': simulation_results['llm']['label'].iloc[:100]}, papers_screened)[0])
-    atd_criteria = metrics._average_time_to_discovery(tdd_at({'record_id': simulation_results['criteria']['record_id'].iloc[:100], 'label': simulation_results['criteria']['label'].iloc[:100]}, papers_screened)[0])
-    atd_no_initialisation = metrics._average_time_to_discovery(tdd_at({'record_id': simulation_results['no_initialisation']['record_id'].iloc[:100], 'label': simulation_results['no_initialisation']['label'].iloc[:100]}, papers_screened)[0])
+    # records and relevant records each condition could screen
+    n_records, n_relevant = screening_pools(dataset, dataset_llms, dataset_criteria, prior_idx)
+
+    # all outcome metrics of the four conditions at once, over the first stop_at_n screened records (all of them when stop_at_n is -1)
+    with stage('evaluation_kernel'):
+        evaluation = evaluation_kernel(labels, lengths, n_relevant, n_records, stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs)
+
+    # Calculate the actual number of runs (retrievals) performed
+    n_trials = int(evaluation['lengths'][0])
 
     ############################################################################################################################################
 
@@ -85,16 +47,13 @@ def evaluate_simulation(simulation_results: dict, dataset: pd.DataFrame, dataset
 
     results_row = []
 
-    for condition, metrics_dict in [
-        ('random', {'papers_found': td_random, 
-                    'atd': atd_random}),
-        ('llm', {'papers_found': td_llm,
-                'atd': atd_llm}),
-        ('criteria', {'papers_found': td_criteria,
-                      'atd': atd_criteria}),
-        ('no_initialisation', {'papers_found': td_no_initialisation,
-                    'atd': atd_no_initialisation})
-    ]:
+    # papers_found: relevant records found (TDD@papers_screened), atd: average time to discovery, time_to_first_relevant,
+    # wss@threshold: work saved over sampling at that recall level, recall@n: recall after screening n records
+    for i, condition in enumerate(EVALUATION_CONDITIONS):
+
+        metrics_dict = {'papers_found': evaluation['papers_found'][i], 'atd': evaluation['atd'][i], 'time_to_first_relevant': evaluation['time_to_first_relevant'][i], f'wss@{wss_threshold:g}': evaluation['wss'][i]}
+        metrics_dict.update({f'recall@{cutoff}': recall[i] for cutoff, recall in evaluation['recall'].items()})
+
         for metric_name, metric_value in metrics_dict.items():
             
             # Determine if parameters apply to this condition
@@ -111,16 +70,21 @@ def evaluate_simulation(simulation_results: dict, dataset: pd.DataFrame, dataset
                 'tdd@': papers_screened,
                 'timestamp': pd.Timestamp.now().isoformat(),
                 'run': run,  # replicate ID
+                'baseline_run': run if is_llm or baseline_run is None else baseline_run,  # run whose simulation produced this row (shared across IV combinations for baselines)
                 'n_trials': n_trials,  # number of attempted retrievals
+                'query_batch_size': query_batch_size,  # records screened between two retrainings of the classifier
             })
             
-    # Append to master results file
+    # Append to master results file (skipped when the caller collects the rows and writes them itself)
     df_results = pd.DataFrame(results_row)
-    master_file = out_dir / 'all_simulation_results.csv'
-    df_results.to_csv(master_file, mode='a', header=not master_file.exists(), index=False)
+    if write_results:
+        with stage('write_results'):
+            append_results(df_results, out_dir, output_format)
     
     ############################################################################################################################################
 
+    return df_results
+
 
 
 
@@ -151,138 +115,464 @@ def pad_labels(labels, num_priors, num_records, stop_at_n):
 
 
     
-def tdd_at(results, threshold):
-    all_tdd = metrics._time_to_discovery(results['record_id'], results['label'])
-    count = sum(iter_idx <= threshold for _, iter_idx in all_tdd)
-    return all_tdd, count
+def label_matrix(sequences: list) -> tuple:
 
+    # stack label sequences of different lengths in one zero-padded 2-D array, with the length of each sequence
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    labels = np.zeros((len(sequences), lengths.max(initial=0)), dtype=np.int32)
+    for i, sequence in enumerate(sequences):
+        labels[i, :len(sequence)] = sequence
 
+    return labels, lengths
 
-def recall_plot(df_cumsum: pd.DataFrame, dataset_names: str, n_abstracts: int, length_abstracts: int, llm_temperature: float, out_dir: Path, run: int, stop_at_n: int):
-    
-    plt.figure(figsize=(10, 6))
 
-    # Use 1-based x-axis: screening 1 through stop_at_n
-    x_axis = range(1, len(df_cumsum['Random Initialization']) + 1)
-    plt.plot(x_axis, df_cumsum['Random Initialization'], label='Random Initialization', color='blue')
-    plt.plot(x_axis, df_cumsum['LLM Initialization'], label='LLM Initialization', color='green')
-    plt.plot(x_axis, df_cumsum['Criteria Initialization'], label='Criteria Initialization', color='orange')
-    plt.plot(x_axis, df_cumsum['No Initialization'], label='No Initialization', color='red')
+
+def screening_pools(dataset: pd.DataFrame, dataset_llms: dict, dataset_criteria: dict, prior_idx: int) -> tuple:
+
+    # number of records and relevant records each condition could screen, in the order of EVALUATION_CONDITIONS
+    # (the priors taken from the dataset itself are not screened)
+    pools = {
+        'random': (dataset["label_included"], [prior_idx]),
+        'llm': (dataset_llms['dataset'].labels, dataset_llms['prior_idx']),
+        'criteria': (dataset_criteria['dataset'].labels, dataset_criteria['prior_idx']),
+        'no_initialisation': (dataset["label_included"], []),
+    }
+    n_records = np.array([len(pool_labels) - len(pool_priors) for pool_labels, pool_priors in pools.values()])
+    n_relevant = np.array([np.sum(pool_labels) - np.asarray(pool_labels)[np.asarray(pool_priors, dtype=int)].sum() for pool_labels, pool_priors in pools.values()])
+
+    return n_records, n_relevant
+
+
+
+def evaluation_kernel(labels: np.ndarray, lengths: np.ndarray, n_relevant: np.ndarray, n_records: np.ndarray, stop_at_n: int, wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100)) -> dict:
+
+    # one row per simulation; the metrics only count the first stop_at_n screened records (all of them when stop_at_n is -1)
+    horizon = labels.shape[1] if stop_at_n == -1 else min(stop_at_n, labels.shape[1])
+    labels = labels[:, :horizon]
+    lengths = np.minimum(lengths, horizon)
+    positions = np.arange(1, horizon + 1)
+
+    # found[:, k] is the number of relevant records found in the first k screened records
+    found = np.zeros((len(labels), horizon + 1), dtype=np.int64)
+    np.cumsum(labels, axis=1, out=found[:, 1:])
+    papers_found = found[:, -1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # average (1-based) position of the relevant records found, and position of the first one (NaN if none was found)
+        atd = np.where(papers_found > 0, (labels * positions).sum(axis=1) / papers_found, np.nan)
+        time_to_first = np.where(papers_found > 0, labels.argmax(axis=1) + 1, np.nan)
+
+        # work saved over sampling: share of the records left unscreened once wss_threshold of the relevant records are
+        # found, minus the share random screening leaves at that recall (NaN when the threshold was not reached)
+        target = np.maximum(np.ceil(wss_threshold * n_relevant - 1e-9), 1)
+        reached = found[:, 1:] >= target[:, None]
+        n_screened = reached.argmax(axis=1) + 1
+        wss = np.where(reached.any(axis=1), (n_records - n_screened) / n_records - (1 - wss_threshold), np.nan)
+
+        # recall after screening each cutoff (simulations that ended earlier keep their final recall), NaN beyond stop_at_n
+        recall = {cutoff: found[:, min(cutoff, horizon)] / n_relevant if stop_at_n == -1 or cutoff <= stop_at_n else np.full(len(labels), np.nan) for cutoff in recall_cutoffs}
+
+    return {
+        'papers_found': papers_found,
+        'atd': atd,
+        'time_to_first_relevant': time_to_first,
+        'wss': wss,
+        'recall': recall,
+        'lengths': lengths,
+    }
+
+
+
+### RENDER THE RECALL PLOT OF EVERY RUN ##############################################################################################################################################
+
+# Plots are rendered after the sweep from the raw simulations of the finished cells in the manifest, instead of in every
+# cell. plot_policy "all" renders every cell, "sample" the cells of the first plot_sample_size replicates (all their IV
+# combinations) of each dataset, "none" none.
+
+PLOT_POLICIES = ("none", "sample", "all")
+
+# legend label and line colour of each condition in the per-run recall plots
+RECALL_PLOT_STYLES = {
+    'random': ('Random Initialization', 'blue'),
+    'llm': ('LLM Initialization', 'green'),
+    'criteria': ('Criteria Initialization', 'orange'),
+    'no_initialisation': ('No Initialization', 'red'),
+}
+
+
+def pyplot():
+
+    # matplotlib is only imported once a plot is drawn, so evaluating and summarising results starts quickly
+    import matplotlib
+    matplotlib.use("Agg")   # headless, no Tk
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def render_recall_plots(out_dir: Path, cells: list, stop_at_n: int, policy: str = "all", sample_size: int = 10, n_workers: int = 1) -> None:
+
+    if policy not in PLOT_POLICIES:
+        raise ValueError(f"Unknown plot policy '{policy}', expected one of {PLOT_POLICIES}.")
+
+    if policy == "none":
+        return
+
+    # the run of a cell also counts the IV combinations of the replicates before it (see executor.build_tasks), so cells
+    # are sampled by their replicate; manifests written before it was recorded give it with the number of IV combinations
+    if policy == "sample":
+        n_combos = len({(cell['n_abstracts'], cell['length_abstracts'], cell['llm_temperature']) for cell in cells})
+        cells = [cell for cell in cells if cell.get('replicate', (cell['run'] - 1) // max(n_combos, 1)) < sample_size]
+
+    # plots of an earlier (interrupted) call are kept
+    cells = [cell for cell in cells if not recall_plot_path(out_dir, cell['dataset'], cell['run'], cell['n_abstracts'], cell['length_abstracts'], cell['llm_temperature']).exists()]
+    if not cells:
+        return
+
+    print(f"Rendering {len(cells)} recall plots")
+
+    if n_workers <= 1:
+        render_cells(out_dir, cells, stop_at_n)
+        return
+
+    # every worker process renders its share of the cells on its own figure
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        for future in [pool.submit(render_cells, out_dir, cells[i::n_workers], stop_at_n) for i in range(min(n_workers, len(cells)))]:
+            future.result()
+
+
+def render_cells(out_dir: Path, cells: list, stop_at_n: int) -> None:
+
+    # one figure for all cells, only the data of the lines changes from one plot to the next
+    figure = recall_figure(stop_at_n)
+
+    for cell in cells:
+        curves = cell_recall_curves(out_dir, cell, stop_at_n)
+        recall_plot(figure, curves, recall_plot_path(out_dir, cell['dataset'], cell['run'], cell['n_abstracts'], cell['length_abstracts'], cell['llm_temperature']))
+
+    pyplot().close(figure[0])
+
+
+def cell_recall_curves(out_dir: Path, cell: dict, stop_at_n: int) -> dict:
+
+    # cumulative number of relevant records found by each condition over its screened records (priors dropped),
+    # up to stop_at_n and NaN after the last record a condition screened
+    sequences = []
+    for condition in RECALL_PLOT_STYLES:
+        df = read_table(out_dir / cell['outputs'][condition]['path'], columns=["label", "training_set"])
+        sequences.append(df["label"].to_numpy()[df["training_set"].notna().to_numpy()])
+
+    labels, lengths = label_matrix([sequence if stop_at_n == -1 else sequence[:stop_at_n] for sequence in sequences])
+    positions = np.arange(1, labels.shape[1] + 1)
+    curves = np.where(positions <= lengths[:, None], np.cumsum(labels, axis=1), np.nan)
+
+    return dict(zip(RECALL_PLOT_STYLES, curves))
+
+
+def recall_figure(stop_at_n: int) -> tuple:
+
+    figure, ax = pyplot().subplots(figsize=(10, 6))
+
+    lines = {condition: ax.plot([], [], label=label, color=colour)[0] for condition, (label, colour) in RECALL_PLOT_STYLES.items()}
 
     # Add dashed line at stop_at_n
     if stop_at_n != -1:
-        plt.axvline(x=stop_at_n, color='black', linestyle='--', label='stopped screening')
+        ax.axvline(x=stop_at_n, color='black', linestyle='--', label='stopped screening')
+
+    ax.set_xlabel('Number of Records Screened')
+    ax.set_ylabel('Number of Relevant Records Found')
+    ax.set_title('Number of Relevant Records Found vs. Number of Records Screened')
+    ax.legend()
+    ax.grid(True)
+
+    return figure, ax, lines
+
+
+def recall_plot(figure: tuple, curves: dict, plot_path: Path) -> None:
+
+    fig, ax, lines = figure
+
+    # Use 1-based x-axis: screening 1 through stop_at_n
+    for condition, curve in curves.items():
+        lines[condition].set_data(np.arange(1, len(curve) + 1), curve)
+
+    ax.relim()
+    ax.autoscale_view()
+    fig.tight_layout()
 
-    plt.xlabel('Number of Records Screened')
-    plt.ylabel('Number of Relevant Records Found')
-    plt.title('Number of Relevant Records Found vs. Number of Records Screened')
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
-    
-    #create subfolder for recalls plots
-    recalls_folder = out_dir / dataset_names / 'recalls_plots'
-    recalls_folder.mkdir(parents=True, exist_ok=True)
-    
     # save plot to output_path
-    plot_path = recalls_folder / f'recall_plot_run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.png'
-    plt.savefig(plot_path)
-    plt.close()
+    atomic_write(plot_path, lambda tmp_path: fig.savefig(tmp_path, format='png'))
+
+
+
+def recall_plot_path(out_dir: Path, dataset_names: str, run: int, n_abstracts: int, length_abstracts: int, llm_temperature: float) -> Path:
+    return out_dir / dataset_names / 'recalls_plots' / f'recall_plot_run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.png'
+
+
+
+
+### RECOMPUTE OUTCOME METRICS FROM STORED RANKINGS ##############################################################################################################################################
+
+def evaluate_rankings(out_dir: Path, stop_at_n: int, wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100), chunk_size: int = 512) -> tuple:
+
+    # one row per stored simulation and metric; baselines shared by the IV combinations of a replicate appear once,
+    # under their shared baseline run. Also returns the number of rankings skipped because their run stopped earlier.
+    results_row = []
+    n_skipped = 0
+
+    for name in simulated_datasets(out_dir):
+
+        rankings = []
+        for condition, run, ivs, file in ranking_files(out_dir, name):
+            ranking = read_ranking(file)
+
+            # a run that stopped earlier than the requested stop_at_n cannot be evaluated at it
+            if ranking['stop_at_n'] != -1 and (stop_at_n == -1 or stop_at_n > ranking['stop_at_n']):
+                n_skipped += 1
+                continue
+
+            rankings.append((condition, run, ivs, ranking))
+
+        # the kernel evaluates a chunk of simulations at once, so memory stays bounded for long rankings
+        for start in range(0, len(rankings), chunk_size):
+            chunk = rankings[start:start + chunk_size]
+
+            labels, lengths = label_matrix([ranking['label'] if stop_at_n == -1 else ranking['label'][:stop_at_n] for _, _, _, ranking in chunk])
+            n_records = np.array([ranking['n_records'] for _, _, _, ranking in chunk])
+            n_relevant = np.array([ranking['n_relevant'] for _, _, _, ranking in chunk])
+
+            evaluation = evaluation_kernel(labels, lengths, n_relevant, n_records, stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs)
+
+            for i, (condition, run, ivs, ranking) in enumerate(chunk):
+
+                metrics_dict = {'papers_found': evaluation['papers_found'][i], 'atd': evaluation['atd'][i], 'time_to_first_relevant': evaluation['time_to_first_relevant'][i], f'wss@{wss_threshold:g}': evaluation['wss'][i]}
+                metrics_dict.update({f'recall@{cutoff}': recall[i] for cutoff, recall in evaluation['recall'].items()})
+
+                # IVs only apply to the llm condition, as in the master results
+                n_abstracts, length_abstracts, llm_temperature = ivs.split('_') if condition == 'llm' else (np.nan, np.nan, np.nan)
+
+                for metric_name, metric_value in metrics_dict.items():
+                    results_row.append({
+                        'dataset': name,
+                        'condition': condition,
+                        'metric': metric_name,
+                        'value': metric_value,
+                        'n_abstracts': float(n_abstracts),
+                        'length_abstracts': float(length_abstracts),
+                        'llm_temperature': float(llm_temperature),
+                        'tdd@': stop_at_n if stop_at_n != -1 else None,
+                        'run': run,
+                        'n_trials': int(evaluation['lengths'][i]),
+                        'query_batch_size': int(ranking['query_batch_size']),
+                    })
+
+    return pd.DataFrame(results_row), n_skipped
 
 
 
 
 ### CREATE AGGREGATED RECALL PLOTS FUNCTION ##############################################################################################################################################
 
-def aggregate_recall_plots(datasets: dict, out_dir: Path, stop_at_n: int) -> None:
-  
+# legend label, line colour and band colour of each condition in the aggregated plots
+CONDITION_STYLES = {
+    'random': ('True Example Condition', 'blue', 'royalblue'),
+    'llm': ('LLM Condition', 'green', 'forestgreen'),
+    'criteria': ('Inclusion Criteria Condition', 'orange', 'goldenrod'),
+    'no_initialisation': ('Cold Start Condition', 'red', 'lightsalmon'),
+}
+
+
+def recall_curve(df: pd.DataFrame, stop_at_n: int) -> np.ndarray:
+
+    # cumulative number of relevant records found, over the screened records only (priors have no querier)
+    screened = df["training_set"].notna().to_numpy() & df["querier"].notna().to_numpy()
+    curve = np.cumsum(df["label"].to_numpy()[screened], dtype=np.float64)
+
+    return curve[:stop_at_n] if stop_at_n != -1 else curve
+
+
+def update_running_stats(stats: dict, curve: np.ndarray) -> None:
+
+    # Welford update of the mean and sum of squared deviations at every screening position the run reached
+    if len(curve) > len(stats['n']):
+        extra = len(curve) - len(stats['n'])
+        stats['n'] = np.concatenate([stats['n'], np.zeros(extra, dtype=np.int64)])
+        stats['mean'] = np.concatenate([stats['mean'], np.zeros(extra)])
+        stats['m2'] = np.concatenate([stats['m2'], np.zeros(extra)])
+
+    reached = slice(0, len(curve))
+    stats['n'][reached] += 1
+    delta = curve - stats['mean'][reached]
+    stats['mean'][reached] += delta / stats['n'][reached]
+    stats['m2'][reached] += delta * (curve - stats['mean'][reached])
+
+
+def new_running_stats() -> dict:
+    return {'n': np.zeros(0, dtype=np.int64), 'mean': np.zeros(0), 'm2': np.zeros(0)}
+
+
+def running_mean_se(stats: dict) -> tuple:
+
+    # standard error of the mean over the runs that reached each position (NaN with a single run, like pd.Series.sem)
+    n = stats['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.where(n > 1, np.sqrt(stats['m2'] / np.maximum(n - 1, 1)) / np.sqrt(np.maximum(n, 1)), np.nan)
+
+    return stats['mean'][n > 0], se[n > 0]
+
+
+def load_aggregate_state(state_path: Path, stop_at_n: int, by_ivs: bool, stamps: dict) -> dict:
+
+    # start from scratch when the settings changed, or when a file that was included has changed or is gone since
+    if state_path.exists():
+        with state_path.open('rb') as f:
+            state = pickle.load(f)
+
+        if state['stop_at_n'] == stop_at_n and state['by_ivs'] == by_ivs and all(stamps.get(file) == stamp for file, stamp in state['files'].items()):
+            return state
+
+    return {'stop_at_n': stop_at_n, 'by_ivs': by_ivs, 'files': {}, 'curves': {}}
+
+
+def save_aggregate_state(state_path: Path, state: dict) -> None:
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open('wb') as f:
+            pickle.dump(state, f)
+
+    atomic_write(state_path, write)
+
+
+def aggregate_recall_plots(datasets: dict, out_dir: Path, stop_at_n: int, by_ivs: bool = False) -> None:
+
   for name in datasets:
-      
-    raw_output = out_dir / name / 'raw_simulations'
-        
-    random_runs = []
-    llm_runs = []
-    criteria_runs = []
-    no_initialisation_runs = []
 
-    # loop over all csv files in raw_output
-    for file in Path(raw_output).glob('*.csv'):
-        df = pd.read_csv(file)
+    files = raw_simulation_files(out_dir, name)
+    stamps = {file.relative_to(out_dir).as_posix(): [file.stat().st_size, file.stat().st_mtime_ns] for _, _, _, file in files}
 
-        #drop the first rows if it contains NaN
-        df = df.dropna(axis=0, subset=["training_set"])
-        
-        # check if the file is random priors, llm or no priors
-        if 'random' in file.name:
-            random_runs.append(df)
-        elif 'llm' in file.name:
-            llm_runs.append(df)
-        elif 'criteria' in file.name:
-            criteria_runs.append(df)
-        elif 'no_initialisation' in file.name:
-            no_initialisation_runs.append(df)   
-            
-    # For each method, first calculate cumsum for each run, then compute mean and SEM across runs
-    random_cumsums = [df.loc[df["querier"].notna(), "label"].iloc[:stop_at_n].cumsum().reset_index(drop=True) for df in random_runs]
-    agg_random = pd.DataFrame({
-        'Cumulative Sum': pd.concat(random_cumsums, axis=1).mean(axis=1),
-        'SE': pd.concat(random_cumsums, axis=1).sem(axis=1)
-    })
-
-    llm_cumsums = [df.loc[df["querier"].notna(), "label"].iloc[:stop_at_n].cumsum().reset_index(drop=True) for df in llm_runs]
-    agg_llm = pd.DataFrame({
-        'Cumulative Sum': pd.concat(llm_cumsums, axis=1).mean(axis=1),
-        'SE': pd.concat(llm_cumsums, axis=1).sem(axis=1)
-    })
-    
-    criteria_cumsums = [df.loc[df["querier"].notna(), "label"].iloc[:stop_at_n].cumsum().reset_index(drop=True) for df in criteria_runs]
-    agg_criteria = pd.DataFrame({
-        'Cumulative Sum': pd.concat(criteria_cumsums, axis=1).mean(axis=1),
-        'SE': pd.concat(criteria_cumsums, axis=1).sem(axis=1)
-    })
+    # running statistics per condition, and per (condition, IVs) when curves are broken down by IV combination,
+    # kept between calls together with the files they include, so only new raw simulations are read
+    state_path = out_dir / name / 'aggregate_state.pkl'
+    state = load_aggregate_state(state_path, stop_at_n, by_ivs, stamps)
+    curves = state['curves']
+
+    new_files = [(condition, ivs, file) for condition, _, ivs, file in files if file.relative_to(out_dir).as_posix() not in state['files']]
+    print(f"Aggregating {len(new_files)} new raw simulations for dataset: {name} ({len(state['files'])} included before)")
+
+    # stream over the new raw simulation files (csv or parquet), one file in memory at a time
+    for condition, ivs, file in new_files:
+
+        curve = recall_curve(read_table(file, columns=["label", "querier", "training_set"]), stop_at_n)
+
+        update_running_stats(curves.setdefault(condition, new_running_stats()), curve)
+        if by_ivs:
+            update_running_stats(curves.setdefault((condition, ivs), new_running_stats()), curve)
 
-    no_initialisation_cumsums = [df.loc[df["querier"].notna(), "label"].iloc[:stop_at_n].cumsum().reset_index(drop=True) for df in no_initialisation_runs]
-    agg_no_initialisation = pd.DataFrame({
-        'Cumulative Sum': pd.concat(no_initialisation_cumsums, axis=1).mean(axis=1),
-        'SE': pd.concat(no_initialisation_cumsums, axis=1).sem(axis=1)
-    })
+        state['files'][file.relative_to(out_dir).as_posix()] = stamps[file.relative_to(out_dir).as_posix()]
 
+    if new_files:
+        save_aggregate_state(state_path, state)
+
+    if not curves:
+        print(f"No raw simulations to aggregate for dataset: {name}")
+        continue
+
+    ### SAVE THE AGGREGATED RECALL CURVES ############################################################################################
+
+    rows = []
+    for key, stats in curves.items():
+        condition, ivs = key if isinstance(key, tuple) else (key, 'all')
+        mean, se = running_mean_se(stats)
+        rows.append(pd.DataFrame({'condition': condition, 'IVs': ivs, 'position': np.arange(1, len(mean) + 1), 'n_runs': stats['n'][stats['n'] > 0], 'mean': mean, 'se': se}))
+
+    pd.concat(rows, ignore_index=True).to_csv(out_dir / name / 'aggregate_recall_curves.csv', index=False)
 
     ### PLOT THE AGGREGATED RECALL CURVES ############################################################################################
-    
-    # Note that this function does not work if stop_at_n == -1 (no stopping criterion)
-    
+
+    # exact reference of screening in random order, written by reference.write_random_reference when the sweep starts,
+    # for the whole dataset and for the pool of the random condition (without its relevant prior)
+    reference_paths = {'dataset': out_dir / name / 'random_reference_curve.csv', 'random': out_dir / name / 'random_reference_curve_random_condition.csv'}
+    reference = {pool: pd.read_csv(path) for pool, path in reference_paths.items() if path.exists()} or None
+
+    plot_aggregate_recall({condition: curves[condition] for condition in CONDITION_STYLES if condition in curves}, stop_at_n, out_dir / name / 'aggregate_recall_plot.png', reference=reference)
+
+    # one plot per IV combination, with the baselines simulated for that combination or shared by its replicate
+    if by_ivs:
+        for ivs in sorted({key[1] for key in curves if isinstance(key, tuple) and key[0] == 'llm'}):
+            combo_curves = {}
+            for condition in CONDITION_STYLES:
+                for key in [(condition, ivs), (condition, 'shared')]:
+                    if key in curves:
+                        combo_curves[condition] = curves[key]
+                        break
+
+            plots_dir = out_dir / name / 'aggregate_recall_plots'
+            plots_dir.mkdir(parents=True, exist_ok=True)
+            plot_aggregate_recall(combo_curves, stop_at_n, plots_dir / f'aggregate_recall_plot_IVs_{ivs}.png', title_suffix=f' (IVs {ivs})', reference=reference)
+
+
+def plot_aggregate_recall(curves: dict, stop_at_n: int, plot_path: Path, title_suffix: str = '', reference: dict = None) -> None:
+
+    plt = pyplot()
     plt.figure(figsize=(10, 6))
 
-    x_axis = range(1, stop_at_n + 1)
+    # expected number found when screening the whole dataset in random order, with the 95% band of single random
+    # screenings; the random condition screens one relevant record less, so its own expectation is drawn in its colour
+    if reference is not None and 'dataset' in reference:
+        plt.plot(reference['dataset']['position'], reference['dataset']['mean'], label='Random Screening (expected)', color='dimgrey', linestyle=':')
+        plt.fill_between(reference['dataset']['position'], reference['dataset']['lower'], reference['dataset']['upper'], color='lightgrey', alpha=0.4, step='post', label='Random Screening (95% band)')
+    if reference is not None and 'random' in reference and 'random' in curves:
+        plt.plot(reference['random']['position'], reference['random']['mean'], label=f"Random Screening, pool of the {CONDITION_STYLES['random'][0]} (expected)", color=CONDITION_STYLES['random'][1], linestyle=':')
 
-    # Use 1-based x-axis: screening 1 through stop_at_n
-    plt.plot(x_axis, agg_random['Cumulative Sum'][:stop_at_n], label='True Example Condition', color='blue')
-    plt.fill_between(x_axis, agg_random['Cumulative Sum'][:stop_at_n] - agg_random['SE'][:stop_at_n], agg_random['Cumulative Sum'][:stop_at_n] + agg_random['SE'][:stop_at_n], color='royalblue', alpha=0.3)
+    for condition, stats in curves.items():
+        label, colour, band_colour = CONDITION_STYLES[condition]
+        mean, se = running_mean_se(stats)
 
-    plt.plot(x_axis, agg_llm['Cumulative Sum'][:stop_at_n], label='LLM Condition', color='green')
-    plt.fill_between(x_axis, agg_llm['Cumulative Sum'][:stop_at_n] - agg_llm['SE'][:stop_at_n], agg_llm['Cumulative Sum'][:stop_at_n] + agg_llm['SE'][:stop_at_n], color='forestgreen', alpha=0.3)
-    
-    plt.plot(x_axis, agg_criteria['Cumulative Sum'][:stop_at_n], label='Inclusion Criteria Condition', color='orange')
-    plt.fill_between(x_axis, agg_criteria['Cumulative Sum'][:stop_at_n] - agg_criteria['SE'][:stop_at_n], agg_criteria['Cumulative Sum'][:stop_at_n] + agg_criteria['SE'][:stop_at_n], color='goldenrod', alpha=0.3)
-    
-    plt.plot(x_axis, agg_no_initialisation['Cumulative Sum'][:stop_at_n], label='Cold Start Condition', color='red')
-    plt.fill_between(x_axis, agg_no_initialisation['Cumulative Sum'][:stop_at_n] - agg_no_initialisation['SE'][:stop_at_n], agg_no_initialisation['Cumulative Sum'][:stop_at_n] + agg_no_initialisation['SE'][:stop_at_n], color='lightsalmon', alpha=0.3)
+        # Use 1-based x-axis: screening 1 through the last position any run reached
+        x_axis = np.arange(1, len(mean) + 1)
+        plt.plot(x_axis, mean, label=label, color=colour)
+        plt.fill_between(x_axis, mean - se, mean + se, color=band_colour, alpha=0.3)
 
     # Add dashed line at stop_at_n
-    plt.axvline(x=stop_at_n, color='black', linestyle='--', label='stop screening')
+    if stop_at_n != -1:
+        plt.axvline(x=stop_at_n, color='black', linestyle='--', label='stop screening')
 
     plt.xlabel('Number of Records Screened')
     plt.ylabel('Number of Relevant Records Found')
-    plt.title('Number of Relevant Records Found vs. Number of Records Screened')
+    plt.title('Number of Relevant Records Found vs. Number of Records Screened' + title_suffix)
     plt.legend()
     plt.grid(True)
     plt.tight_layout()
-    
+
     # save plot to output_path
-    plot_path = out_dir / name / 'aggregate_recall_plot.png'
     plt.savefig(plot_path)
     plt.close()
-    
-    
-    
+
+
+
+### SUMMARY TABLE OF THE OUTCOME METRICS ############################################################################################################################################
+
+def summarise_results(out_dir: Path, output_format: str = "csv") -> pd.DataFrame:
+
+    df_results = read_results(out_dir, output_format)
+    if df_results is None:
+        print("No simulation results to summarise yet.")
+        return None
+
+    # with shared baselines, the rows of a baseline simulation are repeated under every IV combination of its
+    # replicate: each simulation counts once, like in the aggregated recall curves
+    if 'baseline_run' in df_results.columns:
+        is_baseline = df_results['condition'].isin(BASELINE_CONDITIONS)
+        repeated = is_baseline & df_results.duplicated(subset=['dataset', 'condition', 'baseline_run', 'metric'], keep='last')
+        df_results = df_results[~repeated]
+
+    # one row per dataset, condition, IV combination and metric (baselines have no IVs)
+    df_summary = (df_results
+        .groupby(['dataset', 'condition', 'n_abstracts', 'length_abstracts', 'llm_temperature', 'metric'], dropna=False)['value']
+        .agg(n_runs='count', mean='mean', se='sem')
+        .reset_index())
+
+    df_summary.to_csv(out_dir / 'summary_metrics.csv', index=False)
+
+    return df_summary
@@ -0,0 +1,70 @@
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import hashlib
+import re
+import time
+
+from instrument import record
+
+
+### Offline generation backends (no network needed) ###
+
+BACKENDS = ("openai", "replay", "synthetic")
+
+# off-topic words mixed into synthetic abstracts, more of them at higher temperatures
+FILLER_WORDS = (
+    "study results methods analysis data sample participants effect outcome group "
+    "design approach evidence findings population measure review model significant "
+    "association factors level period follow baseline sample report"
+).split()
+
+
+def replay_abstracts(replay_dir: Path, name: str, n_abstracts: int, length_abstracts: int, llm_temperature: float, run: int, fallback: bool = False) -> list:
+
+    abstracts_dir = Path(replay_dir) / name / "llm_abstracts"
+    path = abstracts_dir / f"llm_abstracts_run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.csv"
+
+    if not path.exists():
+        if not fallback:
+            raise FileNotFoundError(f"No abstracts to replay for dataset {name}, run {run} with IVs {n_abstracts}_{length_abstracts}_{llm_temperature}: {path} does not exist (set llm_replay_fallback to replay another run).")
+
+        # only with llm_replay_fallback: another run with the same IVs, picked deterministically. Replicates that get
+        # the same run share their LLM priors, so the substituted run is recorded in the run trace
+        candidates = sorted(abstracts_dir.glob(f"llm_abstracts_run_*_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.csv"))
+        if not candidates:
+            raise FileNotFoundError(f"No abstracts to replay for dataset {name} with IVs {n_abstracts}_{length_abstracts}_{llm_temperature} in {abstracts_dir}.")
+        path = candidates[run % len(candidates)]
+        source_run = int(re.match(r"llm_abstracts_run_(\d+)_IVs_", path.name).group(1))
+        record('llm_replay_fallback', condition='llm', source_run=source_run)
+        print(f"WARNING: replaying the abstracts of run {source_run} for dataset {name}, run {run} ({path.name} is shared with other runs).")
+
+    df_replay = pd.read_csv(path, dtype={"doi": str, "title": str, "abstract": str, "reasoning": str}, keep_default_na=False)
+
+    return df_replay.to_dict("records")
+
+
+def synthetic_abstract(name: str, criteria: str, length_abstracts: int, llm_temperature: float, replicate: int, index: int, seed: int = 0, latency: float = 0.0) -> dict:
+
+    # seed from the replicate, like the abstract cache of the openai backend, so that every (dataset, replicate, index)
+    # always gets the same abstract, also when IV combinations are added or removed
+    digest = hashlib.sha256(f"{seed}|{name}|{replicate}|{index}".encode("utf-8")).digest()
+    rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+
+    criteria_words = re.findall(r"[A-Za-z][A-Za-z\-]+", str(criteria).lower()) or FILLER_WORDS
+
+    # the share of off-topic words grows with the temperature
+    off_topic = rng.random(length_abstracts) < min(0.9, 0.1 + 0.5 * llm_temperature)
+    words = np.where(off_topic, rng.choice(FILLER_WORDS, size=length_abstracts), rng.choice(criteria_words, size=length_abstracts))
+
+    # simulate the response time of an API call
+    if latency > 0:
+        time.sleep(latency)
+
+    return {
+        "doi": "None",
+        "title": " ".join(rng.choice(criteria_words, size=8)).capitalize(),
+        "abstract": " ".join(words),
+        "label_included": 1,
+        "reasoning": "Synthetic abstract generated offline from the inclusion criteria.",
+    }
@@ -1,102 +1,200 @@
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import json
 import re
-import dspy
-from dotenv import load_dotenv
-
-load_dotenv()  # Load environment variables from .env file
-
-def generate_abstracts(name: str, stimulus: list, out_dir: Path, n_abstracts: int, length_abstracts: int, llm_temperature: float, run: int) -> pd.DataFrame:
-    
-    ### Create signature ###
-    lm = dspy.LM("openai/gpt-4o-mini",
-                temperature=llm_temperature, 
-                cache=False
-                )
-    
-    dspy.configure(
-        lm=lm,
-        adapter=dspy.JSONAdapter(),
-    )
+import time
+
+from abstract_cache import CACHE_MODES, CacheMissError, abstract_key, load_abstract, store_abstract
+from throttle import TokenBucket, call_with_retry
+from offline import BACKENDS, replay_abstracts, synthetic_abstract
+from instrument import stage, record
+
+LLM_MODEL = "openai/gpt-4o-mini"
+
+
+### LM CLIENT AND PROGRAM (built once per process) ##################################################
+
+# (llm_temperature, length_abstracts) -> ChainOfThought program with its own LM client
+_programs = {}
+
+# requests_per_second -> token bucket shared by all generation threads of this process
+_rate_limiters = {}
+
+
+def _make_signature(length_abstracts: int):
+
+    import dspy
 
     class MakeAbstract(dspy.Signature):
         """Generate a synthetic abstract based on the eligibility criteria of the systematic review."""
-        
+
         # Input fields
         label_relevant: int = dspy.InputField(desc="1 for an example of an abstract and title relevant to the review; 0 for an example of an abstract and title irrelevant to the review")
         criteria: str = dspy.InputField(desc="The inclusion or exclusion criteria of the review")
         length_abstracts: int = dspy.InputField(desc="The number of words that the generated abstract should approximately contain.")
         # typicality: int = dspy.InputField(desc="A binary variable representing whether an abstract should be typical (1) or atypical (0) for the review. The typical abstracts generated should be 'in the center' of the relevant or irrelevant cluster of abstracts classified by reviewers, whereas the atypical abstracts should aim to be on the 'edges' of these clusters. In other words, typical abstracts should be more representative of the review topic, whereas atypical abstracts should be more unusual or unique in their content.")
         # degree_jargon: float = dspy.InputField(desc="The degree to which the generated abstracts should exist out of a long list of jargon or rather be written as a true abstract (with 1.00 representing an abstract full of jargon only and 0.00 representing a true abstract)")
-     
-        # Output fields   
+
+        # Output fields
         doi: str = dspy.OutputField(desc="Should always be 'None' for generated abstracts")
         title: str = dspy.OutputField(desc="The generated title of the abstract")
         abstract: str = dspy.OutputField(desc=f"The generated abstract text of {length_abstracts} words")
         label_included: int = dspy.OutputField(desc="1 if the abstract is included based on the inclusion criteria, 0 if the abstract is excluded based on the exclusion criteria")
         reasoning: str = dspy.OutputField(desc="The reasoning behind inclusion or exclusion of the abstract")
-        
-    make_abstract = dspy.ChainOfThought(MakeAbstract)
-  
-    ### Generate abstracts ###  
-    
-    df_generated = pd.DataFrame(columns=["doi", "title", "abstract", "label_included", "reasoning"])
-    
-    max_attempts = 10
-    
-    # loop to generate multiple abstracts
-    for i in range(n_abstracts):
-    
-        success = False
-        attempt = 0
-        
-        while not success and attempt < max_attempts:
-            
-            if attempt > 1:
-                print(f"Regenerating abstracts for dataset {name} (attempt {attempt}/{max_attempts}).")
-            attempt += 1
-        
-            #generate relevant abstract
-            relevant = make_abstract(
+
+    return MakeAbstract
+
+
+def get_program(llm_temperature: float, length_abstracts: int):
+
+    key = (llm_temperature, length_abstracts)
+
+    if key not in _programs:
+
+        # dspy (and litellm) are only imported when abstracts are requested from the API
+        import dspy
+        from dotenv import load_dotenv
+
+        # the API key and adapter are set up once, from the thread that first builds a program (token usage is
+        # tracked for the run traces)
+        if not _programs:
+            load_dotenv()  # Load environment variables from .env file
+            dspy.configure(adapter=dspy.JSONAdapter(), track_usage=True)
+
+        # retries are handled by call_with_retry, so litellm should not retry on its own
+        lm = dspy.LM(LLM_MODEL,
+                    temperature=llm_temperature,
+                    cache=False,
+                    num_retries=0
+                    )
+
+        program = dspy.ChainOfThought(_make_signature(length_abstracts))
+        program.set_lm(lm)
+        _programs[key] = program
+
+    return _programs[key]
+
+
+def get_rate_limiter(requests_per_second: float) -> TokenBucket:
+
+    if requests_per_second is None:
+        return None
+
+    if requests_per_second not in _rate_limiters:
+        _rate_limiters[requests_per_second] = TokenBucket(rate=requests_per_second)
+
+    return _rate_limiters[requests_per_second]
+
+
+def token_usage(prediction) -> dict:
+
+    # prompt and completion tokens of a dspy prediction, summed over the LMs it called
+    usage = (prediction.get_lm_usage() or {}).values()
+
+    return {
+        'prompt_tokens': sum(entry.get('prompt_tokens') or 0 for entry in usage),
+        'completion_tokens': sum(entry.get('completion_tokens') or 0 for entry in usage),
+    }
+
+
+
+### GENERATE ABSTRACTS ##############################################################################
+
+def generate_abstracts(name: str, stimulus: list, out_dir: Path, n_abstracts: int, length_abstracts: int, llm_temperature: float, run: int, replicate: int, cache_mode: str = "read_write", cache_dir: Path = None, cache_max_age_days: float = None, max_concurrency: int = 1, requests_per_second: float = None, max_retries: int = 5, backend: str = "openai", replay_dir: Path = None, replay_fallback: bool = False, synthetic_seed: int = 0, synthetic_latency: float = 0.0) -> pd.DataFrame:
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown generation backend '{backend}', expected one of {BACKENDS}.")
+
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Unknown abstract cache mode '{cache_mode}', expected one of {CACHE_MODES}.")
+
+    # default to a cache shared by all datasets in this output directory
+    if cache_dir is None:
+        cache_dir = out_dir / "llm_cache"
+
+    # the LM client is only needed when abstracts are requested from the API
+    if backend == "openai":
+        make_abstract = get_program(llm_temperature, length_abstracts)
+        rate_limiter = get_rate_limiter(requests_per_second)
+
+    ### Generate abstracts ###
+
+    def generate_one(i: int) -> dict:
+
+        # latency (including rate limiting and retries) and token usage of every request go to the run trace
+        start = time.perf_counter()
+
+        # offline backend: deterministic abstracts built from the criteria text, not cached
+        if backend == "synthetic":
+            abstract = synthetic_abstract(name, stimulus['inclusion_criteria'], length_abstracts, llm_temperature, replicate=replicate, index=i, seed=synthetic_seed, latency=synthetic_latency)
+            record('llm_request', condition='llm', backend=backend, index=i, cached=False, seconds=time.perf_counter() - start, prompt_tokens=0, completion_tokens=0)
+            return abstract
+
+        # reuse the abstract if it was generated before for the same prompt inputs and replicate (the global run
+        # is only used to name the output files)
+        key = abstract_key(name, stimulus['inclusion_criteria'], length_abstracts, llm_temperature, label_relevant=1, model=LLM_MODEL, replicate=replicate, index=i)
+
+        if cache_mode != "off":
+            cached = load_abstract(cache_dir, key, max_age_days=cache_max_age_days)
+
+            if cached is not None:
+                record('llm_request', condition='llm', backend=backend, index=i, cached=True, seconds=time.perf_counter() - start, prompt_tokens=0, completion_tokens=0)
+                return cached
+
+            if cache_mode == "cache_only":
+                raise CacheMissError(f"Abstract {i} of replicate {replicate} for dataset {name} is not in the cache at {cache_dir} (cache_only mode).")
+
+        #generate relevant abstract (retried with exponential backoff on 429/5xx responses)
+        relevant = call_with_retry(
+            lambda: make_abstract(
                 label_relevant=1,
                 criteria = stimulus['inclusion_criteria'],
                 length_abstracts=length_abstracts,
                 llm_temperature=llm_temperature,
-            )
-
-            relevant_abstract = {
-                "doi": relevant.doi,
-                "title": relevant.title,
-                "abstract": relevant.abstract,
-                "label_included": 1,
-                "reasoning": relevant.reasoning,
-            }
-        
-            parsed_data = {
-                "doi": [relevant_abstract["doi"]],
-                "title": [relevant_abstract["title"]],
-                "abstract": [relevant_abstract["abstract"]],
-                "label_included": [relevant_abstract["label_included"]],
-                "reasoning": [relevant_abstract["reasoning"]],
-            }
-            
-            # try to append generated abstracts to dataframe
-            df_generated = pd.concat([df_generated, pd.DataFrame(parsed_data)], ignore_index=True)
-            
-            success = True
-            break # exit the attempt loop if successful
-        
-
-    
+            ),
+            max_retries=max_retries,
+            rate_limiter=rate_limiter
+        )
+
+        record('llm_request', condition='llm', backend=backend, index=i, cached=False, seconds=time.perf_counter() - start, **token_usage(relevant))
+
+        relevant_abstract = {
+            "doi": relevant.doi,
+            "title": relevant.title,
+            "abstract": relevant.abstract,
+            "label_included": 1,
+            "reasoning": relevant.reasoning,
+        }
+
+        if cache_mode != "off":
+            store_abstract(cache_dir, key, relevant_abstract)
+
+        return relevant_abstract
+
+    # offline backend: serve the abstracts written by an earlier sweep
+    if backend == "replay":
+        generated = replay_abstracts(replay_dir if replay_dir is not None else out_dir, name, n_abstracts, length_abstracts, llm_temperature, run, fallback=replay_fallback)
+
+    # send the requests for all abstracts concurrently, keeping them in replicate order
+    elif max_concurrency > 1 and n_abstracts > 1:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, n_abstracts)) as pool:
+            generated = list(pool.map(generate_one, range(n_abstracts)))
+    else:
+        generated = [generate_one(i) for i in range(n_abstracts)]
+
+    df_generated = pd.DataFrame(generated, columns=["doi", "title", "abstract", "label_included", "reasoning"])
+
+    # the cache is kept within its size and age limits once per sweep, see run.evict_abstract_cache
+
     #ensure that the label is of the generated abstracts is integer
     df_generated = df_generated.astype({"label_included":int})
-       
+
     #save generated abstracts to csv file in new directory
     path_abstracts = out_dir / name / f"llm_abstracts/llm_abstracts_run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.csv"
     path_abstracts.parent.mkdir(parents=True, exist_ok=True)
-    df_generated.to_csv(path_abstracts, index=False)
+    with stage('write_abstracts', condition='llm'):
+        df_generated.to_csv(path_abstracts, index=False)
 
 
     return df_generated
-
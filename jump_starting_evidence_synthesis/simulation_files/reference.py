@@ -0,0 +1,158 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import hypergeom
+
+from metrics import evaluation_kernel
+
+
+### Random screening reference ###
+
+# Screening the records of a dataset in random order needs no simulation: the number of relevant records found after
+# t records follows the hypergeometric distribution of the number of records and relevant records that can be screened:
+# those of the dataset minus the priors taken from it. The reference is computed once per dataset and pool, and written
+# next to the simulations: random_reference_curve.csv (expected number found at every position with its 95% band, drawn
+# in the aggregated recall plots), random_reference_tdd.csv (distribution of TDD@stop_at_n) and
+# random_reference_metrics.csv (mean and sd of the outcome metrics, and the share of screenings in which they are
+# defined, e.g. when at least one relevant record is found). These hold for the conditions that screen the whole dataset
+# (llm, criteria and no_initialisation, whose priors are extra rows); the files ending in RANDOM_CONDITION_SUFFIX hold
+# for the random condition, whose relevant prior is taken from the dataset.
+# "analytical" computes all of them in closed form; "monte_carlo" screens n_seeds random orders in one vectorized call
+# of the evaluation kernel, as a check of the closed forms.
+
+RANDOM_REFERENCE_METHODS = ("none", "analytical", "monte_carlo")
+
+BAND_QUANTILES = (0.025, 0.975)
+
+# reference files of the pool of the random condition, which screens the dataset without its one relevant prior
+RANDOM_CONDITION_SUFFIX = '_random_condition'
+
+
+def screening_horizon(n_records: int, stop_at_n: int) -> int:
+    return n_records if stop_at_n == -1 else min(stop_at_n, n_records)
+
+
+def moments(values: np.ndarray, pmf: np.ndarray) -> tuple:
+
+    # (mean, sd, probability) of a metric with probabilities pmf over values, given that it is defined
+    p_defined = pmf.sum()
+    if p_defined <= 0:
+        return np.nan, np.nan, 0.0
+
+    mean = (values * pmf).sum() / p_defined
+    sd = np.sqrt(max(((values - mean) ** 2 * pmf).sum() / p_defined, 0.0))
+
+    return mean, sd, p_defined
+
+
+def analytical_reference(n_records: int, n_relevant: int, stop_at_n: int, wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100)) -> tuple:
+
+    horizon = screening_horizon(n_records, stop_at_n)
+    positions = np.arange(1, horizon + 1)
+
+    # number of relevant records found after each position
+    found = hypergeom(n_records, n_relevant, positions)
+    df_curve = pd.DataFrame({'position': positions, 'mean': positions * n_relevant / n_records,
+                             'lower': found.ppf(BAND_QUANTILES[0]), 'upper': found.ppf(BAND_QUANTILES[1])})
+
+    # TDD@stop_at_n: relevant records found at the end of screening
+    papers_found = np.arange(0, min(n_relevant, horizon) + 1)
+    tdd = hypergeom.pmf(papers_found, n_records, n_relevant, horizon)
+    df_tdd = pd.DataFrame({'papers_found': papers_found, 'probability': tdd})
+
+    metrics = {'papers_found': moments(papers_found, tdd)}
+
+    # first relevant record at position t: none in the first t - 1 records, but one in the first t
+    none_found = hypergeom.pmf(0, n_records, n_relevant, np.arange(0, horizon + 1))
+    metrics['time_to_first_relevant'] = moments(positions, none_found[:-1] - none_found[1:])
+
+    # given m records found, their positions are a random m-subset of 1..horizon: the average position is (horizon + 1) / 2
+    # on average, with the variance of the mean of m draws without replacement
+    found_some = papers_found[1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        atd_variance = np.where(horizon > 1, (horizon ** 2 - 1) / 12 / found_some * (horizon - found_some) / max(horizon - 1, 1), 0.0)
+    p_found = tdd[1:].sum()
+    metrics['atd'] = ((horizon + 1) / 2, np.sqrt((atd_variance * tdd[1:]).sum() / p_found), p_found) if p_found > 0 else (np.nan, np.nan, 0.0)
+
+    # records screened until wss_threshold of the relevant records are found (the target is counted like the kernel does)
+    target = max(np.ceil(wss_threshold * n_relevant - 1e-9), 1)
+    reached = np.concatenate([[0.0], hypergeom.sf(target - 1, n_records, n_relevant, positions)])
+    metrics[f'wss@{wss_threshold:g}'] = moments((n_records - positions) / n_records - (1 - wss_threshold), np.diff(reached))
+
+    # recall after each cutoff, NaN beyond stop_at_n like in the simulations
+    for cutoff in recall_cutoffs:
+        if stop_at_n != -1 and cutoff > stop_at_n:
+            metrics[f'recall@{cutoff}'] = (np.nan, np.nan, 0.0)
+            continue
+        screened = min(cutoff, horizon)
+        variance = screened * n_relevant / n_records * (n_records - n_relevant) / n_records * (n_records - screened) / max(n_records - 1, 1)
+        metrics[f'recall@{cutoff}'] = (screened / n_records, np.sqrt(variance) / n_relevant, 1.0)
+
+    df_metrics = pd.DataFrame([{'metric': metric, 'mean': mean, 'sd': sd, 'p_defined': p} for metric, (mean, sd, p) in metrics.items()])
+
+    return df_curve, df_tdd, df_metrics
+
+
+def monte_carlo_reference(n_records: int, n_relevant: int, stop_at_n: int, wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100), n_seeds: int = 10000, seed: int = 0, max_cells: int = 2 ** 24) -> tuple:
+
+    horizon = screening_horizon(n_records, stop_at_n)
+    rng = np.random.default_rng(seed)
+
+    # the labels of the first horizon records of every random order: the number found is hypergeometric, and the
+    # records found are a random subset of the positions; seeds are drawn in blocks of at most max_cells labels
+    block_size = max(1, max_cells // horizon)
+    curves, evaluations = [], []
+
+    for start in range(0, n_seeds, block_size):
+        n_block = min(block_size, n_seeds - start)
+        n_found = rng.hypergeometric(n_relevant, n_records - n_relevant, horizon, size=n_block)
+        labels = (rng.random((n_block, horizon)).argsort(axis=1) < n_found[:, None]).astype(np.int32)
+
+        curves.append(np.cumsum(labels, axis=1, dtype=np.int32))
+        evaluations.append(evaluation_kernel(labels, np.full(n_block, horizon), np.full(n_block, n_relevant), np.full(n_block, n_records), stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs))
+
+    curves = np.concatenate(curves)
+    df_curve = pd.DataFrame({'position': np.arange(1, horizon + 1), 'mean': curves.mean(axis=0),
+                             'lower': np.quantile(curves, BAND_QUANTILES[0], axis=0, method='inverted_cdf'), 'upper': np.quantile(curves, BAND_QUANTILES[1], axis=0, method='inverted_cdf')})
+
+    papers_found = np.concatenate([evaluation['papers_found'] for evaluation in evaluations])
+    values, counts = np.unique(papers_found, return_counts=True)
+    df_tdd = pd.DataFrame({'papers_found': values, 'probability': counts / n_seeds})
+
+    metrics = {'papers_found': papers_found}
+    for metric, key in [('time_to_first_relevant', 'time_to_first_relevant'), ('atd', 'atd'), (f'wss@{wss_threshold:g}', 'wss')]:
+        metrics[metric] = np.concatenate([evaluation[key] for evaluation in evaluations])
+    for cutoff in recall_cutoffs:
+        metrics[f'recall@{cutoff}'] = np.concatenate([evaluation['recall'][cutoff] for evaluation in evaluations])
+
+    rows = []
+    for metric, values in metrics.items():
+        defined = values[~np.isnan(values)]
+        rows.append({'metric': metric, 'mean': defined.mean() if len(defined) else np.nan, 'sd': defined.std(ddof=1) if len(defined) > 1 else np.nan, 'p_defined': len(defined) / n_seeds})
+
+    return df_curve, df_tdd, pd.DataFrame(rows)
+
+
+def write_random_reference(out_dir: Path, name: str, dataset: pd.DataFrame, stop_at_n: int, method: str = "analytical", wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100), n_seeds: int = 10000, n_priors: int = 0, n_relevant_priors: int = 0, suffix: str = '') -> None:
+
+    if method not in RANDOM_REFERENCE_METHODS:
+        raise ValueError(f"Unknown random reference method '{method}', expected one of {RANDOM_REFERENCE_METHODS}.")
+
+    if method == "none":
+        return
+
+    # the priors taken from the dataset are labeled before screening starts, so they are not part of the screened pool
+    n_records, n_relevant = len(dataset) - n_priors, int(dataset["label_included"].sum()) - n_relevant_priors
+
+    if method == "analytical":
+        df_curve, df_tdd, df_metrics = analytical_reference(n_records, n_relevant, stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs)
+    else:
+        df_curve, df_tdd, df_metrics = monte_carlo_reference(n_records, n_relevant, stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs, n_seeds=n_seeds)
+
+    df_metrics.insert(0, 'dataset', name)
+    df_metrics = df_metrics.assign(method=method, n_records=n_records, n_relevant=n_relevant, n_priors=n_priors, n_relevant_priors=n_relevant_priors, stop_at_n=stop_at_n)
+
+    (out_dir / name).mkdir(parents=True, exist_ok=True)
+    df_curve.to_csv(out_dir / name / f'random_reference_curve{suffix}.csv', index=False)
+    df_tdd.to_csv(out_dir / name / f'random_reference_tdd{suffix}.csv', index=False)
+    df_metrics.to_csv(out_dir / name / f'random_reference_metrics{suffix}.csv', index=False)
@@ -0,0 +1,53 @@
+import pandas as pd
+
+
+### Adaptive replication ###
+
+# With adaptive_replication, replicates are added in rounds instead of running n_simulations of them for every dataset
+# and IV combination. After the first adaptive_min_simulations replicates and after every further replicate, the
+# standard error of each metric in adaptive_target_se (papers_found and atd by default) is computed per dataset, IV
+# combination and condition over the replicates so far. A (dataset, IV combination) gets no more replicates once all its
+# conditions are within the targets; the others continue until n_simulations, which becomes the maximum.
+# A standard error needs two values: a metric that is empty in all but one replicate (e.g. atd when nothing is
+# found) never meets its target.
+
+PRECISION_NAME = 'replication_precision.csv'
+
+
+def replication_group(task: dict) -> tuple:
+
+    # replicates of the same dataset and IV combination
+    return task['dataset'], task['combo_idx']
+
+
+def replicate_precision(df_results: pd.DataFrame, tasks: list, target_se: dict) -> pd.DataFrame:
+
+    # standard error of every target metric per dataset, IV combination and condition over the replicates so far;
+    # the rows of a cell are found by its run, as baselines have no IVs
+    groups = {(task['dataset'], task['run']): task for task in tasks}
+
+    # a cell that was run again counts once
+    df = df_results[df_results['metric'].isin(list(target_se.keys()))]
+    df = df.sort_values('timestamp', kind='stable').drop_duplicates(subset=['dataset', 'run', 'condition', 'metric'], keep='last')
+    df = df[[(name, run) in groups for name, run in zip(df['dataset'], df['run'])]]
+
+    cells = [groups[(name, run)] for name, run in zip(df['dataset'], df['run'])]
+    ivs = ['combo_idx', 'n_abstracts', 'length_abstracts', 'llm_temperature']
+    df = df.drop(columns=ivs, errors='ignore').assign(**{column: [task[column] for task in cells] for column in ivs})
+
+    df_precision = (df
+        .groupby(['dataset', *ivs, 'condition', 'metric'])['value']
+        .agg(n_runs='count', mean='mean', se='sem')
+        .reset_index())
+
+    df_precision['target_se'] = df_precision['metric'].map(target_se)
+    df_precision['converged'] = df_precision['se'] <= df_precision['target_se']
+
+    return df_precision
+
+
+def converged_groups(df_precision: pd.DataFrame) -> set:
+
+    # (dataset, IV combination) whose conditions all meet the target of every metric
+    converged = df_precision.groupby(['dataset', 'combo_idx'])['converged'].all()
+    return {(name, int(combo_idx)) for name, combo_idx in converged[converged].index}
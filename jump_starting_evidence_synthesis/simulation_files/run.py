@@ -1,17 +1,134 @@
 import typer 
 from pathlib import Path
-import pandas as pd
+from typing import List
 import itertools
 
-
-from simulation import run_simulation
-from metrics import aggregate_recall_plots
 from config import load_pyproject_config
 
+# Every command imports the modules it needs when it runs, so that e.g. aggregate and evaluate do not pay for
+# importing asreview, dspy or matplotlib (see check_imports.py for the import-time budget of each command)
+
 app = typer.Typer()
 
+
+def load_datasets(in_dir: Path, subset_keys: list = None, cache_dir: Path = None) -> dict:
+
+    from ingest import load_dataset
+
+    # the paths of all datasets in the input directory, of which only the selected ones are read
+    data_paths = {file.stem: file for file in sorted(Path(in_dir).iterdir()) if file.is_file() and file.suffix == '.csv'}
+
+    ### Create smaller subset of datasets for testing ####################################################
+    if subset_keys is not None:
+        data_paths = {k: data_paths[k] for k in subset_keys if k in data_paths}
+
+    # only the columns the simulation uses, from the typed binary cache when the csv did not change
+    return {name: load_dataset(path, cache_dir) for name, path in data_paths.items()}
+
+
+def dataset_cache_dir(config: dict, out_dir: Path) -> Path:
+    # defaults to a cache in the output directory, like the abstract cache
+    return Path(config["dataset_cache_dir"]) if config.get("dataset_cache_dir") else out_dir / "dataset_cache"
+
+
+def llm_options_from_config(config: dict, n_workers: int, llm_backend: str = None) -> dict:
+
+    requests_per_second = config.get("llm_requests_per_second")
+
+    return {
+        "cache_mode": config.get("abstract_cache_mode"),
+        "cache_dir": Path(config["abstract_cache_dir"]) if config.get("abstract_cache_dir") else None,
+        "cache_max_age_days": config.get("abstract_cache_max_age_days"),
+        "max_concurrency": config.get("llm_max_concurrency"),
+        "requests_per_second": requests_per_second / n_workers if requests_per_second else None,  # rate limit is per worker process
+        "max_retries": config.get("llm_max_retries"),
+        "backend": llm_backend if llm_backend is not None else config.get("llm_backend"),
+        "replay_dir": Path(config["llm_replay_dir"]) if config.get("llm_replay_dir") else None,
+        "replay_fallback": config.get("llm_replay_fallback"),
+        "synthetic_seed": config.get("llm_synthetic_seed"),
+        "synthetic_latency": config.get("llm_synthetic_latency"),
+    }
+
+
+def evict_abstract_cache(config: dict, out_dir: Path) -> None:
+
+    # the abstract cache is kept within its size and age limits once at the end of a command, not after every cell
+    # (eviction reads the whole cache); out_dir is where the cache defaults to
+    max_size_mb, max_age_days = config.get("abstract_cache_max_mb"), config.get("abstract_cache_max_age_days")
+    if config.get("abstract_cache_mode") != "read_write" or (max_size_mb is None and max_age_days is None):
+        return
+
+    from abstract_cache import evict_cache
+
+    cache_dir = Path(config["abstract_cache_dir"]) if config.get("abstract_cache_dir") else out_dir / "llm_cache"
+    removed = evict_cache(cache_dir, max_size_mb=max_size_mb, max_age_days=max_age_days)
+    if removed:
+        print(f"Evicted {removed} abstracts from the cache in {cache_dir}")
+
+
+def simulation_options_from_config(config: dict, metadata, llm_options: dict) -> dict:
+
+    # settings of every cell of the sweep, passed on to simulation.run_simulation
+    stop_at_n = config.get("stop_at_n") # set to -1 to stop when all relevant records are found
+
+    return {
+        "criterium": config.get("stimulus_for_llm"),
+        "metadata": metadata,
+        "papers_screened": stop_at_n if stop_at_n != -1 else None,
+        "stop_at_n": stop_at_n,
+        "llm_options": llm_options,
+        "feature_store": Path(config["feature_store_dir"]) if config.get("feature_store_dir") else None,
+        "engine": config.get("al_engine"),
+        "feature_extractor": config.get("feature_extractor"),
+        "query_batch_size": config.get("query_batch_size"),
+        "output_format": config.get("output_format"),
+        "wss_threshold": config.get("wss_threshold"),
+        "recall_cutoffs": config.get("recall_cutoffs"),
+        "save_rankings": config.get("save_rankings"),
+    }
+
+
+def prepare_sweep(datasets: dict, out_dir: Path, config: dict) -> None:
+
+    from features import build_features
+    from simulation import FEATURE_KWARGS
+    from reference import write_random_reference, RANDOM_CONDITION_SUFFIX
+
+    # create output directories for each dataset
+    for dataset in datasets:
+        (out_dir / dataset).mkdir(parents=True, exist_ok=True)
+
+    # reference of screening each dataset in random order, computed instead of simulated (drawn in the aggregated recall
+    # plots): once for the whole dataset, and once without the relevant prior of the random condition (see priors.py)
+    for name, dataset in datasets.items():
+        for n_priors, suffix in [(0, ''), (1, RANDOM_CONDITION_SUFFIX)]:
+            write_random_reference(out_dir, name, dataset, config.get("stop_at_n"), method=config.get("random_reference"), wss_threshold=config.get("wss_threshold"),
+                                   recall_cutoffs=config.get("recall_cutoffs"), n_seeds=config.get("random_reference_seeds"),
+                                   n_priors=n_priors, n_relevant_priors=n_priors, suffix=suffix)
+
+    # Vectorize every dataset once up front, so all cells (and worker processes) share the stored features
+    if config.get("feature_store_dir"):
+        for name, dataset in datasets.items():
+            build_features(Path(config["feature_store_dir"]), name, dataset, FEATURE_KWARGS[config.get("feature_extractor")], config.get("feature_extractor"))
+
+
+def sweep_tasks(datasets: dict, config: dict) -> list:
+
+    from executor import build_tasks
+
+    # Generate all combinations of IVs
+    iv_combinations = list(itertools.product(
+        config.get("n_abstracts"),
+        config.get("length_abstracts"),
+        config.get("llm_temperature")
+    ))
+
+    # Every (run, IV combination, dataset) cell is an independent task
+    return build_tasks(list(datasets.keys()), iv_combinations, config.get("n_simulations"), share_baselines=config.get("share_baselines"))
+
+
 @app.command()
-def run(
+def simulate(
     
     in_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
                                   help="Folder containing datasets."),
@@ -19,27 +136,42 @@ def run(
                                   help="Root folder for all outputs."),
     criteria_path: Path = typer.Argument(..., exists=True, file_okay=True, dir_okay=False, readable=True,
                                   help="Path to criteria file for LLM."),
+    n_workers: int = typer.Option(None, "--n-workers", min=1,
+                                  help="Number of worker processes for the sweep (overrides n_workers in pyproject.toml)."),
+    resume: bool = typer.Option(False, "--resume",
+                                  help="Skip the cells of an interrupted sweep in out_dir that already finished (see manifest.json)."),
+    llm_backend: str = typer.Option(None, "--llm-backend",
+                                  help="Abstract generation backend: openai, replay or synthetic (overrides llm_backend in pyproject.toml)."),
+    adaptive: bool = typer.Option(None, "--adaptive/--fixed-replicates",
+                                  help="Add replicates until adaptive_target_se is reached, up to n_simulations (overrides adaptive_replication in pyproject.toml)."),
+    trace: bool = typer.Option(None, "--trace/--no-trace",
+                                  help="Write the time and memory of every stage of each run to <dataset>/traces, for the profile command (overrides trace_runs in pyproject.toml)."),
     #stimulus_for_llm: str = typer.Argument(..., help="Space-separated list of stimulus for LLM.")
 ):
   
+    import pandas as pd
+
+    from executor import run_sweep, run_adaptive_sweep
+    from scheduling import cell_conditions
+    from metrics import aggregate_recall_plots, summarise_results, render_recall_plots
+    from manifest import load_manifest
+
     ### LOAD CONFIG FROM TOML FILE ##########################################################################
     
     config = load_pyproject_config()
     
     #from simulation import pad_labels
-    stimulus_for_llm = config.get("stimulus_for_llm")
 
     # Parameters for running simulations
     n_simulations = config.get("n_simulations")
     stop_at_n = config.get("stop_at_n") # set to -1 to stop when all relevant records are found
     
-    # Parameters for simulation (IVs)
-    n_abstracts = config.get("n_abstracts")
-    length_abstracts = config.get("length_abstracts")
-    llm_temperature = config.get("llm_temperature")
+    # Parameters for execution
+    n_workers = n_workers if n_workers is not None else config.get("n_workers")
+    adaptive = adaptive if adaptive is not None else config.get("adaptive_replication")
 
-    # Parameters for evaluation (DVs)
-    papers_screened = stop_at_n if stop_at_n != -1 else None  
+    # Parameters for LLM abstract generation (passed on to prompting.generate_abstracts)
+    llm_options = llm_options_from_config(config, n_workers, llm_backend)
 
 
   
@@ -50,16 +182,7 @@ def run(
     # project_root = script_dir.parent
     # in_dir = project_root / in_dir
     
-    # import the paths of all files in the input directory
-    data_paths = [f for f in Path(in_dir).iterdir() if f.is_file()]
-    
-    # import all the of the datasets
-    datasets = {file.stem: pd.read_csv(file) for file in data_paths}
-
-    ### Create smaller subset of datasets for testing ####################################################
-    subset_keys = config.get("subset_datasets", None)
-    if subset_keys is not None:
-        datasets = {k: datasets[k] for k in subset_keys if k in datasets}
+    datasets = load_datasets(in_dir, config.get("subset_datasets", None), dataset_cache_dir(config, out_dir))
     
     print(f"Running simulations on datasets: {list(datasets.keys())}")
 
@@ -71,10 +194,8 @@ def run(
 
     ### CREATE OUTPUT DIRECTORIES ############################################################################
 
-    # create output directories for each dataset
-    for dataset in datasets:
-        (out_dir / dataset).mkdir(parents=True, exist_ok=True)
-        
+    # create output directories, the random screening reference and the stored features of each dataset
+    prepare_sweep(datasets, out_dir, config)
 
         
     # load synergy metadata (path relative to this script's location)
@@ -92,36 +213,57 @@ def run(
 
     ### SIMULATE AND EVALUATE ###############################################################################
     
-    # Generate all combinations of IVs
-    iv_combinations = list(itertools.product(
-        n_abstracts,
-        length_abstracts,
-        llm_temperature
-    ))
-    
-    print(f"Running {n_simulations} simulations for each of {len(iv_combinations)} IV combinations for {len(datasets)} datasets for all four conditions")
-    print(f"Total simulations: {n_simulations * len(iv_combinations) * len(datasets) * 4}")
-    
+    # Every (run, IV combination, dataset) cell of the sweep
+    tasks = sweep_tasks(datasets, config)
+    n_combinations = len({task['combo_idx'] for task in tasks})
+
+    print(f"Running {n_simulations} simulations for each of {n_combinations} IV combinations for {len(datasets)} datasets for all four conditions")
+    print(f"Total simulations: {sum(cell_conditions(task) for task in tasks)}" + (" (baselines shared across IV combinations)" if config.get("share_baselines") else ""))
     
-    for run in range(n_simulations):
-       
-        for combo_idx, (n_abs, len_abs, temp) in enumerate(iv_combinations):
-            print(f"\nIV Combination {combo_idx + 1}/{len(iv_combinations)}: "
-                f"n_abstracts={n_abs}, length={len_abs}, temperature={temp}."
-                f"From simulation {run + 1} of {n_simulations}.")
-        
-            run_simulation(
-                datasets=datasets,
-                criterium=stimulus_for_llm,
-                out_dir=out_dir,
-                metadata=synergy_metadata,
-                n_abstracts=n_abs,
-                length_abstracts=len_abs,
-                llm_temperature=temp,
-                papers_screened=papers_screened,
-                run=run * len(iv_combinations) + combo_idx + 1,  # global run counter starting from 1
-                stop_at_n=stop_at_n
-            )
+
+    sweep_kwargs = dict(
+        output_batch_size=config.get("output_batch_size"),
+        trace_runs=trace if trace is not None else config.get("trace_runs"),
+        **simulation_options_from_config(config, synergy_metadata, llm_options)
+    )
+
+    # sequential sampling: n_simulations is the maximum, replicates stop per dataset and IV combination once precise enough
+    if adaptive:
+        run_adaptive_sweep(
+            tasks=tasks,
+            datasets=datasets,
+            out_dir=out_dir,
+            n_workers=n_workers,
+            target_se=config.get("adaptive_target_se"),
+            min_simulations=config.get("adaptive_min_simulations"),
+            resume=resume,
+            **sweep_kwargs
+        )
+    else:
+        run_sweep(
+            tasks=tasks,
+            datasets=datasets,
+            out_dir=out_dir,
+            n_workers=n_workers,
+            resume=resume,
+            **sweep_kwargs
+        )
+
+    evict_abstract_cache(config, out_dir)
+
+    ############################################################################################################
+
+
+    ### RENDER RECALL PLOTS OF THE FINISHED CELLS ##############################################################
+
+    render_recall_plots(
+        out_dir=out_dir,
+        cells=list(load_manifest(out_dir).values()),
+        stop_at_n=stop_at_n,
+        policy=config.get("plot_policy"),
+        sample_size=config.get("plot_sample_size"),
+        n_workers=n_workers
+    )
 
     ############################################################################################################
 
@@ -131,12 +273,310 @@ def run(
     aggregate_recall_plots(
         datasets=datasets, 
         out_dir=out_dir, 
-        stop_at_n=stop_at_n
+        stop_at_n=stop_at_n,
+        by_ivs=config.get("aggregate_by_ivs")
     )
+
+    summarise_results(out_dir, output_format=config.get("output_format"))
     
     ############################################################################################################
 
     return
 
+
+# the sweep command was called run before, kept so existing scripts keep working
+app.command("run", hidden=True)(simulate)
+
+
+@app.command()
+def enqueue(
+
+    in_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Folder containing datasets."),
+    out_dir: Path = typer.Argument(..., exists=False, file_okay=False, dir_okay=True, readable=True,
+                                  help="Root folder for all outputs, on storage shared by all workers."),
+):
+
+    from manifest import load_manifest, is_complete, cell_key
+    from scheduling import CostModel, dataset_sizes, cell_group
+    from work_queue import queue_path, enqueue_cells, queue_status
+
+    # puts every cell of the sweep in the work queue of out_dir, for workers on any number of hosts (see the work command);
+    # cells that already finished in out_dir are enqueued as done
+    config = load_pyproject_config()
+
+    datasets = load_datasets(in_dir, config.get("subset_datasets", None), dataset_cache_dir(config, out_dir))
+    prepare_sweep(datasets, out_dir, config)
+
+    tasks = sweep_tasks(datasets, config)
+    manifest = load_manifest(out_dir)
+    done_keys = {cell_key(task) for task in tasks if is_complete(out_dir, manifest, task)}
+
+    # every cell is enqueued with its estimated cost, so that workers claim the longest cells first
+    model = CostModel(dataset_sizes(datasets), config.get("stop_at_n"), config.get("query_batch_size"))
+    n_added = enqueue_cells(queue_path(out_dir), tasks, [model.units(*cell_group(task)) for task in tasks], done_keys)
+    counts = queue_status(queue_path(out_dir), config.get("queue_max_attempts"))
+
+    print(f"Enqueued {n_added} new cells of {len(datasets)} datasets in {queue_path(out_dir)}: "
+          + ", ".join(f"{n} {status}" for status, n in counts.items()))
+
+
+@app.command()
+def work(
+
+    in_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Folder containing datasets."),
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder with the work queue (see the enqueue command)."),
+    criteria_path: Path = typer.Argument(..., exists=True, file_okay=True, dir_okay=False, readable=True,
+                                  help="Path to criteria file for LLM."),
+    worker_id: str = typer.Option(None, "--worker-id",
+                                  help="Name of this worker and its shard (defaults to <host>-<pid>)."),
+    llm_backend: str = typer.Option(None, "--llm-backend",
+                                  help="Abstract generation backend: openai, replay or synthetic (overrides llm_backend in pyproject.toml)."),
+    trace: bool = typer.Option(None, "--trace/--no-trace",
+                                  help="Write the time and memory of every stage of each run to <dataset>/traces, for the profile command (overrides trace_runs in pyproject.toml)."),
+):
+
+    import pandas as pd
+
+    from executor import run_worker
+    from work_queue import queue_path, default_worker_id, shard_dir
+
+    # claims cells from the work queue until none are left; start one worker per core on every host
+    config = load_pyproject_config()
+
+    if not queue_path(out_dir).exists():
+        print(f"No work queue in {out_dir}, create it with the enqueue command first.")
+        raise typer.Exit(code=1)
+
+    # the LLM rate limit is shared by n_workers worker processes over all hosts; abstracts are replayed from out_dir, not the shard
+    llm_options = llm_options_from_config(config, config.get("n_workers"), llm_backend)
+    llm_options["replay_dir"] = llm_options["replay_dir"] or out_dir
+
+    datasets = load_datasets(in_dir, config.get("subset_datasets", None), dataset_cache_dir(config, out_dir))
+
+    worker_id = worker_id or default_worker_id()
+    run_worker(
+        datasets=datasets,
+        out_dir=out_dir,
+        worker=worker_id,
+        lease_seconds=config.get("queue_lease_minutes") * 60,
+        max_attempts=config.get("queue_max_attempts"),
+        trace_runs=trace if trace is not None else config.get("trace_runs"),
+        **simulation_options_from_config(config, pd.read_excel(criteria_path), llm_options)
+    )
+
+    # the abstracts of a worker are cached in its shard unless abstract_cache_dir is set
+    evict_abstract_cache(config, shard_dir(out_dir, worker_id))
+
+
+@app.command()
+def merge(
+
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder of a distributed sweep."),
+):
+
+    from work_queue import queue_path, queue_status, active_workers, merge_shards
+
+    # moves the outputs of the worker shards into out_dir and combines their metrics rows and manifests, so that the
+    # plot, aggregate, evaluate and profile commands (and simulate --resume) see one output folder
+    config = load_pyproject_config()
+
+    running = active_workers(queue_path(out_dir)) if queue_path(out_dir).exists() else set()
+    if running:
+        print(f"Skipping the shards of {len(running)} workers that are still running a cell: {', '.join(sorted(running))}")
+
+    n_merged = merge_shards(out_dir, output_format=config.get("output_format"), skip_workers=running)
+    print(f"Merged {n_merged} worker shards into {out_dir}")
+
+    if queue_path(out_dir).exists():
+        counts = queue_status(queue_path(out_dir), config.get("queue_max_attempts"))
+        print("Work queue: " + ", ".join(f"{n} {status}" for status, n in counts.items()))
+
+
+@app.command()
+def generate(
+
+    in_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Folder containing datasets."),
+    out_dir: Path = typer.Argument(..., exists=False, file_okay=False, dir_okay=True, readable=True,
+                                  help="Root folder for all outputs."),
+    criteria_path: Path = typer.Argument(..., exists=True, file_okay=True, dir_okay=False, readable=True,
+                                  help="Path to criteria file for LLM."),
+    llm_backend: str = typer.Option(None, "--llm-backend",
+                                  help="Abstract generation backend: openai, replay or synthetic (overrides llm_backend in pyproject.toml)."),
+):
+
+    import pandas as pd
+
+    from stimulus import select_criteria
+    from prompting import generate_abstracts
+
+    # generates the LLM abstracts of every cell of the sweep without simulating, written to
+    # <out_dir>/<dataset>/llm_abstracts (and the abstract cache), so that simulate can replay them later
+    config = load_pyproject_config()
+
+    llm_options = llm_options_from_config(config, 1, llm_backend)
+    datasets = load_datasets(in_dir, config.get("subset_datasets", None), dataset_cache_dir(config, out_dir))
+    synergy_metadata = pd.read_excel(criteria_path)
+
+    tasks = sweep_tasks(datasets, config)
+
+    print(f"Generating abstracts for {len(tasks)} cells of {len(datasets)} datasets")
+
+    for i, task in enumerate(tasks):
+
+        stimuli = select_criteria(task['dataset'], config.get("stimulus_for_llm"), synergy_metadata)
+        if not stimuli:
+            print(f"Skipping dataset {task['dataset']}: not in the criteria file")
+            continue
+
+        print(f"Cell {i + 1}/{len(tasks)}: dataset={task['dataset']}, run {task['run']}")
+        generate_abstracts(name=task['dataset'], stimulus=stimuli, out_dir=out_dir, n_abstracts=task['n_abstracts'], length_abstracts=task['length_abstracts'], llm_temperature=task['llm_temperature'], run=task['run'], replicate=task['replicate'], **llm_options)
+
+    evict_abstract_cache(config, out_dir)
+
+    return
+
+
+@app.command()
+def aggregate(
+
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder of a finished or running sweep."),
+):
+
+    from metrics import aggregate_recall_plots, summarise_results
+    from storage import simulated_datasets
+
+    # folds the raw simulations added since the last call into the aggregated recall curves, and refreshes
+    # the aggregated plots and summary tables (settings are read from pyproject.toml, as for simulate)
+    config = load_pyproject_config()
+
+    aggregate_recall_plots(
+        datasets=simulated_datasets(out_dir),
+        out_dir=out_dir,
+        stop_at_n=config.get("stop_at_n"),
+        by_ivs=config.get("aggregate_by_ivs")
+    )
+
+    summarise_results(out_dir, output_format=config.get("output_format"))
+
+    return
+
+
+@app.command()
+def plot(
+
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder of a finished or running sweep."),
+    policy: str = typer.Option(None, "--policy",
+                                  help="Recall plots to render: none, sample or all (overrides plot_policy in pyproject.toml)."),
+    n_workers: int = typer.Option(None, "--n-workers", min=1,
+                                  help="Number of worker processes for rendering (overrides n_workers in pyproject.toml)."),
+):
+
+    from metrics import render_recall_plots
+    from manifest import load_manifest
+
+    # renders the missing recall plots of the cells finished so far (see manifest.json)
+    config = load_pyproject_config()
+
+    render_recall_plots(
+        out_dir=out_dir,
+        cells=list(load_manifest(out_dir).values()),
+        stop_at_n=config.get("stop_at_n"),
+        policy=policy if policy is not None else config.get("plot_policy"),
+        sample_size=config.get("plot_sample_size"),
+        n_workers=n_workers if n_workers is not None else config.get("n_workers")
+    )
+
+    return
+
+@app.command()
+def evaluate(
+
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder of a sweep run with save_rankings = true."),
+    stop_at_n: int = typer.Option(None, "--stop-at-n",
+                                  help="Screened records to evaluate (-1 for all of them, defaults to stop_at_n in pyproject.toml)."),
+    wss_threshold: float = typer.Option(None, "--wss-threshold",
+                                  help="Recall level of the WSS metric (defaults to wss_threshold in pyproject.toml)."),
+    recall_cutoffs: List[int] = typer.Option(None, "--recall-cutoff",
+                                  help="Screened records at which recall is reported, can be repeated (defaults to recall_cutoffs in pyproject.toml)."),
+):
+
+    from metrics import evaluate_rankings
+
+    # recomputes the outcome metrics of every stored ranking at the given threshold, without simulating again
+    config = load_pyproject_config()
+
+    stop_at_n = stop_at_n if stop_at_n is not None else config.get("stop_at_n")
+    wss_threshold = wss_threshold if wss_threshold is not None else config.get("wss_threshold")
+    recall_cutoffs = recall_cutoffs if recall_cutoffs else config.get("recall_cutoffs")
+
+    df_results, n_skipped = evaluate_rankings(out_dir, stop_at_n, wss_threshold=wss_threshold, recall_cutoffs=recall_cutoffs)
+
+    if df_results.empty and n_skipped:
+        print(f"None of the {n_skipped} stored rankings reached stop_at_n = {stop_at_n}, their runs stopped earlier (evaluate at a lower stop_at_n, or simulate again with a higher one).")
+        return
+
+    if df_results.empty:
+        print(f"No stored rankings in {out_dir} (rankings are kept when the sweep runs with save_rankings = true in pyproject.toml).")
+        return
+
+    if n_skipped:
+        print(f"Skipped {n_skipped} rankings of runs that stopped before {stop_at_n} screened records")
+
+    evaluations_dir = out_dir / 'evaluations'
+    evaluations_dir.mkdir(parents=True, exist_ok=True)
+    results_path = evaluations_dir / f'metrics_stop_at_{stop_at_n if stop_at_n != -1 else "all"}.csv'
+    df_results.to_csv(results_path, index=False)
+
+    print(f"Evaluated {df_results.groupby(['dataset', 'condition', 'run']).ngroups} simulations, metrics written to {results_path}")
+
+    return
+
+@app.command()
+def profile(
+
+    out_dir: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, readable=True,
+                                  help="Output folder of a sweep run with --trace or trace_runs = true."),
+):
+
+    import pandas as pd
+    from instrument import summarise_traces
+
+    # where the time and memory of the traced runs went, per dataset, stage and condition
+    df_stages, df_requests, df_fallbacks = summarise_traces(out_dir)
+
+    if df_stages is None:
+        print(f"No run traces in {out_dir} (runs are traced when the sweep runs with --trace, or trace_runs = true in pyproject.toml).")
+        return
+
+    df_stages.to_csv(out_dir / 'trace_summary.csv', index=False)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        for name, df_dataset in df_stages.groupby('dataset', sort=False):
+            print(f"\n{name}: {df_dataset.loc[df_dataset['stage'] == 'run', 'n'].sum()} runs")
+            print(df_dataset.drop(columns='dataset').sort_values('seconds', ascending=False).to_string(index=False))
+
+        if df_requests is not None:
+            df_requests.to_csv(out_dir / 'trace_llm_requests.csv', index=False)
+            print("\nLLM requests")
+            print(df_requests.to_string(index=False))
+
+        # with llm_replay_fallback, these runs share their LLM priors with the run they replayed
+        if df_fallbacks is not None:
+            df_fallbacks.to_csv(out_dir / 'trace_replay_fallbacks.csv', index=False)
+            print("\nRuns that replayed the abstracts of another run")
+            print(df_fallbacks.to_string(index=False))
+
+    print(f"\nSummary written to {out_dir / 'trace_summary.csv'}")
+
+    return
+
 if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -0,0 +1,147 @@
+from pathlib import Path
+import pandas as pd
+
+from instrument import read_traces
+
+
+### Size-aware scheduling of the cells of a sweep ###
+
+# The longest cells are started first, so that a sweep does not end with one worker finishing a large dataset while
+# the others are idle. The cost of a cell is estimated from its dataset: every condition it simulates retrains and
+# ranks all records of the dataset after every query, until stop_at_n records are screened (or, with stop_at_n = -1,
+# until the last relevant record, at n_relevant (n_records + 1) / (n_relevant + 1) on average in random order).
+# These units are turned into seconds by the wall-clock time of the finished cells of the same dataset (or of all
+# datasets, for a dataset without finished cells), including the traced runs of earlier sweeps in the output folder.
+
+# conditions simulated by a cell, and by a cell that reuses the shared baselines of its replicate
+N_CONDITIONS = 4
+
+
+def screened_records(n_records: int, n_relevant: int, stop_at_n: int) -> float:
+
+    if stop_at_n == -1:
+        return n_relevant * (n_records + 1) / (n_relevant + 1)
+
+    return min(stop_at_n, n_records)
+
+
+def cell_conditions(task: dict) -> int:
+    return 1 if task['baseline_run'] not in (None, task['run']) else N_CONDITIONS
+
+
+def cell_group(task: dict) -> tuple:
+
+    # all cells of a group have the same estimated cost
+    return task['dataset'], cell_conditions(task)
+
+
+def dataset_sizes(datasets: dict) -> dict:
+    return {name: (len(dataset), int(dataset["label_included"].sum())) for name, dataset in datasets.items()}
+
+
+class CostModel:
+    """Estimated seconds per cell from the size of its dataset, refined with the wall-clock time of finished cells."""
+
+    def __init__(self, sizes: dict, stop_at_n: int, query_batch_size: int = 1):
+        self.sizes = sizes
+        self.stop_at_n = stop_at_n
+        self.query_batch_size = query_batch_size
+        self.observed = {}  # dataset -> [units, seconds] of its finished cells
+        self.total = [0.0, 0.0]
+
+    def units(self, name: str, n_conditions: int = N_CONDITIONS) -> float:
+        n_records, n_relevant = self.sizes[name]
+        return n_conditions * n_records * max(screened_records(n_records, n_relevant, self.stop_at_n) / self.query_batch_size, 1)
+
+    def observe(self, name: str, n_conditions: int, seconds: float) -> None:
+        units = self.units(name, n_conditions)
+        observed = self.observed.setdefault(name, [0.0, 0.0])
+        for totals in (observed, self.total):
+            totals[0] += units
+            totals[1] += seconds
+
+    def observe_traces(self, out_dir: Path) -> int:
+
+        # the 'run' stage of every traced cell in out_dir, with the number of conditions it simulated itself
+        traces = read_traces(out_dir)
+        if traces.empty:
+            return 0
+
+        cells = ['dataset', 'run', 'n_abstracts', 'length_abstracts', 'llm_temperature']
+        runs = traces[(traces['stage'] == 'run') & traces['dataset'].isin(self.sizes.keys())].set_index(cells)['seconds']
+        conditions = traces[traces['stage'] == 'simulate'].groupby(cells).size().reindex(runs.index, fill_value=N_CONDITIONS)
+
+        for (name, *_), seconds, n_conditions in zip(runs.index, runs, conditions):
+            self.observe(name, max(int(n_conditions), 1), seconds)
+
+        return len(runs)
+
+    def rate(self, name: str) -> float:
+
+        # seconds per unit of the dataset, or of all datasets while it has no finished cells (None before any cell finished)
+        units, seconds = self.observed.get(name, self.total)
+        if units == 0:
+            units, seconds = self.total
+
+        return seconds / units if units > 0 else None
+
+    def estimate(self, name: str, n_conditions: int = N_CONDITIONS) -> float:
+
+        # seconds, or units before any cell finished (enough to order the cells)
+        rate = self.rate(name)
+        return self.units(name, n_conditions) * rate if rate is not None else self.units(name, n_conditions)
+
+    def projection(self, waiting: dict, running: list, n_workers: int) -> float:
+
+        # seconds until the sweep is done: the work left spread over the workers, but at least the longest cell left;
+        # waiting holds the number of cells per group, running (task, seconds it has been running) per running cell
+        if self.total[0] == 0:
+            return None
+
+        left = [self.estimate(*group) for group, n_cells in waiting.items() if n_cells > 0]
+        total = sum(self.estimate(*group) * n_cells for group, n_cells in waiting.items())
+
+        for task, elapsed in running:
+            left.append(max(self.estimate(*cell_group(task)) - elapsed, 0.0))
+            total += left[-1]
+
+        return max(total / max(n_workers, 1), max(left)) if left else 0.0
+
+
+
+### Longest cell first ###
+
+def group_cells(tasks: list) -> dict:
+
+    # cells per group, in grid order
+    groups = {}
+    for task in tasks:
+        groups.setdefault(cell_group(task), []).append(task)
+
+    return groups
+
+
+def pop_longest(groups: dict, model: CostModel, can_start=lambda task: True) -> dict:
+
+    # the first cell that can start of the group with the longest estimated cells (with the estimates of now)
+    best = None
+
+    for group, cells in groups.items():
+        index = next((i for i, task in enumerate(cells) if can_start(task)), None)
+        if index is not None and (best is None or model.estimate(*group) > best[0]):
+            best = (model.estimate(*group), group, index)
+
+    if best is None:
+        return None
+
+    _, group, index = best
+    return groups[group].pop(index)
+
+
+def format_projection(seconds: float) -> str:
+
+    if seconds is None:
+        return "projected completion after the first cell"
+
+    finish = pd.Timestamp.now() + pd.Timedelta(seconds=seconds)
+    return f"projected completion at {finish:%Y-%m-%d %H:%M} ({seconds / 60:.1f} min left)"
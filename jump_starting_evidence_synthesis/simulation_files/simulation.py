@@ -1,144 +1,254 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
 import asreview
 from asreview.models.balancers import Balanced
 from asreview.models.classifiers import SVM
-from asreview.models.feature_extractors import Tfidf
 from asreview.models.queriers import Random, Max
 from asreview.models.stoppers import IsFittable
 from asreview.models.stoppers import NLabeled
 
 from priors import sample_priors
 from llm import prepare_datasets
-from metrics import evaluate_simulation
+from metrics import evaluate_simulation, screening_pools
+from features import FEATURE_EXTRACTORS, StackedFeatures, load_features, augment_features, fit_features, make_vectorizer
+from engine import ENGINES, simulate_native
+from instrument import stage
+from storage import OUTPUT_FORMATS, RAW_DTYPES, BASELINE_CONDITIONS, compact, write_table, read_table, raw_simulation_paths, ranking_paths, write_ranking
 
 
+TFIDF_KWARGS = {
+    "ngram_range": (1, 2),
+    "sublinear_tf": True,
+    "max_df": 0.95,
+    "min_df": 1,
+}
 
-def run_simulation(datasets: dict, criterium: list, out_dir: Path, metadata: pd.ExcelFile, n_abstracts: int, length_abstracts: int, llm_temperature: float, papers_screened: int, run: int, stop_at_n: int) -> dict:
+# same word n-grams and term frequency weighting as TFIDF_KWARGS, hashed into a fixed number of features
+HASHING_KWARGS = {
+    "ngram_range": (1, 2),
+    "sublinear_tf": True,
+    "n_features": 2 ** 20,
+}
+
+FEATURE_KWARGS = {"tfidf": TFIDF_KWARGS, "hashing": HASHING_KWARGS}
+
+
+
+class RowRandom(Random):
+    """Random querier that ranks the rows of any input, including sparse feature matrices from the feature store."""
+
+    def query(self, p):
+        return super().query(np.arange(p.shape[0]))
+
+
+
+def make_cycles(seed: int, n_stop: int, query_batch_size: int = 1, feature_extractor: str = "tfidf") -> list:
+
+    # retrain after every query_batch_size records, without screening past n_stop
+    n_query = query_batch_size if n_stop == -1 else (lambda results: max(1, min(query_batch_size, n_stop - len(results))))
+
+    return [
+        asreview.ActiveLearningCycle(
+            querier=RowRandom(random_state=seed),
+            stopper=IsFittable()),
+        asreview.ActiveLearningCycle(
+            querier=Max(),
+            classifier=SVM(C=0.11, loss="squared_hinge", random_state=seed),
+            balancer=Balanced(ratio=9.8),
+            feature_extractor=make_vectorizer(feature_extractor, FEATURE_KWARGS[feature_extractor]),
+            stopper=NLabeled(n_stop),
+            n_query=n_query
+        )
+    ]
+
+
+
+def simulate(X, labels, prior_idx, seed: int, n_stop: int, skip_transform: bool = False, engine: str = "asreview", query_batch_size: int = 1, feature_extractor: str = "tfidf") -> pd.DataFrame:
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown active learning engine '{engine}', expected one of {ENGINES}.")
+
+    # native engine: same cycles on the feature matrix, computed here unless it was computed up front
+    if engine == "native":
+        features = X if skip_transform else make_vectorizer(feature_extractor, FEATURE_KWARGS[feature_extractor]).fit_transform(X)
+        return simulate_native(features, labels, prior_idx, seed=seed, n_stop=n_stop, feature_extractor=feature_extractor, n_query=query_batch_size)
+
+    # asreview screens one matrix: the stored features and any prior rows are stacked into a copy (without prior rows,
+    # the stored matrix is used as it is)
+    if isinstance(X, StackedFeatures):
+        X = X.tocsr()
+
+    sim = asreview.Simulate(X=X, labels=labels, cycles=make_cycles(seed=seed, n_stop=n_stop, query_batch_size=query_batch_size, feature_extractor=feature_extractor), skip_transform=skip_transform)
+    if len(prior_idx) > 0:
+        sim.label(prior_idx)
+    sim.review()
+
+    return sim._results
+
+
+
+def run_simulation(datasets: dict, criterium: list, out_dir: Path, metadata: pd.ExcelFile, n_abstracts: int, length_abstracts: int, llm_temperature: float, papers_screened: int, run: int, replicate: int, stop_at_n: int, write_results: bool = True, llm_options: dict = None, baseline_run: int = None, feature_store: Path = None, engine: str = "asreview", query_batch_size: int = 1, output_format: str = "csv", wss_threshold: float = 0.95, recall_cutoffs: list = (25, 50, 100), save_rankings: bool = False, feature_extractor: str = "tfidf") -> dict:
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}.")
+
+    if feature_extractor not in FEATURE_EXTRACTORS:
+        raise ValueError(f"Unknown feature extractor '{feature_extractor}', expected one of {FEATURE_EXTRACTORS}.")
+
+    # metrics rows per dataset, returned so that a parallel sweep can write them from one process
+    results_rows = {}
 
     for dataset_names in datasets.keys():
-        
+
         ### PREPARE SIMULATION DATA ###################################################################################
-        
+
         # Clear dictionary for each dataset
         simulation_results = {}
-        
+
         # Generate LLM priors and add them to dataset
         print(f"Generating LLM priors for dataset: {dataset_names}")
-        dataset_llm, dataset_criteria = prepare_datasets(datasets[dataset_names], name=dataset_names, criterium=criterium, out_dir=out_dir, metadata=metadata, n_abstracts=n_abstracts, length_abstracts=length_abstracts, llm_temperature=llm_temperature, run=run) # Generate abstracts and add them to datasets
+        with stage('prepare_datasets'):
+            dataset_llm, dataset_criteria = prepare_datasets(datasets[dataset_names], name=dataset_names, criterium=criterium, out_dir=out_dir, metadata=metadata, n_abstracts=n_abstracts, length_abstracts=length_abstracts, llm_temperature=llm_temperature, run=run, replicate=replicate, llm_options=llm_options) # Generate abstracts and add them to datasets
+
+        # Seed of the IV-independent conditions: the run itself, or the replicate's shared baseline run
+        seed_baselines = run if baseline_run is None else baseline_run
 
         # Sample priors for random initialization condition
-        prior_idx = sample_priors(datasets[dataset_names], seed = run) 
+        prior_idx = sample_priors(datasets[dataset_names], seed = seed_baselines)
 
         ###############################################################################################################
-        
-        
-        
-        
+
+
+
+
 
         ### SET UP ACTIVE LEARNING CYCLES #############################################################################
 
-        tfidf_kwargs = {
-        "ngram_range": (1, 2),
-        "sublinear_tf": True,
-        "max_df": 0.95,
-        "min_df": 1,
-        }
+        # -1 runs every simulation to completion (until all relevant records are found)
+        n_stop = stop_at_n + len(dataset_criteria['prior_idx']) if stop_at_n != -1 else -1
+
+        # Input of each simulation: TF-IDF features of the datasets with priors, fitted on the augmented view (or the
+        # stored base features with the prior rows transformed from the feature store), and the dataset itself
+        X_base = datasets[dataset_names]
+
+        with stage('features', feature_extractor=feature_extractor):
+            if feature_store is not None:
+                X_base, vectorizer = load_features(feature_store, dataset_names, datasets[dataset_names], FEATURE_KWARGS[feature_extractor], feature_extractor)
+                X_llm = augment_features(X_base, vectorizer, dataset_llm['dataset'].overlay)
+                X_criteria = augment_features(X_base, vectorizer, dataset_criteria['dataset'].overlay)
+            elif feature_extractor == "hashing":
+                # stateless: the dataset is hashed once for all four conditions, and the priors are hashed on their own
+                vectorizer = make_vectorizer(feature_extractor, HASHING_KWARGS)
+                X_base = vectorizer.transform(datasets[dataset_names])
+                X_llm = augment_features(X_base, vectorizer, dataset_llm['dataset'].overlay)
+                X_criteria = augment_features(X_base, vectorizer, dataset_criteria['dataset'].overlay)
+            else:
+                X_llm = fit_features(dataset_llm['dataset'], TFIDF_KWARGS)
+                X_criteria = fit_features(dataset_criteria['dataset'], TFIDF_KWARGS)
+
+        skip_transform = feature_store is not None or feature_extractor == "hashing"
 
-        alc = [
-            asreview.ActiveLearningCycle(
-                querier=Random(random_state=run), 
-                stopper=IsFittable()),
-            asreview.ActiveLearningCycle(
-                querier=Max(),
-                classifier=SVM(C=0.11, loss="squared_hinge", random_state=run),
-                balancer=Balanced(ratio=9.8),
-                feature_extractor=Tfidf(**tfidf_kwargs),
-                stopper=NLabeled(stop_at_n + len(dataset_criteria['prior_idx']))
-            )
-        ]
-        
         ###############################################################################################################
-        
-        
-        
-        
-        
-        
+
+
+
+
+
+
         ### RUN SIMULATION ############################################################################################
 
+        # Baselines shared by all IV combinations of a replicate are stored once, under the shared baseline run
+        raw_paths = raw_simulation_paths(out_dir, dataset_names, run, baseline_run, n_abstracts, length_abstracts, llm_temperature, output_format)
+        shared_paths = {condition: raw_paths[condition] for condition in BASELINE_CONDITIONS} if baseline_run is not None else {}
+
         print(f"Running simulations for dataset: {dataset_names}")
-        
+
         # Run simulation with LLM priors
-        simulate_llm = asreview.Simulate(X=dataset_llm['dataset'], labels=dataset_llm['dataset']["label_included"], cycles=alc)
-        simulate_llm.label(dataset_llm['prior_idx'])
-        simulate_llm.review()
-
-        # Run simulation with criteria as priors
-        simulate_criteria = asreview.Simulate(X=dataset_criteria['dataset'], labels=dataset_criteria['dataset']["label_included"], cycles=alc)
-        simulate_criteria.label(dataset_criteria['prior_idx'])
-        simulate_criteria.review()
-
-        # Run simulation without priors (random start)
-        simulate_no_initialisation = asreview.Simulate(X=datasets[dataset_names], labels=datasets[dataset_names]["label_included"], cycles=alc)
-        simulate_no_initialisation.review()
-        
-        # Run simulation with random initialization (one relevant and one irrelevant prior)
-        simulate_random = asreview.Simulate(X=datasets[dataset_names], labels=datasets[dataset_names]["label_included"], cycles=alc)
-        simulate_random.label([prior_idx])
-        simulate_random.review()
-        
+        with stage('simulate', condition='llm'):
+            raw_results = {'llm': simulate(X_llm, dataset_llm['dataset'].labels, dataset_llm['prior_idx'], seed=run, n_stop=n_stop, skip_transform=True, engine=engine, query_batch_size=query_batch_size, feature_extractor=feature_extractor)}
+
+        if shared_paths and all(path.exists() for path in shared_paths.values()):
+
+            # Reuse the baselines an earlier IV combination of this replicate already simulated
+            print(f"Reusing baseline simulations of run {baseline_run} for dataset: {dataset_names}")
+            for condition, path in shared_paths.items():
+                with stage('read_baseline', condition=condition):
+                    raw_results[condition] = read_table(path)
+
+        else:
+
+            # Run simulation with criteria as priors
+            with stage('simulate', condition='criteria'):
+                raw_results['criteria'] = simulate(X_criteria, dataset_criteria['dataset'].labels, dataset_criteria['prior_idx'], seed=seed_baselines, n_stop=n_stop, skip_transform=True, engine=engine, query_batch_size=query_batch_size, feature_extractor=feature_extractor)
+
+            # Run simulation without priors (random start)
+            with stage('simulate', condition='no_initialisation'):
+                raw_results['no_initialisation'] = simulate(X_base, datasets[dataset_names]["label_included"], [], seed=seed_baselines, n_stop=n_stop, skip_transform=skip_transform, engine=engine, query_batch_size=query_batch_size, feature_extractor=feature_extractor)
+
+            # Run simulation with random initialization (one relevant and one irrelevant prior)
+            with stage('simulate', condition='random'):
+                raw_results['random'] = simulate(X_base, datasets[dataset_names]["label_included"], [prior_idx], seed=seed_baselines, n_stop=n_stop, skip_transform=skip_transform, engine=engine, query_batch_size=query_batch_size, feature_extractor=feature_extractor)
+
         ###############################################################################################################
-    
-    
-    
-        
-        
+
+
+
+
+
         ### SAVE SIMULATION RESULTS ####################################################################################
-        
-        # Create raw_simulations directory if it doesn't exist
-        raw_sim_dir = out_dir / dataset_names / 'raw_simulations'
-        raw_sim_dir.mkdir(parents=True, exist_ok=True)
-        
-        #save all results to csv files
-        for sim, condition in zip([simulate_random, simulate_llm, simulate_criteria, simulate_no_initialisation], ['random', 'llm', 'criteria', 'no_initialisation']):
-            sim._results.to_csv(raw_sim_dir / f'{condition}_run_{run}_IVs_{n_abstracts}_{length_abstracts}_{llm_temperature}.csv', index=False)
-        
-        # This line drops priors. To access the dataframe before this, just use simulate._results
-        df_results_random = simulate_random._results.dropna(axis=0, subset="training_set")
-        df_results_llm = simulate_llm._results.dropna(axis=0, subset="training_set")
-        df_results_criteria = simulate_criteria._results.dropna(axis=0, subset="training_set")
-        df_results_no_initialisation = simulate_no_initialisation._results.dropna(axis=0, subset="training_set")
 
+        #save all results to csv or parquet files (shared baselines only once)
+        for condition in ['random', 'llm', 'criteria', 'no_initialisation']:
+            if condition not in shared_paths or not shared_paths[condition].exists():
+                with stage('write_raw', condition=condition):
+                    write_table(compact(raw_results[condition], RAW_DTYPES) if output_format == "parquet" else raw_results[condition], raw_paths[condition])
+
+        # This line drops priors. To access the dataframe before this, just use raw_results
         simulation_results[dataset_names] = {
-            'random': df_results_random,
-            'llm': df_results_llm,
-            'criteria': df_results_criteria,
-            'no_initialisation': df_results_no_initialisation
+            condition: raw_results[condition].dropna(axis=0, subset="training_set")
+            for condition in ['random', 'llm', 'criteria', 'no_initialisation']
         }
-        
+
+        # keep the full screening order of every simulation, so metrics can be recomputed later with the evaluate command
+        if save_rankings:
+            paths = ranking_paths(out_dir, dataset_names, run, baseline_run, n_abstracts, length_abstracts, llm_temperature)
+            n_records, n_relevant = screening_pools(datasets[dataset_names], dataset_llm, dataset_criteria, prior_idx)
+            for condition, n_pool, n_pool_relevant in zip(['random', 'llm', 'criteria', 'no_initialisation'], n_records, n_relevant):
+                if condition not in shared_paths or not paths[condition].exists():
+                    screened = simulation_results[dataset_names][condition]
+                    with stage('write_ranking', condition=condition):
+                        write_ranking(paths[condition], screened["record_id"].to_numpy(), screened["label"].to_numpy(), n_pool, n_pool_relevant, stop_at_n, query_batch_size)
+
         #################################################################################################################
-        
-        
-        
-        
-        
+
+
+
+
+
         ### EVALUATE SIMULATION RUN #####################################################################################
-        
-        evaluate_simulation(simulation_results, 
-                            datasets[dataset_names], 
-                            dataset_llm, 
-                            dataset_criteria, 
-                            prior_idx, 
-                            n_abstracts=n_abstracts, 
-                            length_abstracts=length_abstracts, 
-                            llm_temperature=llm_temperature, 
-                            papers_screened=papers_screened, 
-                            out_dir=out_dir, 
-                            run=run, 
-                            stop_at_n=stop_at_n)
+
+        with stage('evaluate_simulation'):
+            results_rows[dataset_names] = evaluate_simulation(simulation_results,
+                                datasets[dataset_names],
+                                dataset_llm,
+                                dataset_criteria,
+                                prior_idx,
+                                n_abstracts=n_abstracts,
+                                length_abstracts=length_abstracts,
+                                llm_temperature=llm_temperature,
+                                papers_screened=papers_screened,
+                                out_dir=out_dir,
+                                run=run,
+                                stop_at_n=stop_at_n,
+                                write_results=write_results,
+                                baseline_run=seed_baselines,
+                                query_batch_size=query_batch_size,
+                                output_format=output_format,
+                                wss_threshold=wss_threshold,
+                                recall_cutoffs=recall_cutoffs)
 
         #################################################################################################################
-        
-    return
\ No newline at end of file
+
+    return results_rows
@@ -0,0 +1,298 @@
+from pathlib import Path
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+
+
+### Output backends ###
+
+# csv: one csv per raw simulation under <out_dir>/<dataset>/raw_simulations and one appended master csv (original layout).
+# parquet: raw simulations partitioned as <out_dir>/raw_simulations/dataset=<name>/condition=<condition>/run=<run>/,
+# and master results written in batches as part files under <out_dir>/all_simulation_results/, both with compact
+# dtypes. Both layouts can be read with pd.read_parquet or arrow::open_dataset in R.
+
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# conditions that do not depend on n_abstracts, length_abstracts or llm_temperature
+BASELINE_CONDITIONS = ['random', 'criteria', 'no_initialisation']
+
+RAW_FILE_PATTERN = re.compile(r'^(?P<condition>random|llm|criteria|no_initialisation)_run_(?P<run>\d+)_IVs_(?P<ivs>.+)\.csv$')
+
+RANKING_FILE_PATTERN = re.compile(r'^(?P<condition>random|llm|criteria|no_initialisation)_run_(?P<run>\d+)_IVs_(?P<ivs>.+)\.npz$')
+
+RAW_DTYPES = {
+    "record_id": "int32",
+    "label": "int32",
+    "classifier": "category",
+    "querier": "category",
+    "balancer": "category",
+    "feature_extractor": "category",
+    "training_set": "Int32",
+    "time": "float64",
+    "note": "string",
+    "tags": "string",
+    "user_id": "string",
+}
+
+RESULTS_DTYPES = {
+    "dataset": "string",
+    "condition": "string",
+    "metric": "string",
+    "value": "float64",
+    "n_abstracts": "Int32",
+    "length_abstracts": "Int32",
+    "llm_temperature": "float64",
+    "tdd@": "Int32",
+    "timestamp": "string",
+    "run": "int32",
+    "baseline_run": "int32",
+    "n_trials": "int32",
+    "query_batch_size": "int32",
+}
+
+
+### Atomic writes ###
+
+# Every output is written to a temporary file next to it, named <name>.<pid>.tmp, and moved over the real file once
+# complete, so an interrupted process (or a concurrent reader) never sees a partial file. The temporary files of
+# processes that crashed are removed when a sweep is resumed or its shards are merged.
+
+TMP_SUFFIX = '.tmp'
+
+
+def atomic_write(path: Path, write_fn) -> None:
+
+    # write_fn writes the file (or directory) at the temporary path it is given
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}{TMP_SUFFIX}')
+
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True) if tmp_path.is_dir() else tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def remove_temporary_files(directory: Path, skip: tuple = ()) -> int:
+
+    # leftovers of atomic_write in processes that crashed, except under the subdirectories in skip
+    removed = 0
+
+    for path in sorted(Path(directory).rglob(f'*{TMP_SUFFIX}')):
+        if any(part in skip for part in path.relative_to(directory).parts[:-1]) or not path.exists():
+            continue
+        shutil.rmtree(path, ignore_errors=True) if path.is_dir() else path.unlink(missing_ok=True)
+        removed += 1
+
+    return removed
+
+
+
+def compact(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+
+
+def write_table(df: pd.DataFrame, path: Path) -> None:
+
+    if path.suffix == '.parquet':
+        atomic_write(path, lambda tmp_path: df.to_parquet(tmp_path, index=False, compression='zstd'))
+    else:
+        atomic_write(path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+
+
+def read_table(path: Path, columns: list = None) -> pd.DataFrame:
+
+    if path.suffix == '.parquet':
+        return pd.read_parquet(path, columns=columns)
+
+    return pd.read_csv(path, usecols=columns)
+
+
+def raw_simulation_file(out_dir: Path, name: str, condition: str, run: int, ivs: str, output_format: str = "csv") -> Path:
+
+    if output_format == "parquet":
+        return out_dir / 'raw_simulations' / f'dataset={name}' / f'condition={condition}' / f'run={run}' / f'IVs_{ivs}.parquet'
+
+    return out_dir / name / 'raw_simulations' / f'{condition}_run_{run}_IVs_{ivs}.csv'
+
+
+def raw_simulation_paths(out_dir: Path, name: str, run: int, baseline_run: int, n_abstracts: int, length_abstracts: int, llm_temperature: float, output_format: str = "csv") -> dict:
+
+    paths = {condition: raw_simulation_file(out_dir, name, condition, run, f'{n_abstracts}_{length_abstracts}_{llm_temperature}', output_format) for condition in ['random', 'llm', 'criteria', 'no_initialisation']}
+
+    # baselines shared by all IV combinations of a replicate are stored under the shared baseline run
+    if baseline_run is not None:
+        paths.update({condition: raw_simulation_file(out_dir, name, condition, baseline_run, 'shared', output_format) for condition in BASELINE_CONDITIONS})
+
+    return paths
+
+
+def raw_simulation_files(out_dir: Path, name: str) -> list:
+
+    # (condition, run, IVs, path) of every raw simulation of a dataset in either layout, parsed from the file name or
+    # partition directories; IVs is "<n_abstracts>_<length_abstracts>_<llm_temperature>" or "shared"
+    files = []
+
+    for file in sorted((out_dir / name / 'raw_simulations').glob('*.csv')):
+        match = RAW_FILE_PATTERN.match(file.name)
+        if match:
+            files.append((match['condition'], int(match['run']), match['ivs'], file))
+
+    for file in sorted((out_dir / 'raw_simulations' / f'dataset={name}').glob('condition=*/run=*/IVs_*.parquet')):
+        files.append((file.parent.parent.name.removeprefix('condition='), int(file.parent.name.removeprefix('run=')), file.stem.removeprefix('IVs_'), file))
+
+    return files
+
+
+
+def simulated_datasets(out_dir: Path) -> list:
+
+    # names of the datasets with raw simulations in out_dir, in either layout
+    names = {path.parent.name for path in out_dir.glob('*/raw_simulations') if path.is_dir()}
+    names |= {path.name.removeprefix('dataset=') for path in (out_dir / 'raw_simulations').glob('dataset=*')}
+
+    return sorted(names)
+
+
+
+### SCREENING ORDER OF EVERY SIMULATION ###
+
+# With save_rankings, the screened records of every simulation (priors excluded) are kept in screening order as
+# int32 record ids and int8 labels in <out_dir>/<dataset>/rankings/<condition>_run_<run>_IVs_<ivs>.npz, together with
+# the number of records and relevant records that could be screened and the stop_at_n of the run, so that the
+# outcome metrics can be recomputed at other thresholds without simulating again.
+
+def ranking_file(out_dir: Path, name: str, condition: str, run: int, ivs: str) -> Path:
+    return out_dir / name / 'rankings' / f'{condition}_run_{run}_IVs_{ivs}.npz'
+
+
+def ranking_paths(out_dir: Path, name: str, run: int, baseline_run: int, n_abstracts: int, length_abstracts: int, llm_temperature: float) -> dict:
+
+    # same run and IVs in the file names as the raw simulations
+    paths = {condition: ranking_file(out_dir, name, condition, run, f'{n_abstracts}_{length_abstracts}_{llm_temperature}') for condition in ['random', 'llm', 'criteria', 'no_initialisation']}
+
+    if baseline_run is not None:
+        paths.update({condition: ranking_file(out_dir, name, condition, baseline_run, 'shared') for condition in BASELINE_CONDITIONS})
+
+    return paths
+
+
+def write_ranking(path: Path, record_ids: np.ndarray, labels: np.ndarray, n_records: int, n_relevant: int, stop_at_n: int, query_batch_size: int = 1) -> None:
+
+    def write(tmp_path: Path) -> None:
+        with tmp_path.open('wb') as f:
+            np.savez(f, record_id=np.asarray(record_ids, dtype=np.int32), label=np.asarray(labels, dtype=np.int8),
+                     n_records=n_records, n_relevant=n_relevant, stop_at_n=stop_at_n, query_batch_size=query_batch_size)
+
+    atomic_write(path, write)
+
+
+def read_ranking(path: Path) -> dict:
+    with np.load(path) as ranking:
+        return {key: ranking[key] for key in ranking.files}
+
+
+def ranking_files(out_dir: Path, name: str) -> list:
+
+    # (condition, run, IVs, path) of every stored ranking of a dataset
+    files = []
+
+    for file in sorted((out_dir / name / 'rankings').glob('*.npz')):
+        match = RANKING_FILE_PATTERN.match(file.name)
+        if match:
+            files.append((match['condition'], int(match['run']), match['ivs'], file))
+
+    return files
+
+
+
+### MASTER RESULTS ###
+
+def append_results(df_results: pd.DataFrame, out_dir: Path, output_format: str = "csv") -> None:
+
+    if output_format == "parquet":
+        # every write is a new part file of the master results dataset
+        parts_dir = out_dir / 'all_simulation_results'
+        write_table(compact(df_results, RESULTS_DTYPES), parts_dir / f'part-{pd.Timestamp.now():%Y%m%dT%H%M%S%f}-{os.getpid()}.parquet')
+        return
+
+    master_file = out_dir / 'all_simulation_results.csv'
+
+    if not master_file.exists():
+        df_results.to_csv(master_file, index=False)
+        return
+
+    # rows are appended under the header of the existing file, so their columns must be the same (in its order)
+    header = list(pd.read_csv(master_file, nrows=0).columns)
+
+    if set(header) == set(df_results.columns):
+        df_results[header].to_csv(master_file, mode='a', header=False, index=False)
+        return
+
+    # a master file written with other columns (e.g. before baseline_run and query_batch_size were added) is rewritten
+    # once with the union of the columns, left empty for the rows that do not have them
+    columns = [column for column in RESULTS_DTYPES if column in header or column in df_results.columns]
+    columns += [column for column in [*header, *df_results.columns] if column not in columns]
+    columns = list(dict.fromkeys(columns))
+
+    print(f"Rewriting {master_file} with the columns {', '.join(sorted(set(columns) - set(header)))} added to its existing rows")
+    df_master = pd.concat([pd.read_csv(master_file), df_results], ignore_index=True).reindex(columns=columns)
+    write_table(df_master.astype({column: 'Int32' for column, dtype in RESULTS_DTYPES.items() if dtype == 'int32' and column in columns}), master_file)
+
+
+def read_results(out_dir: Path, output_format: str = "csv") -> pd.DataFrame:
+
+    if output_format == "parquet":
+        parts = sorted((out_dir / 'all_simulation_results').glob('part-*.parquet'))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True) if parts else None
+
+    master_file = out_dir / 'all_simulation_results.csv'
+    return pd.read_csv(master_file) if master_file.exists() else None
+
+
+def replace_results(df_results: pd.DataFrame, out_dir: Path, output_format: str = "csv") -> None:
+
+    if output_format == "parquet":
+        # the new part is in place before the old parts are removed, so rows can be repeated but never lost
+        old_parts = sorted((out_dir / 'all_simulation_results').glob('part-*.parquet'))
+        append_results(df_results, out_dir, output_format="parquet")
+        for part in old_parts:
+            part.unlink()
+        return
+
+    write_table(df_results, out_dir / 'all_simulation_results.csv')
+
+
+class ResultsWriter:
+    """Buffers the metrics rows of finished cells and writes them to the master results in batches."""
+
+    def __init__(self, out_dir: Path, output_format: str = "csv", batch_size: int = 1):
+        self.out_dir = out_dir
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.frames = []
+        self.tasks = []
+
+    def add(self, frames: list, task: dict) -> list:
+
+        self.frames.extend(frames)
+        self.tasks.append(task)
+
+        if len(self.tasks) >= self.batch_size:
+            return self.flush()
+
+        return []
+
+    def flush(self) -> list:
+
+        # returns the cells whose rows were written, so the caller can record them as finished
+        if self.frames:
+            append_results(pd.concat(self.frames, ignore_index=True), self.out_dir, self.output_format)
+
+        flushed = self.tasks
+        self.frames, self.tasks = [], []
+
+        return flushed
@@ -0,0 +1,85 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+from asreview.models.feature_extractors import Tfidf
+
+from features import fit_features
+from llm import prepare_datasets
+from priors import sample_priors
+from simulation import RowRandom, simulate, TFIDF_KWARGS
+
+# The native engine must screen the records in the same order as asreview, for all four conditions. Same check as
+# check_engine.py, on a small synthetic dataset (LLM abstracts from the synthetic backend) so that it runs without
+# the SYNERGY data or the network.
+
+NAME = "synthetic"
+N_RECORDS = 300
+N_RELEVANT = 12
+STOP_AT_N = 60
+
+
+@pytest.fixture(scope="module")
+def dataset():
+
+    # relevant records use the topic words far more often, the others mostly the general words
+    rng = np.random.default_rng(0)
+    general = [f"word{i}" for i in range(400)]
+    topic = [f"topic{i}" for i in range(30)]
+
+    labels = np.zeros(N_RECORDS, dtype=int)
+    labels[rng.choice(N_RECORDS, size=N_RELEVANT, replace=False)] = 1
+
+    def text(label, length):
+        share = 0.3 if label == 1 else 0.02
+        return " ".join(rng.choice(topic) if rng.random() < share else rng.choice(general) for _ in range(length))
+
+    return pd.DataFrame({
+        "title": [text(label, 8) for label in labels],
+        "abstract": [text(label, 60) for label in labels],
+        "label_included": labels,
+        "doi": [f"10.0000/synthetic.{i}" for i in range(N_RECORDS)],
+    })
+
+
+def condition_views(dataset: pd.DataFrame, run: int, out_dir: Path) -> dict:
+
+    # features, labels and priors per condition, built like in a sweep
+    metadata = pd.DataFrame([{"dataset_ID": NAME, "inclusion_criteria": "Studies about " + " ".join(f"topic{i}" for i in range(10))}])
+    labels = dataset["label_included"]
+    X = Tfidf(**TFIDF_KWARGS).fit_transform(dataset)
+
+    views = {"no_initialisation": (X, labels, []), "random": (X, labels, [sample_priors(dataset, seed=run)])}
+
+    prepared = prepare_datasets(dataset, name=NAME, criterium=["inclusion_criteria"], out_dir=out_dir, metadata=metadata, n_abstracts=2, length_abstracts=50, llm_temperature=0.4, run=run, replicate=run - 1, llm_options={"backend": "synthetic"})
+    for condition, view in zip(("llm", "criteria"), prepared):
+        views[condition] = (fit_features(view['dataset'], TFIDF_KWARGS), view['dataset'].labels, view['prior_idx'])
+
+    return views
+
+
+@pytest.mark.parametrize("run", [1, 2])
+def test_native_engine_matches_asreview(dataset, run, tmp_path):
+
+    for condition, (X, labels, prior_idx) in condition_views(dataset, run, tmp_path).items():
+
+        n_stop = STOP_AT_N + len(prior_idx)
+        reference = simulate(X, labels, prior_idx, seed=run, n_stop=n_stop, skip_transform=True, engine="asreview")
+        native = simulate(X, labels, prior_idx, seed=run, n_stop=n_stop, skip_transform=True, engine="native")
+
+        np.testing.assert_array_equal(native["record_id"].to_numpy(), reference["record_id"].to_numpy(), err_msg=f"screening order of the {condition} condition")
+        np.testing.assert_array_equal(native["querier"].to_numpy(), reference["querier"].to_numpy(), err_msg=f"queriers of the {condition} condition")
+
+
+def test_random_querier_is_reseeded_on_every_query():
+
+    # the native Random cycle draws a fresh RandomState(seed) permutation of the pool at every step, which only matches
+    # asreview if its Random querier starts from the seed again on every query instead of advancing one generator
+    querier = RowRandom(random_state=3)
+
+    for n_pool in (50, 50, 49):
+        ranking = np.arange(n_pool)
+        np.random.RandomState(3).shuffle(ranking)
+
+        np.testing.assert_array_equal(querier.query(np.zeros((n_pool, 1))), ranking)
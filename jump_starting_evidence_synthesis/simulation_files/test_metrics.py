@@ -0,0 +1,47 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from asreviewcontrib.insights import metrics
+
+from metrics import evaluation_kernel, label_matrix
+
+# papers_found and atd of the evaluation kernel must match asreview-insights on the first stop_at_n screened records,
+# as computed per simulation before the kernel (tdd_at and _average_time_to_discovery on the truncated results).
+
+SIMULATIONS = [
+    np.array([0, 1, 0, 0, 1, 1, 0, 0, 0, 1, 0, 0]),  # relevant records found before and after the horizon
+    np.zeros(12, dtype=int),                          # no relevant record found
+    np.array([1, 0, 1]),                              # stopped before the horizon (e.g. all relevant records found)
+    np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1]),  # only relevant record past the horizon
+]
+
+
+def insights_metrics(labels: np.ndarray, horizon: int) -> tuple:
+
+    # (papers_found, atd) of one simulation with asreview-insights; atd is NaN when nothing was found
+    labels = labels[:horizon]
+    td = metrics._time_to_discovery(np.arange(len(labels)), labels)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        atd = metrics._average_time_to_discovery(td)
+
+    return sum(position <= horizon for _, position in td), atd
+
+
+@pytest.mark.parametrize("stop_at_n", [8, -1])
+def test_kernel_matches_insights(stop_at_n):
+
+    labels, lengths = label_matrix(SIMULATIONS)
+    n_relevant = np.array([4, 2, 2, 1])
+    n_records = np.full(len(SIMULATIONS), 20)
+
+    evaluation = evaluation_kernel(labels, lengths, n_relevant, n_records, stop_at_n)
+
+    for i, simulation in enumerate(SIMULATIONS):
+        papers_found, atd = insights_metrics(simulation, len(simulation) if stop_at_n == -1 else stop_at_n)
+
+        assert evaluation['papers_found'][i] == papers_found
+        np.testing.assert_equal(evaluation['atd'][i], atd)
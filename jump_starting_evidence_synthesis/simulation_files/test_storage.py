@@ -0,0 +1,36 @@
+import pytest
+
+from storage import atomic_write, remove_temporary_files
+
+# Atomic writes and the clean-up of the temporary files that crashed processes leave behind (see storage.py).
+
+
+def test_interrupted_write_keeps_previous_file(tmp_path):
+
+    path = tmp_path / "out" / "table.csv"
+    atomic_write(path, lambda tmp: tmp.write_text("complete"))
+
+    def crash(tmp):
+        tmp.write_text("parti")
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        atomic_write(path, crash)
+
+    assert path.read_text() == "complete"
+    assert [p.name for p in path.parent.iterdir()] == ["table.csv"]
+
+
+def test_leftover_temporary_files_are_removed(tmp_path):
+
+    # a file and a directory store left by a crashed process, and a file of a running worker's shard
+    (tmp_path / "raw").mkdir()
+    (tmp_path / "raw" / "results.csv.123.tmp").write_text("parti")
+    (tmp_path / "features.456.tmp").mkdir()
+    (tmp_path / "features.456.tmp" / "data.npy").write_bytes(b"")
+    (tmp_path / "shards" / "worker").mkdir(parents=True)
+    (tmp_path / "shards" / "worker" / "results.csv.789.tmp").write_text("busy")
+    (tmp_path / "raw" / "results.csv").write_text("complete")
+
+    assert remove_temporary_files(tmp_path, skip=("shards",)) == 2
+    assert sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob("*") if p.is_file()) == ["raw/results.csv", "shards/worker/results.csv.789.tmp"]
@@ -0,0 +1,61 @@
+import time
+
+from manifest import cell_key
+from work_queue import enqueue_cells, claim_cell, complete_cell, release_cell, queue_status
+
+# Leases, retries and shared-baseline dependencies of the work queue of a distributed sweep (see work_queue.py).
+
+
+def make_task(run: int, baseline_run: int = None) -> dict:
+    return {'dataset': 'synthetic', 'replicate': 0, 'combo_idx': run - 1, 'n_abstracts': 1, 'length_abstracts': 500,
+            'llm_temperature': 0.4, 'run': run, 'baseline_run': baseline_run}
+
+
+def enqueue_shared_baselines(path) -> tuple:
+
+    # the second cell reuses the baselines simulated by the first
+    first, second = make_task(1, baseline_run=1), make_task(2, baseline_run=1)
+    enqueue_cells(path, [first, second], units=[4, 1])
+
+    return first, second
+
+
+def test_dependent_cell_waits_for_its_shared_baselines(tmp_path):
+
+    path = tmp_path / 'work_queue.sqlite'
+    first, second = enqueue_shared_baselines(path)
+
+    assert cell_key(claim_cell(path, 'a', lease_seconds=60, max_attempts=3)) == cell_key(first)
+    assert claim_cell(path, 'b', lease_seconds=60, max_attempts=3) is None
+
+    complete_cell(path, first, 'a', seconds=1.0)
+    assert cell_key(claim_cell(path, 'b', lease_seconds=60, max_attempts=3)) == cell_key(second)
+
+
+def test_expired_lease_is_claimed_again_until_attempts_run_out(tmp_path):
+
+    path = tmp_path / 'work_queue.sqlite'
+    task = make_task(1)
+    enqueue_cells(path, [task], units=[1])
+
+    assert claim_cell(path, 'a', lease_seconds=0.05, max_attempts=2) is not None
+    time.sleep(0.1)
+    assert cell_key(claim_cell(path, 'b', lease_seconds=0.05, max_attempts=2)) == cell_key(task)
+
+    # a failed cell goes back to the queue while it has attempts left
+    release_cell(path, task, 'b', error='boom', max_attempts=3)
+    assert queue_status(path, max_attempts=3)['pending'] == 1
+
+
+def test_dead_worker_on_last_attempt_does_not_block_the_queue(tmp_path):
+
+    # the worker holding the first cell on its last attempt dies: once the lease expired the cell fails, and the cell
+    # waiting for its shared baselines can be claimed (it simulates them itself)
+    path = tmp_path / 'work_queue.sqlite'
+    first, second = enqueue_shared_baselines(path)
+
+    assert cell_key(claim_cell(path, 'dead', lease_seconds=0.1, max_attempts=1)) == cell_key(first)
+    time.sleep(0.2)
+
+    assert cell_key(claim_cell(path, 'alive', lease_seconds=60, max_attempts=1)) == cell_key(second)
+    assert queue_status(path, max_attempts=1) == {'pending': 0, 'leased': 1, 'done': 0, 'failed': 1}
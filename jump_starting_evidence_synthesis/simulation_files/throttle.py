@@ -0,0 +1,63 @@
+import random
+import threading
+import time
+
+
+### Rate limiting and retries for LLM requests ###
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def is_retryable(error: Exception) -> bool:
+
+    # litellm/openai errors carry the HTTP status code; retry on rate limits and server errors
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+def call_with_retry(fn, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, rate_limiter: TokenBucket = None):
+
+    attempt = 0
+
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            return fn()
+        except Exception as error:
+            if not is_retryable(error) or attempt >= max_retries:
+                raise
+
+            # exponential backoff with full jitter
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"LLM request failed with status {getattr(error, 'status_code', '?')}, retrying in {delay:.1f}s (retry {attempt + 1}/{max_retries}).")
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from manifest import MANIFEST_NAME, cell_key, load_manifest, save_manifest
+from storage import raw_simulation_paths, ranking_paths, read_results, replace_results, atomic_write, remove_temporary_files, BASELINE_CONDITIONS
+
+
+### Work queue of a distributed sweep ###
+
+# The cells of a sweep are enqueued once in <out_dir>/work_queue.sqlite, on storage shared by all hosts. Any number of
+# workers (run.py work) then claim cells one at a time with a lease that expires after lease_seconds unless the
+# worker renews it while the cell runs, so the cells of a worker that died are claimed again by another one, up to
+# max_attempts times. Every worker writes to its own shard, <out_dir>/shards/<worker>, laid out like an output folder
+# of its own (raw simulations, metrics rows, manifest.json, traces), and run.py merge moves the shards into out_dir.
+# Workers claim the longest cell first: every cell is enqueued with its cost in units of scheduling.CostModel, and the
+# seconds of the finished cells of its dataset (or of all datasets) turn the units of the other cells into seconds.
+
+QUEUE_NAME = 'work_queue.sqlite'
+
+SHARDS_DIR = 'shards'
+
+# seconds an idle worker waits before looking for claimable cells again (e.g. a lease that expires)
+POLL_SECONDS = 30
+
+# every shard file that is not combined row by row is moved into the output folder as it is
+SHARD_RESULTS = ('all_simulation_results.csv', 'all_simulation_results', MANIFEST_NAME)
+
+
+def queue_path(out_dir: Path) -> Path:
+    return out_dir / QUEUE_NAME
+
+
+def shard_dir(out_dir: Path, worker: str) -> Path:
+    return out_dir / SHARDS_DIR / worker
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+@contextmanager
+def connect(path: Path):
+
+    # transactions are opened explicitly (BEGIN IMMEDIATE takes the write lock up front, so two workers never claim
+    # the same cell); the timeout covers other hosts holding the lock for a moment
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+
+    try:
+        connection.execute("""CREATE TABLE IF NOT EXISTS cells (
+            key TEXT PRIMARY KEY, position INTEGER, task TEXT, dataset TEXT, units REAL, after TEXT, status TEXT DEFAULT 'pending',
+            worker TEXT, lease_expires REAL, attempts INTEGER DEFAULT 0, error TEXT, finished REAL, seconds REAL)""")
+        yield connection
+    finally:
+        connection.close()
+
+
+# estimated seconds of a cell: its units times the seconds per unit of the finished cells of its dataset, or of all
+# datasets (its units while no cell finished, enough to order the cells)
+ESTIMATE = """COALESCE(rates.rate, (SELECT SUM(seconds) / SUM(units) FROM cells WHERE seconds IS NOT NULL), 1) * cells.units"""
+
+RATES = """WITH rates AS (SELECT dataset, SUM(seconds) / SUM(units) AS rate FROM cells WHERE seconds IS NOT NULL GROUP BY dataset) """
+
+
+def enqueue_cells(path: Path, tasks: list, units: list, done_keys: set = frozenset()) -> int:
+
+    # cells already in the queue keep their state, so enqueueing again only adds new cells (e.g. more replicates);
+    # cells with shared baselines wait for the cell that simulates them, found by its run
+    keys = {(task['dataset'], task['run']): cell_key(task) for task in tasks}
+    rows = [(cell_key(task), position, json.dumps(task), task['dataset'], cell_units, keys.get((task['dataset'], task['baseline_run'])) if task['baseline_run'] not in (None, task['run']) else None,
+             'done' if cell_key(task) in done_keys else 'pending') for position, (task, cell_units) in enumerate(zip(tasks, units))]
+
+    with connect(path) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        before = connection.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+        connection.executemany("INSERT OR IGNORE INTO cells (key, position, task, dataset, units, after, status) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        added = connection.execute("SELECT COUNT(*) FROM cells").fetchone()[0] - before
+        connection.execute("COMMIT")
+
+    return added
+
+
+def claim_cell(path: Path, worker: str, lease_seconds: float, max_attempts: int) -> dict:
+
+    # the longest pending cell (the first in grid order among equals), or a cell whose lease expired; cells with shared
+    # baselines once the cell simulating them is done (or failed, then the cell simulates the baselines itself)
+    with connect(path) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        now = time.time()
+
+        # a worker that died on the last attempt of a cell never releases it: the cell fails once its lease expired, so
+        # the cells waiting for its shared baselines can be claimed
+        connection.execute("UPDATE cells SET status = 'failed', lease_expires = NULL, error = COALESCE(error, 'lease expired') WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, max_attempts))
+
+        row = connection.execute(RATES + """SELECT key, task FROM cells LEFT JOIN rates USING (dataset)
+            WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?
+            AND (after IS NULL OR after IN (SELECT key FROM cells WHERE status IN ('done', 'failed')))
+            ORDER BY """ + ESTIMATE + """ DESC, position LIMIT 1""", (now, max_attempts)).fetchone()
+
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+
+        connection.execute("UPDATE cells SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE key = ?", (worker, now + lease_seconds, row[0]))
+        connection.execute("COMMIT")
+
+    return json.loads(row[1])
+
+
+def renew_lease(path: Path, task: dict, worker: str, lease_seconds: float) -> bool:
+
+    # False when the lease was lost, i.e. it expired and another worker claimed the cell
+    with connect(path) as connection:
+        cursor = connection.execute("UPDATE cells SET lease_expires = ? WHERE key = ? AND worker = ? AND status = 'leased'", (time.time() + lease_seconds, cell_key(task), worker))
+        return cursor.rowcount == 1
+
+
+def keep_lease(path: Path, task: dict, worker: str, lease_seconds: float, stop: threading.Event) -> None:
+
+    # renews the lease of a running cell three times per lease period, until stop is set
+    while not stop.wait(lease_seconds / 3):
+        if not renew_lease(path, task, worker, lease_seconds):
+            print(f"Lost the lease of cell {cell_key(task)}, another worker may run it as well")
+            return
+
+
+def complete_cell(path: Path, task: dict, worker: str, seconds: float = None) -> None:
+    with connect(path) as connection:
+        connection.execute("UPDATE cells SET status = 'done', worker = ?, lease_expires = NULL, error = NULL, finished = ?, seconds = ? WHERE key = ?", (worker, time.time(), seconds, cell_key(task)))
+
+
+def release_cell(path: Path, task: dict, worker: str, error: str = None, max_attempts: int = 3) -> None:
+
+    # a failed cell is tried again until max_attempts; an interrupted one (error None) goes back without using an attempt
+    with connect(path) as connection:
+        if error is None:
+            connection.execute("UPDATE cells SET status = 'pending', lease_expires = NULL, attempts = attempts - 1 WHERE key = ? AND worker = ? AND status = 'leased'", (cell_key(task), worker))
+        else:
+            connection.execute("UPDATE cells SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, lease_expires = NULL, error = ? WHERE key = ? AND worker = ?", (max_attempts, error, cell_key(task), worker))
+
+
+def queue_status(path: Path, max_attempts: int = 3) -> dict:
+
+    # number of cells per state; leased cells whose lease expired count as pending, or as failed without attempts left
+    counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+
+    with connect(path) as connection:
+        for status, expired, attempts in connection.execute("SELECT status, lease_expires < ?, attempts FROM cells", (time.time(),)):
+            if status == 'leased' and expired:
+                status = 'pending' if attempts < max_attempts else 'failed'
+            counts[status] += 1
+
+    return counts
+
+
+def projected_seconds(path: Path) -> float:
+
+    # seconds until the queue is done: the estimated cells left (running ones in full) spread over the workers that hold
+    # a lease, but at least the longest cell left; None before any cell finished
+    with connect(path) as connection:
+        if connection.execute("SELECT COUNT(*) FROM cells WHERE seconds IS NOT NULL").fetchone()[0] == 0:
+            return None
+
+        total, longest, n_workers = connection.execute(RATES + """SELECT SUM(""" + ESTIMATE + """), MAX(""" + ESTIMATE + """),
+            COUNT(DISTINCT CASE WHEN status = 'leased' AND lease_expires >= ? THEN worker END)
+            FROM cells LEFT JOIN rates USING (dataset) WHERE status IN ('pending', 'leased')""", (time.time(),)).fetchone()
+
+    return max(total / max(n_workers, 1), longest) if total is not None else 0.0
+
+
+def active_workers(path: Path) -> set:
+    with connect(path) as connection:
+        return {row[0] for row in connection.execute("SELECT DISTINCT worker FROM cells WHERE status = 'leased' AND lease_expires >= ?", (time.time(),))}
+
+
+def baseline_worker(path: Path, task: dict) -> str:
+
+    # worker that simulated the shared baselines a cell reuses
+    with connect(path) as connection:
+        row = connection.execute("SELECT worker FROM cells WHERE key = (SELECT after FROM cells WHERE key = ?) AND status = 'done'", (cell_key(task),)).fetchone()
+
+    return row[0] if row else None
+
+
+
+### Shards of a distributed sweep ###
+
+def copy_shared_baselines(out_dir: Path, shard: Path, task: dict, source_worker: str, output_format: str = "csv") -> None:
+
+    # the shared baselines of a replicate are simulated once, by whichever worker ran its first IV combination; other
+    # workers copy them into their own shard (or take them from out_dir once that shard was merged)
+    if task['baseline_run'] in (None, task['run']):
+        return
+
+    ivs = (task['n_abstracts'], task['length_abstracts'], task['llm_temperature'])
+    paths = {**raw_simulation_paths(shard, task['dataset'], task['run'], task['baseline_run'], *ivs, output_format),
+             **{f'ranking_{condition}': path for condition, path in ranking_paths(shard, task['dataset'], task['run'], task['baseline_run'], *ivs).items()}}
+    sources = [shard_dir(out_dir, source_worker), out_dir] if source_worker is not None else [out_dir]
+
+    for condition, path in paths.items():
+        if condition.removeprefix('ranking_') not in BASELINE_CONDITIONS or path.exists():
+            continue
+
+        for source in sources:
+            source_path = source / path.relative_to(shard)
+            if source_path.exists():
+                atomic_write(path, lambda tmp_path: shutil.copyfile(source_path, tmp_path))
+                break
+
+
+def merge_shards(out_dir: Path, output_format: str = "csv", skip_workers: set = frozenset()) -> int:
+
+    # shards of workers that are still running a cell are left for a later merge
+    shards = sorted(path for path in (out_dir / SHARDS_DIR).glob('*') if path.is_dir() and path.name not in skip_workers)
+    if not shards:
+        return 0
+
+    # temporary files left by crashed processes, in out_dir and in the shards of the workers that are not running
+    removed = remove_temporary_files(out_dir, skip=(SHARDS_DIR,)) + sum(remove_temporary_files(shard) for shard in shards)
+    if removed:
+        print(f"Removed {removed} temporary files of interrupted writes")
+
+    manifest = load_manifest(out_dir)
+    frames = [df for df in [read_results(out_dir, output_format)] if df is not None]
+
+    for shard in shards:
+
+        # outputs are moved to the same place in out_dir (shared baselines copied by several workers are identical)
+        for path in sorted(shard.rglob('*')):
+            relative = path.relative_to(shard)
+            if path.is_file() and relative.parts[0] not in SHARD_RESULTS:
+                (out_dir / relative).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(path, out_dir / relative)
+
+        shard_results = read_results(shard, output_format)
+        if shard_results is not None:
+            frames.append(shard_results)
+
+        # the manifest paths are relative to the shard, so they hold for out_dir as well
+        manifest.update(load_manifest(shard))
+
+    # a merge that is cut short can be run again: the rows of every cell are kept once
+    if frames:
+        df_results = pd.concat(frames, ignore_index=True).sort_values('timestamp', kind='stable').drop_duplicates(subset=['dataset', 'run', 'condition', 'metric'], keep='last')
+        replace_results(df_results, out_dir, output_format)
+
+    save_manifest(out_dir, manifest)
+
+    for shard in shards:
+        shutil.rmtree(shard)
+
+    if not any((out_dir / SHARDS_DIR).iterdir()):
+        (out_dir / SHARDS_DIR).rmdir()
+
+    return len(shards)